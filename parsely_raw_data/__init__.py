@@ -16,15 +16,34 @@ limitations under the License.
 
 __version__ = '2.2.3'
 
-from . import bigquery, docgen, redshift, s3, samples, schema, stream, utils
+import sys
+
+from . import (analytics, bigquery, cache, checkpoint, codec, columnar,
+               consumer_group, docgen, metrics, query, records, redshift, s3,
+               samples, schema, sink, stream, utils)
 
 __all__ = [
+    'analytics',
     'bigquery',
+    'cache',
+    'checkpoint',
+    'codec',
+    'columnar',
+    'consumer_group',
     'docgen',
+    'metrics',
+    'query',
+    'records',
     'redshift',
     's3',
     'samples',
     'schema',
+    'sink',
     'stream',
     'utils',
 ]
+
+# asyncio support needs async generators, which arrived in Python 3.6
+if sys.version_info >= (3, 6):
+    from . import async_stream
+    __all__.append('async_stream')
@@ -0,0 +1,427 @@
+from __future__ import absolute_import, print_function
+
+import hashlib
+import heapq
+import math
+import struct
+import time
+from operator import itemgetter
+
+from six import iteritems, text_type
+
+__license__ = """
+Copyright 2016 Parsely, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Bounded-memory aggregates over streams of Parse.ly events.
+
+These work with the events from any reader (s3.events_s3,
+stream.events_kinesis, etc) and keep a fixed amount of state however many
+events or distinct keys they see.
+"""
+
+DEFAULT_PRECISION = 12
+
+
+def _key_getter(field):
+    """Return a function extracting a grouping key from an event
+
+    `field` is either the name of an event field or a function of an event.
+    List values, such as `metadata_tags`, are converted to tuples.
+    """
+    if callable(field):
+        return field
+
+    def get(event):
+        value = event.get(field)
+        if isinstance(value, list):
+            return tuple(value)
+        return value
+    return get
+
+
+class SpaceSaving(object):
+    """Approximate the most frequent keys in a stream with Space-Saving
+
+    At most `capacity` keys are tracked. When a new key arrives and the
+    summary is full, the least frequent key is replaced and the new key
+    inherits its count, so counts may overestimate by up to `errors[key]`.
+    Any key occurring more than `total / capacity` times is always tracked.
+
+    :param capacity: The maximum number of keys to track
+    :type capacity: int
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        # one (count, sequence, key) entry per tracked key; counts only grow,
+        # so an entry may be stale but is never an overestimate
+        self._heap = []
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, count=1):
+        """Count `key`, returning `(key, count)` of any key evicted for it"""
+        self.total += count
+        if key in self.counts:
+            self.counts[key] += count
+            return None
+        evicted = None
+        floor = 0
+        if len(self.counts) >= self.capacity:
+            evicted = self._pop_min()
+            floor = evicted[1]
+        self.counts[key] = floor + count
+        self.errors[key] = floor
+        self._sequence += 1
+        heapq.heappush(self._heap, (floor + count, self._sequence, key))
+        return evicted
+
+    def _pop_min(self):
+        while True:
+            count, _, key = self._heap[0]
+            actual = self.counts[key]
+            if actual == count:
+                heapq.heappop(self._heap)
+                del self.counts[key]
+                del self.errors[key]
+                return key, count
+            self._sequence += 1
+            heapq.heapreplace(self._heap, (actual, self._sequence, key))
+
+    def top(self, n=10):
+        """Return the `n` most frequent `(key, count)` pairs, most frequent first"""
+        return heapq.nlargest(n, iteritems(self.counts), key=itemgetter(1))
+
+
+class SlidingTopN(object):
+    """Count events by key over a sliding time window
+
+    The window is divided into `window / resolution` buckets, held in a
+    ring; each bucket counts its keys in a `SpaceSaving` summary of
+    `capacity` keys, and running totals across the live buckets are kept up
+    to date as events arrive and buckets expire. Querying the top keys
+    therefore never re-counts events, and memory is bounded by the number
+    of buckets times `capacity`.
+
+    :param field: The event field to group by, or a function returning the
+        key of an event. Events whose key is None are ignored.
+    :type field: str or callable
+    :param window: The length of the window, in seconds
+    :type window: float
+    :param resolution: The length of each bucket, in seconds
+    :type resolution: float
+    :param capacity: The maximum number of keys counted per bucket
+    :type capacity: int
+    :param clock: A function returning the current time, used when `add` or
+        `top` isn't passed a timestamp
+    :type clock: callable
+    """
+
+    def __init__(self, field="url", window=300, resolution=10, capacity=1000,
+                 clock=time.time):
+        self.key = _key_getter(field)
+        self.window = window
+        self.resolution = resolution
+        self.capacity = capacity
+        self.clock = clock
+        self.totals = {}
+        self._num_buckets = max(1, int(round(float(window) / resolution)))
+        # each slot holds (bucket index, SpaceSaving) or None
+        self._ring = [None] * self._num_buckets
+        self._current = None
+
+    def _expire(self, index):
+        """Drop the buckets that have slid out of a window ending in `index`"""
+        if self._current is not None and index <= self._current:
+            return
+        for position, slot in enumerate(self._ring):
+            if slot is None or slot[0] > index - self._num_buckets:
+                continue
+            for key, count in iteritems(slot[1].counts):
+                self._subtract(key, count)
+            self._ring[position] = None
+        self._current = index
+
+    def _subtract(self, key, count):
+        remaining = self.totals[key] - count
+        if remaining > 0:
+            self.totals[key] = remaining
+        else:
+            del self.totals[key]
+
+    def add(self, event, timestamp=None, count=1):
+        """Count an event
+
+        :param event: The event to count
+        :type event: dict
+        :param timestamp: The time, in seconds since the epoch, at which to
+            count the event (eg its ts_action), defaulting to now. Events
+            older than the window are ignored.
+        :type timestamp: float
+        :param count: The weight of the event
+        :type count: int
+        """
+        key = self.key(event)
+        if key is None:
+            return
+        if timestamp is None:
+            timestamp = self.clock()
+        index = int(timestamp // self.resolution)
+        self._expire(index)
+        if index <= self._current - self._num_buckets:
+            return
+        position = index % self._num_buckets
+        slot = self._ring[position]
+        if slot is None:
+            slot = self._ring[position] = (index, SpaceSaving(self.capacity))
+        bucket = slot[1]
+        before = bucket.counts.get(key, 0)
+        evicted = bucket.add(key, count)
+        if evicted is not None:
+            self._subtract(*evicted)
+        self.totals[key] = (self.totals.get(key, 0) +
+                            bucket.counts[key] - before)
+
+    def top(self, n=10, timestamp=None):
+        """Return the `n` most frequent `(key, count)` pairs in the window
+
+        :param n: The number of keys to return
+        :type n: int
+        :param timestamp: The end of the window, defaulting to now
+        :type timestamp: float
+        """
+        if timestamp is None:
+            timestamp = self.clock()
+        self._expire(int(timestamp // self.resolution))
+        return heapq.nlargest(n, iteritems(self.totals), key=itemgetter(1))
+
+    def total(self, timestamp=None):
+        """Return the number of events counted in the window"""
+        if timestamp is None:
+            timestamp = self.clock()
+        self._expire(int(timestamp // self.resolution))
+        return sum(slot[1].total for slot in self._ring if slot is not None)
+
+
+def _hash64(value):
+    if not isinstance(value, bytes):
+        value = text_type(value).encode("utf-8")
+    return struct.unpack("<Q", hashlib.md5(value).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct values in a stream with HyperLogLog
+
+    The sketch holds `2 ** precision` one-byte registers, and its estimates
+    have a standard error of about `1.04 / sqrt(2 ** precision)` (1.6% at the
+    default precision of 12, in 4KB). Sketches of the same precision can be
+    merged, giving the sketch of the union of their streams, so they may be
+    built in separate processes or time periods and combined afterwards.
+    They pickle, and `to_bytes` gives a compact form for storage.
+
+    :param precision: The number of index bits, from 4 to 16
+    :type precision: int
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self._width = 64 - precision
+        size = 1 << precision
+        if registers is None:
+            registers = bytearray(size)
+        elif len(registers) != size:
+            raise ValueError("expected {} registers, got {}".format(
+                size, len(registers)))
+        self.registers = bytearray(registers)
+
+    def add(self, value):
+        """Add a value (hashed by its UTF-8 string form) to the sketch"""
+        hashed = _hash64(value)
+        index = hashed >> self._width
+        rank = self._width - (hashed & ((1 << self._width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        """Add each of `values` to the sketch"""
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """Fold another sketch of the same precision into this one"""
+        if other.precision != self.precision:
+            raise ValueError("can't merge sketches of precision {} and {}"
+                             .format(self.precision, other.precision))
+        self.registers = bytearray(max(a, b) for a, b in
+                                   zip(self.registers, other.registers))
+        return self
+
+    def count(self):
+        """Return the estimated number of distinct values added"""
+        size = len(self.registers)
+        if size >= 128:
+            alpha = 0.7213 / (1 + 1.079 / size)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[size]
+        estimate = alpha * size * size / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+    def to_bytes(self):
+        """Serialize the sketch as its precision followed by its registers"""
+        return bytes(bytearray([self.precision]) + self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Load a sketch serialized by `to_bytes`"""
+        data = bytearray(data)
+        return cls(precision=data[0], registers=data[1:])
+
+
+class SketchMap(object):
+    """Count distinct values per key, with a HyperLogLog sketch per key
+
+    For example, `SketchMap("url", "visitor_site_id")` estimates the unique
+    visitors to each URL. To count uniques per URL per hour, key by a
+    function such as ``lambda e: (e["ts_action"][:13], e["url"])``, or keep
+    one map per hour and merge them to cover longer periods.
+
+    Memory is bounded by `max_keys` sketches of `2 ** precision` bytes each.
+    Once `max_keys` keys are held, a new key replaces the one with the
+    fewest events (as counted by a `SpaceSaving` summary), so the busiest
+    keys are kept. A key admitted that way gets a new sketch but inherits
+    the replaced key's count, so its sketch may have missed up to that many
+    of its events; `errors` gives this bound for each key, and
+    ``counts(complete=True)`` leaves out keys whose sketches may be
+    incomplete. Maps pickle, so they can be built per S3 object in
+    `s3.map_events_s3` (see `sketch_uniques`) and merged in the parent.
+
+    :param field: The event field to group by, or a function returning the
+        key of an event. Events whose key is None are ignored.
+    :type field: str or callable
+    :param value_field: The event field whose distinct values are counted, or
+        a function returning the value of an event
+    :type value_field: str or callable
+    :param precision: The precision of each key's sketch
+    :type precision: int
+    :param max_keys: The maximum number of keys to hold sketches for
+    :type max_keys: int
+    """
+
+    def __init__(self, field="url", value_field="visitor_site_id",
+                 precision=10, max_keys=10000):
+        self.field = field
+        self.value_field = value_field
+        self.precision = precision
+        self.max_keys = max_keys
+        self.sketches = {}
+        self._events = SpaceSaving(max_keys)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # nested getters can't be pickled, so they're rebuilt on load
+        state.pop("_key", None)
+        state.pop("_value", None)
+        return state
+
+    def _sketch(self, key, count):
+        evicted = self._events.add(key, count)
+        if evicted is not None:
+            del self.sketches[evicted[0]]
+        sketch = self.sketches.get(key)
+        if sketch is None:
+            sketch = self.sketches[key] = HyperLogLog(self.precision)
+        return sketch
+
+    def add(self, event):
+        """Add an event's value to the sketch for its key"""
+        if "_key" not in self.__dict__:
+            self._key = _key_getter(self.field)
+            self._value = _key_getter(self.value_field)
+        key = self._key(event)
+        value = self._value(event)
+        if key is None or value is None:
+            return
+        self._sketch(key, 1).add(value)
+
+    def update(self, events):
+        """Add each of `events` to the map"""
+        for event in events:
+            self.add(event)
+        return self
+
+    def merge(self, other):
+        """Fold another map's sketches into this one"""
+        for key, sketch in iteritems(other.sketches):
+            self._sketch(key, other._events.counts.get(key, 1)).merge(sketch)
+            self._events.errors[key] += other._events.errors.get(key, 0)
+        return self
+
+    def errors(self):
+        """Return a dict of the number of each key's events its sketch may
+        have missed, which is nonzero for keys admitted by replacing another
+        """
+        return dict((key, self._events.errors[key]) for key in self.sketches)
+
+    def counts(self, complete=False):
+        """Return a dict of the estimated distinct values for each key
+
+        :param complete: Only include keys whose sketches have seen every one
+            of their events, so their counts aren't underestimates
+        :type complete: bool
+        """
+        errors = self._events.errors
+        return dict((key, sketch.count())
+                    for key, sketch in iteritems(self.sketches)
+                    if not complete or not errors[key])
+
+    def top(self, n=10, complete=False):
+        """Return the `n` keys with the most distinct values, with their counts
+
+        :param n: The number of keys to return
+        :type n: int
+        :param complete: Only include keys whose sketches have seen every one
+            of their events
+        :type complete: bool
+        """
+        return heapq.nlargest(n, iteritems(self.counts(complete=complete)),
+                              key=itemgetter(1))
+
+
+def sketch_uniques(events, field="url", value_field="visitor_site_id",
+                   precision=10, max_keys=10000):
+    """Build a `SketchMap` of distinct values per key from `events`
+
+    Suitable, via `functools.partial`, as the `func` of `s3.map_events_s3`::
+
+        func = functools.partial(sketch_uniques, field="url")
+        uniques = SketchMap("url")
+        for sketches in map_events_s3("blog.parsely.com", func, prefix=...):
+            uniques.merge(sketches)
+    """
+    return SketchMap(field, value_field, precision=precision,
+                     max_keys=max_keys).update(events)
@@ -0,0 +1,220 @@
+from __future__ import absolute_import, print_function
+
+import asyncio
+
+from botocore.exceptions import ClientError, ParamValidationError
+
+from . import query, utils
+from .stream import (MAX_RECORDS_PER_CALL, THROTTLE_ERRORS, _backoff,
+                     _poll_interval, decode_records)
+
+__license__ = """
+Copyright 2016 Parsely, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+An asyncio-native Kinesis consumer for Parse.ly streams (Python 3.6+).
+
+All shards are read concurrently as tasks on one event loop, with the same
+polling and backoff behaviour as parsely_raw_data.stream. The client is
+any object with awaitable `describe_stream`, `get_shard_iterator` and
+`get_records` methods taking boto3's arguments, such as an aiobotocore
+Kinesis client or an in-memory fake for tests.
+"""
+
+
+async def list_shards(client, stream):
+    """Return the description of every shard in a stream, open or closed"""
+    shards = []
+    kwargs = {"StreamName": stream}
+    while True:
+        response = await client.describe_stream(**kwargs)
+        description = response.get("StreamDescription", {})
+        shards.extend(description.get("Shards", []))
+        if not description.get("HasMoreShards", False) or not shards:
+            return shards
+        kwargs["ExclusiveStartShardId"] = shards[-1].get("ShardId")
+
+
+async def _shard_iterator(client, stream, shard_id, checkpoint=None,
+                          after_sequence_number=None):
+    kwargs = {"StreamName": stream, "ShardId": shard_id,
+              "ShardIteratorType": "LATEST"}
+    if after_sequence_number is None and checkpoint is not None:
+        after_sequence_number = checkpoint.get(stream, shard_id)
+        if after_sequence_number is None:
+            kwargs["ShardIteratorType"] = "TRIM_HORIZON"
+    if after_sequence_number is not None:
+        kwargs["ShardIteratorType"] = "AFTER_SEQUENCE_NUMBER"
+        kwargs["StartingSequenceNumber"] = after_sequence_number
+    response = await client.get_shard_iterator(**kwargs)
+    return response.get("ShardIterator")
+
+
+async def _read_shard(client, stream, shard_id, decode, output, slots,
+                      checkpoint, limit):
+    """Read one shard until it closes, putting decoded batches on `output`
+
+    `slots` bounds how many of this shard's batches may wait on `output`.
+    """
+    loop = asyncio.get_event_loop()
+    iterator = await _shard_iterator(client, stream, shard_id,
+                                     checkpoint=checkpoint)
+    last_sequence_number = None
+    attempt = 0
+    while iterator:
+        started = loop.time()
+        try:
+            response = await client.get_records(ShardIterator=iterator,
+                                                Limit=limit)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code in THROTTLE_ERRORS:
+                await asyncio.sleep(_backoff(attempt))
+                attempt += 1
+            elif code == "ExpiredIteratorException":
+                iterator = await _shard_iterator(
+                    client, stream, shard_id, checkpoint=checkpoint,
+                    after_sequence_number=last_sequence_number)
+            else:
+                await asyncio.sleep(2)
+            continue
+        except ParamValidationError:
+            await asyncio.sleep(2)
+            continue
+        attempt = 0
+        iterator = response.get("NextShardIterator")
+        records = response.get("Records", [])
+        if records:
+            last_sequence_number = records[-1].get("SequenceNumber")
+            sequence_numbers, events = decode_records(records, decode)
+            await slots.acquire()
+            await output.put((shard_id, last_sequence_number, sequence_numbers,
+                              events, slots))
+        delay = (_poll_interval(len(records), response.get("MillisBehindLatest"))
+                 - (loop.time() - started))
+        if iterator and delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def _guard(reader, output):
+    """Run a shard reader, passing any exception it raises to the consumer"""
+    try:
+        await reader
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await output.put(e)
+
+
+async def _consume(client, stream, decode, buffer_size, checkpoint, limit):
+    output = asyncio.Queue()
+    loop = asyncio.get_event_loop()
+    tasks = []
+    try:
+        for shard in await list_shards(client, stream):
+            slots = asyncio.Semaphore(buffer_size)
+            reader = _read_shard(client, stream, shard.get("ShardId"), decode,
+                                 output, slots, checkpoint, limit)
+            tasks.append(loop.create_task(_guard(reader, output)))
+        while True:
+            item = await output.get()
+            if isinstance(item, Exception):
+                raise item
+            shard_id, last_sequence_number, sequence_numbers, events, slots = item
+            slots.release()
+            if checkpoint is None:
+                for event in events:
+                    yield event
+                continue
+            for sequence_number, event in zip(sequence_numbers, events):
+                yield event
+                if sequence_number is not None:
+                    checkpoint.record(stream, shard_id, sequence_number)
+            checkpoint.record(stream, shard_id, last_sequence_number)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if checkpoint is not None:
+            checkpoint.commit()
+
+
+async def aevents_kinesis(network,
+                          access_key_id="",
+                          secret_access_key="",
+                          region_name="us-east-1",
+                          client=None,
+                          fields=None,
+                          where=None,
+                          buffer_size=10,
+                          checkpoint=None,
+                          limit=MAX_RECORDS_PER_CALL):
+    """Asynchronously yield a stream of events from a Parse.ly Kinesis Stream
+
+    Use as ``async for event in aevents_kinesis(...)``.
+
+    :param network: The Parse.ly network name for which to perform reads (eg
+        "blog.parsely.com")
+    :type network: str
+    :param access_key_id: The AWS access key to use when consuming the stream
+    :type access_key_id: str
+    :param secret_access_key: The AWS secret key to use when consuming the stream
+    :type secret_access_key: str
+    :param region_name: The AWS region of the stream
+    :type region_name: str
+    :param client: Optional: the asynchronous Kinesis client to read with.
+        Without one, an aiobotocore client is created from the credentials.
+    :param fields: If given, yield events holding only these keys
+    :type fields: list
+    :param where: If given, yield only events matching this filter, mapping
+        field names to a value or a list of acceptable values
+    :type where: dict
+    :param buffer_size: The maximum number of record batches buffered per shard
+        before that shard's reads pause for the consumer to catch up
+    :type buffer_size: int
+    :param checkpoint: Optional: a store in which to record each shard's
+        position as its events are consumed, as in `stream.events_kinesis`
+    :type checkpoint: parsely_raw_data.checkpoint.ShardCheckpointStore
+    :param limit: The maximum number of records to request per call
+    :type limit: int
+    """
+    stream = "parsely-dw-{}".format(utils.clean_network(network))
+    decode = query.compile_query(fields=fields, where=where)
+    if client is not None:
+        # close the reader explicitly so its tasks are cancelled and the
+        # checkpoint committed as soon as we are, not when it's collected
+        events = _consume(client, stream, decode, buffer_size, checkpoint,
+                          limit)
+        try:
+            async for event in events:
+                yield event
+        finally:
+            await events.aclose()
+        return
+    try:
+        from aiobotocore.session import get_session
+    except ImportError:
+        raise ImportError("aevents_kinesis requires aiobotocore unless a "
+                          "client is passed")
+    async with get_session().create_client(
+            'kinesis',
+            region_name=region_name,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key) as client:
+        events = _consume(client, stream, decode, buffer_size, checkpoint,
+                          limit)
+        try:
+            async for event in events:
+                yield event
+        finally:
+            await events.aclose()
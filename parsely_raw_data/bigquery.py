@@ -1,16 +1,32 @@
 from __future__ import absolute_import, print_function
 
+import hashlib
+import itertools
 import logging
+import os
 import pprint
 import json
+import tempfile
+import threading
+import time
+from collections import namedtuple
 
-from googleapiclient.discovery import build as google_build
+import httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
+from googleapiclient.model import JsonModel
 from oauth2client.client import GoogleCredentials
+import six
 from six import iteritems
 
-from . import utils
+from . import codec, utils
+from .cache import _atomic_write
+from .checkpoint import S3Checkpoint
 from .s3 import events_s3
-from .schema import mk_bigquery_schema
+from .schema import compile_projector, mk_bigquery_schema
+from .sink import PartitionedFileSink
+from .stream import _backoff
 
 
 __license__ = """
@@ -28,14 +44,223 @@ limitations under the License.
 
 log = logging.getLogger(__name__)
 
+# insertAll requests are limited to 10MB; a batch is closed once it reaches
+# MAX_INSERT_BYTES, so this leaves room for the row that takes it over
+MAX_INSERT_ROWS = 500
+MAX_INSERT_BYTES = 4 * 1024 * 1024
+INSERT_CONCURRENCY = 4
+INSERT_ATTEMPTS = 5
+# insertErrors reasons for rows that may succeed if sent again; "stopped"
+# rows were valid but held back because another row in the request wasn't
+RETRYABLE_REASONS = frozenset(["backendError", "internalError", "timeout",
+                               "rateLimitExceeded", "stopped"])
+
+InsertSummary = namedtuple("InsertSummary", [
+    "batches", "rows", "failed_batches", "failed_rows"])
+
+# load jobs accept gzipped JSON files of up to 4GB; smaller files let more
+# of them be written and uploaded in parallel
+LOAD_FILE_BYTES = 256 * 1024 * 1024
+LOAD_WRITERS = 4
+LOAD_CONCURRENCY = 4
+LOAD_POLL_INTERVAL = 5.0
+# resumable uploads are sent in chunks of a multiple of 256KB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# the job label holding the SHA-1 digest of the file a load job was sent
+LOAD_DIGEST_LABEL = "parsely_source_sha1"
+
+LoadSummary = namedtuple("LoadSummary", ["files", "failed_files"])
+
+DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/bigquery/v2/rest"
+DISCOVERY_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache",
+                                    "parsely_raw_data",
+                                    "bigquery-v2-discovery.json")
+DISCOVERY_CACHE_TTL = 24 * 60 * 60
+BIGQUERY_SCOPE = "https://www.googleapis.com/auth/bigquery"
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class _EncodedJson(six.text_type):
+    """A request body already encoded as JSON, which is sent as it is"""
+
+
+class CodecJsonModel(JsonModel):
+    """Serialize BigQuery API request bodies with the fastest JSON codec"""
+
+    def serialize(self, body_value):
+        if isinstance(body_value, _EncodedJson):
+            return body_value
+        if (isinstance(body_value, dict) and 'data' not in body_value and
+                self._data_wrapper):
+            body_value = {'data': body_value}
+        return codec.dumps(body_value)
+
+
+def _discovery_document(path=DISCOVERY_CACHE_PATH, ttl=DISCOVERY_CACHE_TTL):
+    """Return the BigQuery discovery document, cached on disk for `ttl` seconds
+
+    A stale cached copy is used if the document can't be fetched.
+    """
+    cached = None
+    try:
+        with open(path, "rb") as f:
+            cached = f.read().decode("utf-8")
+        if time.time() - os.path.getmtime(path) < ttl:
+            return cached
+    except (IOError, OSError):
+        pass
+    try:
+        response, content = httplib2.Http(timeout=30).request(DISCOVERY_URL)
+        if response.status != 200:
+            raise IOError("HTTP {}".format(response.status))
+    except Exception as e:
+        if cached is None:
+            raise
+        log.warning("Using a stale BigQuery discovery document: %s", e)
+        return cached
+    try:
+        _atomic_write(path, content)
+    except (IOError, OSError) as e:
+        log.warning("Couldn't cache the BigQuery discovery document: %s", e)
+    return content.decode("utf-8")
+
+
+class _ThreadLocalHttp(object):
+    """An httplib2.Http stand-in that gives each thread its own connection
+
+    httplib2 connections can't be shared between threads, so a client built
+    with one of these can be.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = threading.local()
+
+    def _http(self):
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = self._local.http = self._factory()
+        return http
+
+    def request(self, *args, **kwargs):
+        return self._http().request(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._http(), name)
+
+
+def bigquery_client(credentials=None):
+    """Return a BigQuery API client that is safe to share between threads
+
+    The client is built from a discovery document cached on disk for
+    `DISCOVERY_CACHE_TTL` seconds rather than fetched on every build, and
+    with the application default credentials it's built once per process.
+
+    :param credentials: Optional: the credentials to use instead of the
+        application default credentials, in which case a new client is built
+    :type credentials: oauth2client.client.Credentials
+    """
+    global _client
+    if credentials is None:
+        with _client_lock:
+            if _client is None:
+                _client = bigquery_client(
+                    GoogleCredentials.get_application_default())
+            return _client
+    if credentials.create_scoped_required():
+        credentials = credentials.create_scoped([BIGQUERY_SCOPE])
+    http = _ThreadLocalHttp(lambda: credentials.authorize(httplib2.Http()))
+    return build_from_document(_discovery_document(), http=http,
+                               model=CodecJsonModel())
+
+
+def _insert_row(row):
+    """Wrap a row for insertAll, deduplicated on its event_id if it has one"""
+    entry = {"json": row}
+    event_id = row.get("event_id")
+    if event_id:
+        entry["insertId"] = event_id
+    return entry
+
+
+def _insert_body(rows):
+    return {
+        "kind": "bigquery#tableDataInsertAllRequest",
+        "skipInvalidRows": False,
+        "ignoreUnknownValues": False,
+        "rows": [_insert_row(row) for row in rows]
+    }
+
+
+def _encode_insert_row(row):
+    return codec.dumps(_insert_row(row))
+
+
+def _encoded_insert_body(entries):
+    """Join rows encoded by `_encode_insert_row` into an insertAll body"""
+    return _EncodedJson(
+        '{"kind":"bigquery#tableDataInsertAllRequest",'
+        '"skipInvalidRows":false,"ignoreUnknownValues":false,'
+        '"rows":[' + ",".join(entries) + ']}')
+
+
+def _insert_rows(bq_conn, entries, project_id, dataset_id, table_id,
+                 max_attempts=INSERT_ATTEMPTS):
+    """Insert rows, resending only the rows that fail for transient reasons
+
+    Each row is encoded once, by `_encode_insert_row`, and the encoded rows
+    are joined into each request. Returns the indexes of the rows that
+    couldn't be inserted.
+    """
+    pending = list(range(len(entries)))
+    failed = []
+    retry = []
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(_backoff(attempt - 1))
+        query = bq_conn.tabledata().insertAll(
+            projectId=project_id,
+            datasetId=dataset_id,
+            tableId=table_id,
+            body=_encoded_insert_body([entries[index] for index in pending]))
+        response = query.execute(num_retries=5)
+        retry = []
+        for error_set in response.get('insertErrors', []):
+            index = pending[error_set['index']]
+            errors = error_set.get('errors', [])
+            if errors and all(error.get('reason') in RETRYABLE_REASONS
+                              for error in errors):
+                retry.append(index)
+                continue
+            for error in errors:
+                log.error(error)
+            failed.append(index)
+        if not retry:
+            break
+        pending = sorted(retry)
+    else:
+        log.error("%d rows still failing after %d attempts", len(retry),
+                  max_attempts)
+        failed.extend(retry)
+    return sorted(failed)
+
 
 def streaming_insert_bigquery(jsonlines,
                               bq_conn=None,
                               project_id=None,
                               dataset_id=None,
-                              table_id=None):
+                              table_id=None,
+                              max_attempts=INSERT_ATTEMPTS):
     """Write a stream of events to BigQuery
 
+    Rows that fail for transient reasons are resent, with backoff, up to
+    `max_attempts` times in all; the other rows aren't sent again. Each row
+    carries its event_id as its insertId, so BigQuery drops rows that were
+    already inserted by an earlier attempt or run. Returns True if every
+    row was inserted.
+
     :param bq_conn: The BigQuery connection to write to
     :type bq_conn: googleapiclient.discovery.Resource
     :param project_id: The BigQuery project ID to write to
@@ -44,29 +269,126 @@ def streaming_insert_bigquery(jsonlines,
     :type dataset_id: str
     :param table_id: The BigQuery table ID to write to
     :type table_id: str
+    :param max_attempts: The maximum number of times to send a row
+    :type max_attempts: int
     """
-    insert_body = {
-        "kind": "bigquery#tableDataInsertAllRequest",
-        "skipInvalidRows": False,
-        "ignoreUnknownValues": False,
-        "rows": [
-            {"json": line} for line in jsonlines
-        ]
-    }
+    rows = list(jsonlines)
     if bq_conn is None:
-        pprint.PrettyPrinter(indent=0).pprint(insert_body)
+        pprint.PrettyPrinter(indent=0).pprint(_insert_body(rows))
         return False
-    query = bq_conn.tabledata().insertAll(projectId=project_id,
-                                          datasetId=dataset_id,
-                                          tableId=table_id,
-                                          body=insert_body)
-    response = query.execute(num_retries=5)
-    if 'insertErrors' in response:
-        for error_set in response['insertErrors']:
-            for error in error_set['errors']:
-                log.error(error)
-        return False
-    return True
+    entries = [_encode_insert_row(row) for row in rows]
+    return not _insert_rows(bq_conn, entries, project_id, dataset_id,
+                            table_id, max_attempts=max_attempts)
+
+
+def _schema_compliant_rows(events):
+    """Project events onto the columns of the BigQuery schema"""
+    project = compile_projector("bigquery")
+    return (project(event) for event in events)
+
+
+def row_batches(rows, max_rows=MAX_INSERT_ROWS, max_bytes=MAX_INSERT_BYTES,
+                checkpoint=None):
+    """Encode rows for insertAll and group them by row count and size
+
+    Each row is encoded once, and a batch is closed once it holds
+    `max_rows` rows or at least `max_bytes` bytes of encoded rows. Yields
+    `(entries, mark)` pairs, where `entries` are the encoded rows and `mark`
+    is the `checkpoint.mark()` taken as the batch was closed (or None
+    without a checkpoint).
+
+    :param rows: The rows to group
+    :type rows: iterable
+    :param max_rows: The maximum number of rows per batch
+    :type max_rows: int
+    :param max_bytes: The encoded size at which a batch is closed
+    :type max_bytes: int
+    :param checkpoint: Optional: the checkpoint recording the positions of
+        the events `rows` come from
+    :type checkpoint: parsely_raw_data.checkpoint.S3Checkpoint
+    """
+    batch = []
+    batch_bytes = 0
+    for row in rows:
+        entry = _encode_insert_row(row)
+        batch.append(entry)
+        # the length of the JSON text approximates its encoded size
+        batch_bytes += len(entry) + 1
+        if len(batch) >= max_rows or batch_bytes >= max_bytes:
+            yield batch, checkpoint.mark() if checkpoint is not None else None
+            batch = []
+            batch_bytes = 0
+    if checkpoint is not None:
+        # a final, possibly empty, batch carries the positions recorded as
+        # the last objects were completed
+        yield batch, checkpoint.mark()
+    elif batch:
+        yield batch, None
+
+
+def insert_batches(batches,
+                   connect,
+                   project_id=None,
+                   dataset_id=None,
+                   table_id=None,
+                   concurrency=INSERT_CONCURRENCY,
+                   checkpoint=None):
+    """Stream batches of rows to BigQuery with concurrent insertAll requests
+
+    Up to `concurrency` requests are in flight at once, each sent from a
+    pool thread with its own HTTP connection. Results are accounted for in the
+    order the batches were produced: each batch's checkpoint mark is
+    committed once it and every earlier batch have been inserted, so the
+    checkpoint never advances past a batch with failed rows. Returns an
+    `InsertSummary` of the batches and rows sent, the indexes of the batches
+    with rows that couldn't be inserted, and the number of those rows.
+
+    :param batches: `(entries, mark)` pairs, as yielded by `row_batches`
+    :type batches: iterable
+    :param connect: A function returning a BigQuery connection, called
+        once per pool thread, or returning None for a dry run
+    :type connect: callable
+    :param project_id: The BigQuery project ID to write to
+    :type project_id: str
+    :param dataset_id: The BigQuery dataset ID to write to
+    :type dataset_id: str
+    :param table_id: The BigQuery table ID to write to
+    :type table_id: str
+    :param concurrency: The maximum number of requests in flight
+    :type concurrency: int
+    :param checkpoint: Optional: the checkpoint to commit batch marks to
+    :type checkpoint: parsely_raw_data.checkpoint.S3Checkpoint
+    """
+    local = threading.local()
+
+    def send(batch):
+        entries, mark = batch
+        if not entries:
+            return 0, mark, []
+        if not hasattr(local, "bq_conn"):
+            local.bq_conn = connect()
+        if local.bq_conn is None:
+            print(_encoded_insert_body(entries))
+            return len(entries), mark, []
+        return len(entries), mark, _insert_rows(
+            local.bq_conn, entries, project_id, dataset_id, table_id)
+
+    num_batches = num_rows = failed_rows = 0
+    failed_batches = []
+    results = utils.imap_bounded(send, batches, max_workers=concurrency,
+                                 prefetch=concurrency)
+    for index, (size, mark, failed) in enumerate(results):
+        num_batches += 1 if size else 0
+        num_rows += size
+        if failed:
+            failed_batches.append(index)
+            failed_rows += len(failed)
+            log.error("%d of the %d rows in batch %d failed to insert",
+                      len(failed), size, index)
+        elif (checkpoint is not None and mark is not None and
+              not failed_batches):
+            checkpoint.commit(mark)
+    return InsertSummary(num_batches, num_rows, failed_batches, failed_rows)
 
 
 def copy_from_s3(network,
@@ -77,9 +399,19 @@ def copy_from_s3(network,
                  project_id=None,
                  dataset_id=None,
                  table_id=None,
-                 dry_run=False):
+                 dry_run=False,
+                 start=None,
+                 end=None,
+                 checkpoint_path=None,
+                 concurrency=INSERT_CONCURRENCY,
+                 max_rows=MAX_INSERT_ROWS,
+                 max_bytes=MAX_INSERT_BYTES):
     """Load events from S3 to BigQuery using the BQ streaming insert API.
 
+    Events are grouped into batches by row count and size, and several
+    batches are inserted at once; see `insert_batches`. Returns an
+    `InsertSummary`.
+
     :param network: The Parse.ly network for which to perform writes (eg
         "parsely-blog")
     :type network: str
@@ -100,35 +432,471 @@ def copy_from_s3(network,
     :type table_id: str
     :param dry_run: If True, don't perform BigQuery writes
     :type dry_run: bool
+    :param start: If given with `end`, load the range of data from `start` up
+        to `end` instead of a single prefix
+    :type start: datetime.datetime
+    :param end: The exclusive end of the range to load
+    :type end: datetime.datetime
+    :param checkpoint_path: If given, the path of a SQLite file in which to
+        record progress after each successful insert. Rerunning with the same
+        file resumes where the previous run stopped.
+    :type checkpoint_path: str
+    :param concurrency: The maximum number of insertAll requests in flight
+    :type concurrency: int
+    :param max_rows: The maximum number of rows per insertAll request
+    :type max_rows: int
+    :param max_bytes: The encoded size at which a request's batch is closed
+    :type max_bytes: int
     """
-    bq_conn = None
-    if not dry_run:
-        bq_conn = google_build(
-            'bigquery', 'v2',
-            credentials=GoogleCredentials.get_application_default())
+    def connect():
+        if dry_run:
+            return None
+        return bigquery_client()
+
+    checkpoint = None
+    if checkpoint_path is not None:
+        checkpoint = S3Checkpoint(checkpoint_path)
     s3_stream = events_s3(network, prefix=s3_prefix, access_key_id=access_key_id,
                           secret_access_key=secret_access_key,
-                          region_name=region_name)
+                          region_name=region_name, start=start, end=end,
+                          checkpoint=checkpoint)
 
-    schema_compliant_fields = [column['name'] for column in mk_bigquery_schema()]
+    rows = _schema_compliant_rows(s3_stream)
+    summary = insert_batches(
+        row_batches(rows, max_rows=max_rows, max_bytes=max_bytes,
+                    checkpoint=checkpoint),
+        connect, project_id=project_id, dataset_id=dataset_id,
+        table_id=table_id, concurrency=1 if dry_run else concurrency,
+        checkpoint=None if dry_run else checkpoint)
+    if summary.failed_batches:
+        log.error("%d of %d rows failed to insert", summary.failed_rows,
+                  summary.rows)
+    return summary
 
-    def schema_compliant(jsonline):
-        return {k: jsonline.get(k, None) for k in schema_compliant_fields}
 
-    def chunked(seq, chunk_size):
-        chunk = []
-        for item in seq:
-            chunk.append(schema_compliant(item))
-            if len(chunk) >= chunk_size:
-                yield chunk
-                chunk = []
-        if chunk:
-            yield chunk
+class _LoadProgress(object):
+    """Tracks which load files hold the events of each S3 object, and
+    commits each object's position as the files holding it are loaded
 
-    for events in chunked(s3_stream, 500):
-        streaming_insert_bigquery(events, bq_conn=bq_conn, project_id=project_id,
-                              dataset_id=dataset_id, table_id=table_id)
+    It stands in for the S3Checkpoint passed to `events_s3`, noting the
+    position of each event read. `write_load_files` sends all the events of
+    an object to the same writer, so they're in that writer's consecutive
+    files, and notes the position reached at the end of each object and
+    every `batch_size` events per writer. Since each writer's files roll
+    over only between batches, every file's last event has a noted
+    position.
+
+    :param checkpoint: The checkpoint to resume from and commit to
+    :type checkpoint: parsely_raw_data.checkpoint.S3Checkpoint
+    :param writers: The number of writers
+    :type writers: int
+    :param batch_size: The number of events handed to a writer at a time
+    :type batch_size: int
+    """
 
+    def __init__(self, checkpoint, writers, batch_size):
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self._current = None
+        self._finished = []
+        self._writer_of = {}
+        self._turn = 0
+        self._events = [0] * writers
+        self._noted = [[] for _ in range(writers)]
+        self._rolled = [[] for _ in range(writers)]
+        self._files = {}
+        self._objects = {}
+        self._loaded = set()
+        self._committed = {}
+
+    def position(self, bucket, key, etag):
+        return self.checkpoint.position(bucket, key, etag)
+
+    def record(self, bucket, key, etag, lines, complete=False):
+        self._current = ((bucket, key), (etag, lines, complete))
+        if complete:
+            self._finished.append(self._current)
+
+    def _note_finished(self):
+        empty = {}
+        for obj, position in self._finished:
+            writer = self._writer_of.pop(obj, None)
+            if writer is None:
+                empty[obj] = position
+            else:
+                self._noted[writer].append(
+                    (self._events[writer], obj, position))
+        del self._finished[:]
+        return empty
+
+    def writer(self):
+        """Return the writer for the event just read"""
+        self._note_finished()
+        obj, position = self._current
+        writer = self._writer_of.get(obj)
+        if writer is None:
+            writer = self._writer_of[obj] = self._turn % len(self._events)
+            self._turn += 1
+        self._events[writer] += 1
+        if self._events[writer] % self.batch_size == 0:
+            self._noted[writer].append((self._events[writer], obj, position))
+        return writer
+
+    def rolled(self, writer, path, events_written):
+        """Note that a writer's file holds its events up to `events_written`"""
+        self._rolled[writer].append((path, events_written))
+
+    def finish(self):
+        """Attribute positions to files once every file is written"""
+        empty = self._note_finished()
+        if empty:
+            # objects without events are done with
+            self.checkpoint.commit(empty)
+        for noted, rolled in zip(self._noted, self._rolled):
+            noted = iter(noted)
+            entry = next(noted, None)
+            for path, events_written in rolled:
+                positions = self._files[path] = {}
+                while entry is not None and entry[0] <= events_written:
+                    _, obj, position = entry
+                    positions[obj] = position
+                    entry = next(noted, None)
+                for obj in positions:
+                    self._objects.setdefault(obj, []).append(path)
+
+    def chains(self):
+        """Return lists of the files to load one after another
+
+        A writer's consecutive files holding parts of the same object are
+        loaded in order, so a later part isn't loaded after an earlier one
+        fails, where it would be loaded again when the object is reread.
+        """
+        chains = []
+        for rolled in self._rolled:
+            previous = None
+            for path, _ in rolled:
+                if previous is not None and \
+                        set(self._files[path]) & set(self._files[previous]):
+                    chains[-1].append(path)
+                else:
+                    chains.append([path])
+                previous = path
+        return chains
+
+    def loaded(self, path):
+        """Commit the positions a loaded file lets each object reach"""
+        self._loaded.add(path)
+        positions = {}
+        for obj in self._files.get(path, ()):
+            position = None
+            for other in self._objects[obj]:
+                if other not in self._loaded:
+                    break
+                position = self._files[other][obj]
+            if position is not None and position != self._committed.get(obj):
+                positions[obj] = self._committed[obj] = position
+        if positions:
+            self.checkpoint.commit(positions)
+
+
+def write_load_files(rows, directory, max_bytes=LOAD_FILE_BYTES,
+                     writers=LOAD_WRITERS, batch_size=1000, progress=None):
+    """Write rows to gzipped newline-delimited JSON files for load jobs
+
+    Batches of rows are handed out in turn to `writers` file sinks, each of
+    which encodes, compresses and writes its own files on a background
+    thread, rolling over to a new file at `max_bytes` compressed bytes.
+    Returns the paths of the files written.
+
+    :param rows: The rows to write
+    :type rows: iterable
+    :param directory: The directory in which to write the files
+    :type directory: str
+    :param max_bytes: The compressed size at which to start a new file
+    :type max_bytes: int
+    :param writers: The number of files to write at once
+    :type writers: int
+    :param batch_size: The number of rows handed to a writer at a time
+    :type batch_size: int
+    :param progress: Optional: the `_LoadProgress` passed to `events_s3` as
+        its checkpoint, in which case each S3 object's rows are handed to
+        one writer and `progress` learns which files hold them
+    :type progress: _LoadProgress
+    """
+    paths = []
+
+    def on_roll(writer):
+        def rolled(path):
+            paths.append(path)
+            if progress is not None:
+                progress.rolled(writer, path, sinks[writer].events_written)
+        return rolled
+
+    sinks = [PartitionedFileSink(directory,
+                                 prefix="load-{}".format(index),
+                                 max_bytes=max_bytes,
+                                 max_age=float("inf"),
+                                 batch_size=batch_size,
+                                 partition=lambda row: "",
+                                 on_roll=on_roll(index))
+             for index in range(writers)]
+    batch = []
+    turn = 0
+    try:
+        if progress is not None:
+            for row in rows:
+                sinks[progress.writer()].write(row)
+        else:
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    sinks[turn % writers].write_many(batch)
+                    batch = []
+                    turn += 1
+            sinks[turn % writers].write_many(batch)
+    finally:
+        for sink in sinks:
+            sink.close()
+    if progress is not None:
+        progress.finish()
+    return sorted(paths)
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load_job_body(project_id, dataset_id, table_id, job_id, digest):
+    return {
+        "jobReference": {"projectId": project_id, "jobId": job_id},
+        "configuration": {
+            "labels": {LOAD_DIGEST_LABEL: digest},
+            "load": {
+                "sourceFormat": "NEWLINE_DELIMITED_JSON",
+                "destinationTable": {
+                    "projectId": project_id,
+                    "datasetId": dataset_id,
+                    "tableId": table_id
+                },
+                "schema": {"fields": mk_bigquery_schema()},
+                "createDisposition": "CREATE_IF_NEEDED",
+                "writeDisposition": "WRITE_APPEND"
+            }
+        }
+    }
+
+
+def _wait_for_job(bq_conn, project_id, job_id, poll_interval):
+    """Return a load job once it's done"""
+    while True:
+        job = bq_conn.jobs().get(projectId=project_id,
+                                 jobId=job_id).execute(num_retries=5)
+        if job.get("status", {}).get("state") == "DONE":
+            return job
+        time.sleep(poll_interval)
+
+
+def load_file(bq_conn, path, project_id=None, dataset_id=None, table_id=None,
+              poll_interval=LOAD_POLL_INTERVAL):
+    """Upload a file as a BigQuery load job and wait for the job to finish
+
+    The file is sent with a resumable upload. Its job ID is made from the
+    file name, the SHA-1 digest of its contents and an attempt number, and
+    the job is labelled with the digest. If a job with that ID already
+    exists and was sent the same file, it isn't loaded again: a running or
+    successful job is waited on, and a failed job is retried under the next
+    attempt number. Returns the job's errorResult, or None if it succeeded.
+
+    :param bq_conn: The BigQuery connection to load with
+    :type bq_conn: googleapiclient.discovery.Resource
+    :param path: The path of a gzipped newline-delimited JSON file
+    :type path: str
+    :param project_id: The BigQuery project ID to write to
+    :type project_id: str
+    :param dataset_id: The BigQuery dataset ID to write to
+    :type dataset_id: str
+    :param table_id: The BigQuery table ID to write to
+    :type table_id: str
+    :param poll_interval: The number of seconds between checks on the job
+    :type poll_interval: float
+    """
+    digest = _file_digest(path)
+    prefix = "parsely_{}_{}".format(
+        os.path.basename(path).replace(".", "_"), digest)
+    for attempt in itertools.count():
+        job_id = "{}_{}".format(prefix, attempt)
+        media = MediaFileUpload(path, mimetype="application/octet-stream",
+                                chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+        request = bq_conn.jobs().insert(
+            projectId=project_id,
+            body=_load_job_body(project_id, dataset_id, table_id, job_id,
+                                digest),
+            media_body=media)
+        try:
+            response = None
+            while response is None:
+                _, response = request.next_chunk(num_retries=5)
+        except HttpError as e:
+            # 409 means a job with this ID exists
+            if e.resp.status != 409:
+                raise
+            job = _wait_for_job(bq_conn, project_id, job_id, poll_interval)
+            labels = job.get("configuration", {}).get("labels", {})
+            if labels.get(LOAD_DIGEST_LABEL) != digest:
+                return {"reason": "duplicate",
+                        "message": "job {} exists but wasn't sent {}".format(
+                            job_id, path)}
+            error = job["status"].get("errorResult")
+            if error is not None:
+                log.info("Retrying %s, which failed as job %s: %s", path,
+                         job_id, error)
+                continue
+            return None
+        job = _wait_for_job(bq_conn, project_id, job_id, poll_interval)
+        return job["status"].get("errorResult")
+
+
+def load_files(paths, connect, project_id=None, dataset_id=None,
+               table_id=None, concurrency=LOAD_CONCURRENCY,
+               poll_interval=LOAD_POLL_INTERVAL, remove=True, on_load=None):
+    """Load files with up to `concurrency` load jobs running at once
+
+    Returns the paths of the files whose jobs failed or, following a failed
+    file in a sequence, weren't attempted.
+
+    :param paths: The paths of gzipped newline-delimited JSON files. An item
+        may also be a list of paths, which are loaded one after another
+        until one fails.
+    :type paths: list
+    :param connect: A function returning a BigQuery connection, called
+        once per pool thread
+    :type connect: callable
+    :param project_id: The BigQuery project ID to write to
+    :type project_id: str
+    :param dataset_id: The BigQuery dataset ID to write to
+    :type dataset_id: str
+    :param table_id: The BigQuery table ID to write to
+    :type table_id: str
+    :param concurrency: The maximum number of jobs to run at once
+    :type concurrency: int
+    :param poll_interval: The number of seconds between checks on each job
+    :type poll_interval: float
+    :param remove: If True, delete each file once it's loaded
+    :type remove: bool
+    :param on_load: Optional: a function called with the path of each file
+        as soon as it's loaded
+    :type on_load: callable
+    """
+    local = threading.local()
+
+    def load(chain):
+        if isinstance(chain, six.string_types):
+            chain = [chain]
+        if not hasattr(local, "bq_conn"):
+            local.bq_conn = connect()
+        results = []
+        for index, path in enumerate(chain):
+            error = load_file(local.bq_conn, path, project_id=project_id,
+                              dataset_id=dataset_id, table_id=table_id,
+                              poll_interval=poll_interval)
+            results.append((path, error))
+            if error is not None:
+                results.extend(
+                    (skipped, {"reason": "notAttempted",
+                               "message": "{} failed".format(path)})
+                    for skipped in chain[index + 1:])
+                break
+            if remove:
+                os.remove(path)
+        return results
+
+    failed = []
+    for results in utils.imap_bounded(load, paths, max_workers=concurrency,
+                                      prefetch=concurrency, ordered=False):
+        for path, error in results:
+            if error is not None:
+                log.error("Loading %s failed: %s", path, error)
+                failed.append(path)
+            elif on_load is not None:
+                on_load(path)
+    return sorted(failed)
+
+
+def load_from_s3(network,
+                 s3_prefix="",
+                 access_key_id="",
+                 secret_access_key="",
+                 region_name="us-east-1",
+                 project_id=None,
+                 dataset_id=None,
+                 table_id=None,
+                 dry_run=False,
+                 start=None,
+                 end=None,
+                 checkpoint_path=None,
+                 directory=None,
+                 max_bytes=LOAD_FILE_BYTES,
+                 writers=LOAD_WRITERS,
+                 concurrency=LOAD_CONCURRENCY):
+    """Load events from S3 to BigQuery using load jobs
+
+    Events are written to local gzipped JSON files, which are then loaded
+    with a few load jobs rather than many streaming inserts. This is much
+    cheaper and faster for whole days of data, but nothing is visible in
+    BigQuery until the jobs finish. Returns a `LoadSummary` of the files
+    written and the files whose jobs failed, which are left on disk.
+
+    Accepts the same S3 and BigQuery arguments as `copy_from_s3`.
+
+    :param dry_run: If True, write the files but don't load them
+    :type dry_run: bool
+    :param checkpoint_path: If given, the path of a SQLite file in which to
+        record progress. Each S3 object's position is committed as the
+        files holding its events are loaded, so a rerun after a failed job
+        reads only the objects that job held.
+    :type checkpoint_path: str
+    :param directory: The directory in which to write the files, defaulting
+        to a new temporary directory
+    :type directory: str
+    :param max_bytes: The compressed size at which to start a new file
+    :type max_bytes: int
+    :param writers: The number of files to write at once
+    :type writers: int
+    :param concurrency: The maximum number of jobs to run at once
+    :type concurrency: int
+    """
+    progress = None
+    if checkpoint_path is not None:
+        progress = _LoadProgress(S3Checkpoint(checkpoint_path), writers,
+                                 batch_size=1000)
+    s3_stream = events_s3(network, prefix=s3_prefix, access_key_id=access_key_id,
+                          secret_access_key=secret_access_key,
+                          region_name=region_name, start=start, end=end,
+                          checkpoint=progress)
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="parsely_bigquery_")
+    paths = write_load_files(_schema_compliant_rows(s3_stream), directory,
+                             max_bytes=max_bytes, writers=writers,
+                             batch_size=1000,
+                             progress=None if dry_run else progress)
+    if dry_run:
+        log.info("Dry run: wrote %d files to %s", len(paths), directory)
+        return LoadSummary(paths, [])
+
+    if progress is None:
+        failed = load_files(paths, bigquery_client, project_id=project_id,
+                            dataset_id=dataset_id, table_id=table_id,
+                            concurrency=concurrency)
+    else:
+        failed = load_files(progress.chains(), bigquery_client,
+                            project_id=project_id, dataset_id=dataset_id,
+                            table_id=table_id, concurrency=concurrency,
+                            on_load=progress.loaded)
+    return LoadSummary(paths, failed)
 
 
 def create_table(project_id, table_id, dataset_id, debug=False):
@@ -154,15 +922,14 @@ def create_table(project_id, table_id, dataset_id, debug=False):
     if debug:
         print("Running the following BigQuery JSON table insert:")
         print(json.dumps(schema, indent=4, sort_keys=True))
-    credentials = GoogleCredentials.get_application_default()
-    bigquery = google_build('bigquery', 'v2', credentials=credentials)
+    bigquery = bigquery_client()
     bigquery.tables().insert(projectId=project_id,
                              datasetId=dataset_id,
                              body=schema).execute()
 
 
 def main():
-    commands = ["copy_from_s3", "create_table"]
+    commands = ["copy_from_s3", "load_from_s3", "create_table"]
     parser = utils.get_default_parser("Google BigQuery utilities for Parse.ly",
                                       commands=commands)
     parser.add_argument('--dry_run', action="store_true",
@@ -174,7 +941,21 @@ def main():
                         help='The ID of the BigQuery dataset to which to connect')
     parser.add_argument('--bigquery_table_id', type=str,
                         help='The ID of the BigQuery table to which to connect')
+    parser.add_argument('--checkpoint', type=str,
+                        help='Optional: a local SQLite file in which to record '
+                             'progress, so an interrupted copy can be resumed')
+    parser.add_argument('--concurrency', type=int, default=INSERT_CONCURRENCY,
+                        help='The maximum number of streaming insert requests '
+                             '(or, with load_from_s3, load jobs) to have in '
+                             'flight at once')
+    parser.add_argument('--load_dir', type=str,
+                        help='Optional: the local directory in which '
+                             'load_from_s3 writes files to be loaded')
     args = parser.parse_args()
+    try:
+        utils.check_range(args.start, args.end)
+    except ValueError as e:
+        parser.error(str(e))
 
     if args.command == "copy_from_s3":
         copy_from_s3(
@@ -186,7 +967,28 @@ def main():
             project_id=args.bigquery_project_id,
             dataset_id=args.bigquery_dataset_id,
             table_id=args.bigquery_table_id,
-            dry_run=args.dry_run
+            dry_run=args.dry_run,
+            start=args.start,
+            end=args.end,
+            checkpoint_path=args.checkpoint,
+            concurrency=args.concurrency
+        )
+    elif args.command == "load_from_s3":
+        load_from_s3(
+            args.network,
+            s3_prefix=args.s3_prefix,
+            access_key_id=args.aws_access_key_id,
+            secret_access_key=args.aws_secret_access_key,
+            region_name=args.aws_region_name,
+            project_id=args.bigquery_project_id,
+            dataset_id=args.bigquery_dataset_id,
+            table_id=args.bigquery_table_id,
+            dry_run=args.dry_run,
+            start=args.start,
+            end=args.end,
+            checkpoint_path=args.checkpoint,
+            directory=args.load_dir,
+            concurrency=args.concurrency
         )
     elif args.command == "create_table":
         create_table(
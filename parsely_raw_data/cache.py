@@ -0,0 +1,269 @@
+from __future__ import absolute_import, print_function
+
+import calendar
+import datetime
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from six.moves.urllib.parse import quote
+
+__license__ = """
+Copyright 2016 Parsely, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+PREFIX_DATE_RE = re.compile(r"(\d{4})/(\d{2})/(\d{2})(?:/(\d{2}))?/?$")
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def _atomic_write(path, data):
+    """Write `data` to `path` so that readers never observe a partial file"""
+    directory = os.path.dirname(path) or "."
+    _makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def prefix_period_end(prefix):
+    """Return the UTC epoch timestamp at which a date-formatted prefix closes
+
+    `prefix` ending in YYYY/MM/DD closes at the end of that day, and one
+    ending in YYYY/MM/DD/HH at the end of that hour. Returns None for
+    prefixes that don't name a time period.
+
+    :param prefix: The S3 key prefix to inspect
+    :type prefix: str
+    """
+    match = PREFIX_DATE_RE.search(prefix)
+    if match is None:
+        return None
+    year, month, day, hour = match.groups()
+    start = datetime.datetime(int(year), int(month), int(day), int(hour or 0))
+    if hour is None:
+        end = start + datetime.timedelta(days=1)
+    else:
+        end = start + datetime.timedelta(hours=1)
+    return calendar.timegm(end.utctimetuple())
+
+
+class ListingCache(object):
+    """An on-disk cache of S3 object listings, one file per bucket and prefix
+
+    Each cached listing records the key, size, ETag and LastModified of every
+    object. Parse.ly keys sort in the order they are written, so a stale
+    listing is refreshed by listing only the keys after the last one cached.
+    A listing whose prefix names a day or hour that closed more than
+    `grace_seconds` before the last refresh is considered complete and is
+    served without any LIST calls.
+
+    :param directory: The directory in which to store listings
+    :type directory: str
+    :param grace_seconds: How long after a period closes new objects may still
+        appear under its prefix
+    :type grace_seconds: int
+    """
+
+    def __init__(self, directory, grace_seconds=3600):
+        self.directory = directory
+        self.grace_seconds = grace_seconds
+
+    def _path(self, bucket, prefix):
+        return os.path.join(self.directory, "listings", bucket,
+                            quote(prefix, safe="") or "_root")
+
+    def load(self, bucket, prefix):
+        """Return the cached listing for a bucket and prefix, or None"""
+        try:
+            with open(self._path(bucket, prefix), "rb") as f:
+                return json.loads(f.read().decode("utf-8"))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, bucket, prefix, listing):
+        _atomic_write(self._path(bucket, prefix),
+                      json.dumps(listing).encode("utf-8"))
+
+    def is_closed(self, listing):
+        """Return True if `listing` can no longer gain new objects"""
+        period_end = prefix_period_end(listing["prefix"])
+        if period_end is None:
+            return False
+        return listing["refreshed_at"] >= period_end + self.grace_seconds
+
+    def objects(self, bucket, prefix, list_func):
+        """Return the full object listing for a bucket and prefix
+
+        :param bucket: The S3 bucket to list
+        :type bucket: str
+        :param prefix: The key prefix to list
+        :type prefix: str
+        :param list_func: A callable accepting `start_after` and returning an
+            iterable of object summaries with keys following it
+        :type list_func: callable
+        """
+        listing = self.load(bucket, prefix)
+        if listing is None:
+            listing = {"prefix": prefix, "refreshed_at": 0, "objects": []}
+        elif self.is_closed(listing):
+            return listing["objects"]
+        refreshed_at = time.time()
+        objects = listing["objects"]
+        start_after = objects[-1]["key"] if objects else None
+        objects.extend(list_func(start_after=start_after))
+        listing["refreshed_at"] = refreshed_at
+        self.save(bucket, prefix, listing)
+        return objects
+
+
+class ObjectCache(object):
+    """A size-capped local disk cache of S3 object bodies
+
+    Entries are keyed by bucket, key and ETag, so an object that is rewritten
+    in S3 is never served stale. When the cache grows past `max_bytes`, the
+    least recently used entries are evicted. Safe for use from several
+    threads in one process.
+
+    :param directory: The directory in which to store cached objects
+    :type directory: str
+    :param max_bytes: The maximum total size of cached objects
+    :type max_bytes: int
+    """
+
+    def __init__(self, directory, max_bytes=10 * 1024 ** 3):
+        self.directory = os.path.join(directory, "objects")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        _makedirs(self.directory)
+        existing = []
+        for name in os.listdir(self.directory):
+            if name.startswith(".tmp-"):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            existing.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(existing):
+            self._entries[name] = size
+            self._total_bytes += size
+        self._remove(self._evict())
+
+    def _evict(self):
+        """Drop least recently used entries until under the size cap
+
+        Always keeps the most recent entry. Must be called holding the lock;
+        returns the names of the evicted entries for removal from disk.
+        """
+        evicted = []
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            evicted.append(oldest)
+            self._total_bytes -= self._entries.pop(oldest)
+        return evicted
+
+    def _remove(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _name(self, bucket, key, etag):
+        digest = hashlib.sha1(
+            "{}/{}".format(bucket, key).encode("utf-8")).hexdigest()
+        return "{}-{}".format(digest, etag)
+
+    def get(self, bucket, key, etag):
+        """Return an open binary file holding the cached object, or None
+
+        :param bucket: The S3 bucket holding the object
+        :type bucket: str
+        :param key: The S3 key of the object
+        :type key: str
+        :param etag: The current ETag of the object
+        :type etag: str
+        """
+        name = self._name(bucket, key, etag)
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            if name not in self._entries:
+                return None
+            try:
+                f = open(path, "rb")
+            except (IOError, OSError):
+                self._total_bytes -= self._entries.pop(name)
+                return None
+            size = self._entries.pop(name)
+            self._entries[name] = size
+            try:
+                os.utime(path, None)
+            except OSError:
+                # evicted by another process; the open file is still readable
+                pass
+        return f
+
+    def put(self, bucket, key, etag, chunks):
+        """Store an object from an iterable of byte chunks
+
+        Returns an open binary file holding the stored object, which remains
+        readable even if the entry is evicted before it is consumed.
+
+        :param bucket: The S3 bucket holding the object
+        :type bucket: str
+        :param key: The S3 key of the object
+        :type key: str
+        :param etag: The ETag of the object being stored
+        :type etag: str
+        :param chunks: The object's body
+        :type chunks: iterable
+        """
+        name = self._name(bucket, key, etag)
+        path = os.path.join(self.directory, name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        f = open(path, "rb")
+        stale_prefix = name.split("-", 1)[0] + "-"
+        with self._lock:
+            if name in self._entries:
+                self._total_bytes -= self._entries.pop(name)
+            self._entries[name] = size
+            self._total_bytes += size
+            evicted = [other for other in self._entries
+                       if other.startswith(stale_prefix) and other != name]
+            for other in evicted:
+                self._total_bytes -= self._entries.pop(other)
+            evicted.extend(self._evict())
+        self._remove(evicted)
+        return f
@@ -0,0 +1,253 @@
+from __future__ import absolute_import, print_function
+
+import json
+import sqlite3
+import threading
+import time
+
+from .cache import _atomic_write
+
+__license__ = """
+Copyright 2016 Parsely, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+class S3Checkpoint(object):
+    """A SQLite record of how far each S3 object has been consumed
+
+    Readers call `record` as they hand out events; nothing is persisted
+    until `commit` is called, which the consumer should do only once it has
+    durably handled every event it has received so far. A restarted read
+    skips objects recorded as complete and resumes partially consumed ones
+    after their last committed line. Positions are discarded if an object's
+    ETag changes.
+
+    :param path: The path of the SQLite database file
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._conn = sqlite3.connect(path, timeout=30,
+                                     check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS s3_objects ("
+            " bucket TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " etag TEXT,"
+            " lines INTEGER NOT NULL,"
+            " complete INTEGER NOT NULL,"
+            " PRIMARY KEY (bucket, key))")
+        self._conn.commit()
+
+    def position(self, bucket, key, etag):
+        """Return the committed (lines, complete) position of an object"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, lines, complete FROM s3_objects"
+                " WHERE bucket = ? AND key = ?", (bucket, key)).fetchone()
+        if row is None or row[0] != etag:
+            return 0, False
+        return row[1], bool(row[2])
+
+    def record(self, bucket, key, etag, lines, complete=False):
+        """Note that the first `lines` lines of an object have been consumed"""
+        with self._lock:
+            self._pending[(bucket, key)] = (etag, lines, complete)
+
+    def mark(self):
+        """Return the positions recorded since the last commit
+
+        Consumers that hand events on before they're handled (eg to a pool
+        of writers) can take a mark when they hand on a batch and pass it to
+        `commit` once that batch and every batch before it are handled.
+        """
+        with self._lock:
+            return dict(self._pending)
+
+    def commit(self, positions=None):
+        """Persist every position recorded since the last commit
+
+        :param positions: If given, persist only these positions, as
+            returned by `mark`
+        :type positions: dict
+        """
+        with self._lock:
+            if positions is None:
+                pending, self._pending = self._pending, {}
+            else:
+                pending = positions
+                for key, position in positions.items():
+                    if self._pending.get(key) == position:
+                        del self._pending[key]
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO s3_objects"
+                " (bucket, key, etag, lines, complete) VALUES (?, ?, ?, ?, ?)",
+                [(bucket, key, etag, lines, int(complete))
+                 for (bucket, key), (etag, lines, complete) in pending.items()])
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+class ShardCheckpointStore(object):
+    """Base class for stores of the last consumed sequence number per shard
+
+    Consumers call `record` as they finish with each record. Positions are
+    buffered in memory and committed in batches, at most every
+    `commit_interval` seconds, or whenever `commit` is called. Subclasses
+    implement `_load` and `_save`.
+
+    Functions registered with `add_commit_hook` run before each commit, so
+    that a consumer's output (eg a `sink.PartitionedFileSink`) can be made
+    durable before the positions that produced it are saved.
+
+    :param commit_interval: The minimum number of seconds between commits
+    :type commit_interval: float
+    """
+
+    def __init__(self, commit_interval=10.0):
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._commit_hooks = []
+        self._pending = {}
+        self._last_commit = time.time()
+
+    def get(self, stream, shard_id):
+        """Return the last committed sequence number of a shard, or None"""
+        return self._load(stream, shard_id)
+
+    def record(self, stream, shard_id, sequence_number):
+        """Note that a shard has been consumed up to `sequence_number`"""
+        with self._lock:
+            self._pending[(stream, shard_id)] = sequence_number
+        self.maybe_commit()
+
+    def discard(self, stream, shard_ids):
+        """Forget the uncommitted positions of shards, eg once another
+        consumer has taken them over"""
+        with self._lock:
+            for shard_id in shard_ids:
+                self._pending.pop((stream, shard_id), None)
+
+    def add_commit_hook(self, hook):
+        """Call `hook()` before each commit; if it raises, nothing is saved"""
+        self._commit_hooks.append(hook)
+
+    def maybe_commit(self):
+        """Commit if `commit_interval` has passed since the last commit"""
+        if time.time() - self._last_commit >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        """Persist every position recorded since the last commit"""
+        with self._commit_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._last_commit = time.time()
+            if not pending:
+                return
+            try:
+                for hook in self._commit_hooks:
+                    hook()
+            except Exception:
+                # keep the positions for the next attempt, unless they've
+                # since been superseded
+                with self._lock:
+                    pending.update(self._pending)
+                    self._pending = pending
+                raise
+            with self._lock:
+                self._save(pending)
+
+    def _load(self, stream, shard_id):
+        raise NotImplementedError
+
+    def _save(self, positions):
+        """Persist a dict mapping (stream, shard_id) to sequence numbers"""
+        raise NotImplementedError
+
+
+class SQLiteShardCheckpoint(ShardCheckpointStore):
+    """A shard checkpoint store kept in a local SQLite database
+
+    :param path: The path of the SQLite database file
+    :type path: str
+    :param commit_interval: The minimum number of seconds between commits
+    :type commit_interval: float
+    """
+
+    def __init__(self, path, commit_interval=10.0):
+        super(SQLiteShardCheckpoint, self).__init__(commit_interval)
+        self.path = path
+        # the workers of a consumer group share the database
+        self._conn = sqlite3.connect(path, timeout=30,
+                                     check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kinesis_shards ("
+            " stream TEXT NOT NULL,"
+            " shard_id TEXT NOT NULL,"
+            " sequence_number TEXT NOT NULL,"
+            " PRIMARY KEY (stream, shard_id))")
+        self._conn.commit()
+
+    def _load(self, stream, shard_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sequence_number FROM kinesis_shards"
+                " WHERE stream = ? AND shard_id = ?",
+                (stream, shard_id)).fetchone()
+        return row[0] if row is not None else None
+
+    def _save(self, positions):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO kinesis_shards"
+            " (stream, shard_id, sequence_number) VALUES (?, ?, ?)",
+            [(stream, shard_id, sequence_number)
+             for (stream, shard_id), sequence_number in positions.items()])
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+class FileShardCheckpoint(ShardCheckpointStore):
+    """A shard checkpoint store kept in a local JSON file
+
+    The file is rewritten atomically on every commit.
+
+    :param path: The path of the JSON file
+    :type path: str
+    :param commit_interval: The minimum number of seconds between commits
+    :type commit_interval: float
+    """
+
+    def __init__(self, path, commit_interval=10.0):
+        super(FileShardCheckpoint, self).__init__(commit_interval)
+        self.path = path
+        try:
+            with open(path, "rb") as f:
+                self._positions = json.loads(f.read().decode("utf-8"))
+        except (IOError, OSError):
+            self._positions = {}
+
+    def _load(self, stream, shard_id):
+        return self._positions.get(stream, {}).get(shard_id)
+
+    def _save(self, positions):
+        for (stream, shard_id), sequence_number in positions.items():
+            self._positions.setdefault(stream, {})[shard_id] = sequence_number
+        _atomic_write(self.path, json.dumps(self._positions).encode("utf-8"))
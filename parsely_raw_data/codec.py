@@ -0,0 +1,126 @@
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import sys
+import timeit
+
+__license__ = """
+Copyright 2016 Parsely, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+The JSON codec used to decode and encode Parse.ly events.
+
+The fastest installed library among orjson, ujson and pysimdjson is used,
+falling back to the standard library's json module. Set the
+PARSELY_JSON_CODEC environment variable to one of "orjson", "ujson",
+"simdjson" or "json" to force a particular codec.
+
+`loads` accepts bytes directly, so raw lines from S3 objects and Kinesis
+records never need to be decoded to text first. Decoding errors from every
+codec are subclasses of ValueError.
+"""
+
+PREFERENCE = ("orjson", "ujson", "simdjson", "json")
+# json.loads only accepts bytes on Python 3.6 and later
+STDLIB_LOADS_BYTES = sys.version_info < (3,) or sys.version_info >= (3, 6)
+
+
+def _stdlib_loads(data):
+    if not STDLIB_LOADS_BYTES and isinstance(data, bytes):
+        data = data.decode("utf-8")
+    return json.loads(data)
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj)
+
+
+def _load_codec(name):
+    """Return a (loads, dumps) pair for the named codec, or None"""
+    if name == "json":
+        return _stdlib_loads, _stdlib_dumps
+    try:
+        module = __import__(name)
+    except ImportError:
+        return None
+    if name == "orjson":
+        def dumps(obj):
+            try:
+                return module.dumps(obj).decode("utf-8")
+            except TypeError:
+                # eg integers beyond 64 bits or non-string keys
+                return _stdlib_dumps(obj)
+        return module.loads, dumps
+    if name == "ujson":
+        def dumps(obj):
+            return module.dumps(obj, escape_forward_slashes=False)
+        return module.loads, dumps
+    if name == "simdjson":
+        return module.loads, _stdlib_dumps
+    return None
+
+
+def available_codecs():
+    """Return the names of the installed codecs, fastest first"""
+    return [name for name in PREFERENCE if _load_codec(name) is not None]
+
+
+def _select():
+    forced = os.environ.get("PARSELY_JSON_CODEC")
+    if forced:
+        codec = _load_codec(forced)
+        if codec is None:
+            raise ImportError(
+                "PARSELY_JSON_CODEC={} is not installed".format(forced))
+        return (forced,) + codec
+    for name in PREFERENCE:
+        codec = _load_codec(name)
+        if codec is not None:
+            return (name,) + codec
+
+
+NAME, loads, dumps = _select()
+
+
+def _benchmark(num_events=20000, repeat=3):
+    """Compare the decode and encode speed of the installed codecs on a batch
+    of realistic Parse.ly events."""
+    from .schema import mk_sample_event
+
+    events = []
+    for i in range(num_events):
+        event = mk_sample_event()
+        event["event_id"] = "0x{:032x}".format(i)
+        event["url"] = "http://mashable.com/2016/09/07/post-{}/".format(i % 500)
+        event["engaged_time_inc"] = i % 30
+        event["extra_data"] = {"subscriberType": "free", "n": i}
+        events.append(event)
+    lines = [json.dumps(event).encode("utf-8") for event in events]
+    total_mb = sum(len(line) for line in lines) / 1e6
+    print("{} events, {:.1f} MB of JSON".format(num_events, total_mb))
+    print("{:10} {:>14} {:>14}".format("codec", "decode MB/s", "encode MB/s"))
+    for name in available_codecs():
+        codec_loads, codec_dumps = _load_codec(name)
+        decode = min(timeit.repeat(
+            lambda: [codec_loads(line) for line in lines],
+            number=1, repeat=repeat))
+        encode = min(timeit.repeat(
+            lambda: [codec_dumps(event) for event in events],
+            number=1, repeat=repeat))
+        print("{:10} {:>14.1f} {:>14.1f}".format(
+            name, total_mb / decode, total_mb / encode))
+
+
+if __name__ == "__main__":
+    _benchmark()
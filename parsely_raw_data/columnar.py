@@ -0,0 +1,205 @@
+from __future__ import absolute_import, print_function
+
+from array import array
+from collections import namedtuple
+
+import six
+
+from .schema import SCHEMA, _to_bool, _to_float, _to_int
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__license__ = """
+Copyright 2016 Parsely, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Column-oriented batches of Parse.ly events.
+
+Each column is typed from schema.SCHEMA: integer fields (including the
+*_tmsp and *_ms timestamps) become int64, floats such as ip_lat and ip_lon
+become float64, booleans become bool, and strings, lists and JSON objects
+are kept as Python objects. String fields may instead be requested as
+categorical, in which case the column holds int32 codes into a per-batch
+list of categories.
+
+Values of other types are coerced as schema.compile_projector does (eg
+numeric strings to numbers and "true"/"false" to booleans). Missing values,
+and values that can't be coerced, are filled with 0, NaN, False or None,
+and every column has a matching boolean null mask. Columns are NumPy
+arrays when NumPy is installed and `array.array`s (or lists, for object
+columns) otherwise.
+"""
+
+
+class ColumnBatch(namedtuple("ColumnBatch",
+                             ["size", "columns", "nulls", "categories"])):
+    """A batch of events as typed columns
+
+    :param size: The number of events in the batch
+    :param columns: A dict mapping field names to arrays of values
+    :param nulls: A dict mapping field names to boolean null masks
+    :param categories: A dict mapping categorical field names to the list of
+        distinct values their codes refer to
+    """
+    __slots__ = ()
+
+
+TYPES2COLUMN = {
+    str: "object",
+    int: "int64",
+    float: "float64",
+    bool: "bool",
+    object: "object",
+    list: "object",
+}
+FILL_VALUES = {"int64": 0, "float64": float("nan"), "bool": False, "object": None}
+ARRAY_TYPECODES = {"int64": "q", "float64": "d", "bool": "b"}
+# the value types each column holds as is, and the coercions of others
+NATIVE_TYPES = {"int64": frozenset(six.integer_types),
+                "float64": frozenset((float,) + six.integer_types),
+                "bool": frozenset((bool,))}
+COERCIONS = {"int64": _to_int, "float64": _to_float, "bool": _to_bool}
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def column_types(fields=None):
+    """Return a dict mapping each field to its column type name
+
+    :param fields: The fields to type, defaulting to every field in the schema
+    :type fields: list
+    """
+    types = {record["key"]: TYPES2COLUMN[record["type"]] for record in SCHEMA}
+    if fields is None:
+        fields = [record["key"] for record in SCHEMA]
+    return [(field, types.get(field, "object")) for field in fields]
+
+
+def _array(values, type_):
+    if np is not None:
+        return np.array(values, dtype=type_)
+    return array(ARRAY_TYPECODES[type_], values)
+
+
+def _object_column(raw):
+    if np is None:
+        return raw
+    # assign element-wise so that list values aren't broadcast into a 2D array
+    column = np.empty(len(raw), dtype=object)
+    for i, value in enumerate(raw):
+        column[i] = value
+    return column
+
+
+def _mask(flags):
+    if np is not None:
+        return np.array(flags, dtype=bool)
+    return array("b", flags)
+
+
+def _typed_column(raw, type_):
+    """Return a typed column and its null mask
+
+    Values of other types are coerced with the schema's coercions, and
+    values that can't be coerced (or overflow an int64) are null.
+    """
+    fill = FILL_VALUES[type_]
+    native = NATIVE_TYPES[type_]
+    if set(map(type, raw)) <= native | {type(None)}:
+        values = [fill if value is None else value for value in raw]
+        try:
+            return (_array(values, type_),
+                    _mask([value is None for value in raw]))
+        except OverflowError:
+            pass
+    coerce = COERCIONS[type_]
+    values = []
+    nulls = []
+    for value in raw:
+        if value is not None and value.__class__ not in native:
+            value = coerce(value)
+        if type_ == "int64" and value is not None and \
+                not INT64_MIN <= value <= INT64_MAX:
+            value = None
+        nulls.append(value is None)
+        values.append(fill if value is None else value)
+    return _array(values, type_), _mask(nulls)
+
+
+def _categorical_column(raw):
+    codes = {}
+    categories = []
+    column = []
+    for value in raw:
+        if value is None:
+            column.append(-1)
+            continue
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(categories)
+            categories.append(value)
+        column.append(code)
+    if np is not None:
+        return np.array(column, dtype="int32"), categories
+    return array("i", column), categories
+
+
+def to_columns(events, fields=None, categorical=()):
+    """Convert a list of event dicts into a ColumnBatch
+
+    :param events: The events to convert
+    :type events: list
+    :param fields: The fields to include, defaulting to every schema field
+    :type fields: list
+    :param categorical: String fields to encode as categorical codes
+    :type categorical: iterable
+    """
+    categorical = frozenset(categorical)
+    columns = {}
+    nulls = {}
+    categories = {}
+    for field, type_ in column_types(fields):
+        raw = [event.get(field) for event in events]
+        if field in categorical:
+            columns[field], categories[field] = _categorical_column(raw)
+        elif type_ == "object":
+            columns[field] = _object_column(raw)
+        else:
+            columns[field], nulls[field] = _typed_column(raw, type_)
+            continue
+        nulls[field] = _mask([value is None for value in raw])
+    return ColumnBatch(len(events), columns, nulls, categories)
+
+
+def iter_batches(events, batch_size=10000, fields=None, categorical=()):
+    """Group a stream of events into ColumnBatches of at most `batch_size`
+
+    :param events: The events to convert
+    :type events: iterable
+    :param batch_size: The maximum number of events per batch
+    :type batch_size: int
+    :param fields: The fields to include, defaulting to every schema field
+    :type fields: list
+    :param categorical: String fields to encode as categorical codes
+    :type categorical: iterable
+    """
+    batch = []
+    for event in events:
+        batch.append(event)
+        if len(batch) >= batch_size:
+            yield to_columns(batch, fields=fields, categorical=categorical)
+            batch = []
+    if batch:
+        yield to_columns(batch, fields=fields, categorical=categorical)
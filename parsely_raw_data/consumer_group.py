@@ -0,0 +1,377 @@
+from __future__ import absolute_import, print_function
+
+import logging
+import math
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import boto3
+from six.moves.queue import Queue, Empty
+
+from . import query, utils
+from .checkpoint import SQLiteShardCheckpoint
+from .stream import QUEUE_GET_TIMEOUT, decode_records, list_shards, read_shard
+
+__license__ = """
+Copyright 2016 Parsely, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+A multi-process Kinesis consumer for Parse.ly streams.
+
+Worker processes divide a stream's shards between them through a lease
+table in a local SQLite file. Each worker periodically re-describes the
+stream, takes leases on unowned shards up to its fair share, and renews the
+leases it holds; a lease that isn't renewed expires and can be taken by
+another worker. After a reshard, a child shard is only read once its parent
+shards have been read to their end, so events from a partition key are
+handled in order.
+"""
+
+log = logging.getLogger(__name__)
+
+# how often run_consumer_group checks that its workers are alive
+WORKER_POLL_INTERVAL = 1.0
+
+
+class ShardLeases(object):
+    """A table of shard leases shared by the workers of a consumer group
+
+    :param path: The path of the SQLite database file holding the leases
+    :type path: str
+    :param owner: A unique identifier for the lease holder
+    :type owner: str
+    :param lease_seconds: How long a lease lasts without being renewed
+    :type lease_seconds: float
+    """
+
+    def __init__(self, path, owner, lease_seconds=30.0):
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kinesis_leases ("
+            " stream TEXT NOT NULL,"
+            " shard_id TEXT NOT NULL,"
+            " owner TEXT,"
+            " expires REAL NOT NULL DEFAULT 0,"
+            " finished INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (stream, shard_id))")
+
+    def finished(self, stream):
+        """Return the IDs of the shards in `stream` that were read to their end"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT shard_id FROM kinesis_leases"
+                " WHERE stream = ? AND finished = 1", (stream,)).fetchall()
+        return set(row[0] for row in rows)
+
+    def acquire(self, stream, shard_ids, limit):
+        """Take leases on free shards until this owner holds `limit` of them
+
+        Returns the IDs of the newly leased shards.
+
+        :param stream: The name of the stream
+        :type stream: str
+        :param shard_ids: The shards eligible to be leased, in order of
+            preference
+        :type shard_ids: list
+        :param limit: The maximum number of leases to hold
+        :type limit: int
+        """
+        now = time.time()
+        acquired = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT shard_id, owner, expires, finished"
+                    " FROM kinesis_leases WHERE stream = ?",
+                    (stream,)).fetchall()
+                leases = dict((row[0], row[1:]) for row in rows)
+                held = sum(1 for owner, expires, finished in leases.values()
+                           if owner == self.owner and expires > now and
+                           not finished)
+                for shard_id in shard_ids:
+                    if held >= limit:
+                        break
+                    owner, expires, finished = leases.get(shard_id,
+                                                          (None, 0, 0))
+                    if finished or (owner is not None and expires > now):
+                        continue
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO kinesis_leases"
+                        " (stream, shard_id, owner, expires, finished)"
+                        " VALUES (?, ?, ?, ?, 0)",
+                        (stream, shard_id, self.owner, now + self.lease_seconds))
+                    acquired.append(shard_id)
+                    held += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return acquired
+
+    def renew(self, stream, shard_ids):
+        """Extend this owner's leases, returning the IDs of those still held"""
+        expires = time.time() + self.lease_seconds
+        held = set()
+        with self._lock:
+            for shard_id in shard_ids:
+                cursor = self._conn.execute(
+                    "UPDATE kinesis_leases SET expires = ?"
+                    " WHERE stream = ? AND shard_id = ? AND owner = ?",
+                    (expires, stream, shard_id, self.owner))
+                if cursor.rowcount:
+                    held.add(shard_id)
+        return held
+
+    def finish(self, stream, shard_id):
+        """Mark a closed shard as read to its end and release its lease"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE kinesis_leases SET owner = NULL, expires = 0, finished = 1"
+                " WHERE stream = ? AND shard_id = ? AND owner = ?",
+                (stream, shard_id, self.owner))
+
+    def release(self, stream, shard_ids):
+        """Give up this owner's leases so other workers can take them at once"""
+        with self._lock:
+            for shard_id in shard_ids:
+                self._conn.execute(
+                    "UPDATE kinesis_leases SET owner = NULL, expires = 0"
+                    " WHERE stream = ? AND shard_id = ? AND owner = ?",
+                    (stream, shard_id, self.owner))
+
+    def close(self):
+        self._conn.close()
+
+
+def eligible_shards(shards, finished):
+    """Return the IDs of the shards that may be read now, in stream order
+
+    A shard is eligible if it hasn't been read to its end and each of its
+    parents either has been or has aged out of the stream.
+
+    :param shards: Shard descriptions, as returned by `stream.list_shards`
+    :type shards: list
+    :param finished: The IDs of the shards already read to their end
+    :type finished: set
+    """
+    present = set(shard.get("ShardId") for shard in shards)
+    eligible = []
+    for shard in shards:
+        shard_id = shard.get("ShardId")
+        if shard_id in finished:
+            continue
+        parents = [shard.get("ParentShardId"),
+                   shard.get("AdjacentParentShardId")]
+        if all(parent is None or parent in finished or parent not in present
+               for parent in parents):
+            eligible.append(shard_id)
+    return eligible
+
+
+def _group_worker(network, handler, processes, access_key_id,
+                  secret_access_key, region_name, lease_path, checkpoint_path,
+                  fields, where, lease_seconds, discovery_interval,
+                  queue_size, parent_pid):
+    client = boto3.client(
+        'kinesis',
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
+        region_name=region_name
+    )
+    stream = "parsely-dw-{}".format(utils.clean_network(network))
+    owner = "{}-{}-{}".format(socket.gethostname(), os.getpid(),
+                              uuid.uuid4().hex[:8])
+    leases = ShardLeases(lease_path, owner, lease_seconds=lease_seconds)
+    # commits are made by renew_and_commit only, so that a shard's position
+    # is never saved once another worker may have taken the shard over
+    checkpoint = SQLiteShardCheckpoint(checkpoint_path,
+                                       commit_interval=float("inf"))
+    decode = query.compile_query(fields=fields, where=where)
+    batches = Queue(maxsize=queue_size)
+    readers = {}
+
+    def read(shard_id, stop_event):
+        try:
+            for records in read_shard(client, stream, shard_id,
+                                      checkpoint=checkpoint,
+                                      stop_event=stop_event):
+                _, events = decode_records(records, decode)
+                batches.put((shard_id, records[-1].get("SequenceNumber"),
+                             events))
+        except Exception as e:
+            log.exception("Reading %s failed", shard_id)
+            batches.put((shard_id, None, e))
+            return
+        if not stop_event.is_set():
+            # the shard was closed by a reshard and has been read to its end
+            batches.put((shard_id, None, None))
+
+    def renew_and_commit():
+        held = leases.renew(stream, list(readers))
+        lost = set(readers) - held
+        for shard_id in lost:
+            log.warning("Lost lease on %s", shard_id)
+            readers.pop(shard_id).set()
+        # their new owners save their own, newer, positions
+        checkpoint.discard(stream, lost)
+        checkpoint.commit()
+
+    next_discovery = next_renewal = 0
+    try:
+        # stop if the parent process goes away without shutting us down
+        while os.getppid() == parent_pid:
+            now = time.time()
+            if now >= next_renewal:
+                renew_and_commit()
+                next_renewal = now + lease_seconds / 3.0
+            if now >= next_discovery:
+                eligible = eligible_shards(list_shards(client, stream),
+                                           leases.finished(stream))
+                limit = int(math.ceil(len(eligible) / float(processes)))
+                for shard_id in leases.acquire(stream, eligible, limit):
+                    stop_event = threading.Event()
+                    readers[shard_id] = stop_event
+                    reader = threading.Thread(target=read,
+                                              args=(shard_id, stop_event))
+                    reader.daemon = True
+                    reader.start()
+                next_discovery = now + discovery_interval
+            try:
+                shard_id, sequence_number, events = batches.get(
+                    timeout=QUEUE_GET_TIMEOUT)
+            except Empty:
+                continue
+            if shard_id not in readers:
+                # the lease was lost; its new owner will re-read this batch
+                continue
+            if sequence_number is None and events is not None:
+                # the reader failed; give up the shard so that it's read
+                # again, by this worker or another, from its checkpoint
+                renew_and_commit()
+                if readers.pop(shard_id, None) is not None:
+                    leases.release(stream, [shard_id])
+                continue
+            if sequence_number is None:
+                renew_and_commit()
+                if readers.pop(shard_id, None) is not None:
+                    leases.finish(stream, shard_id)
+                # look for the closed shard's children straight away
+                next_discovery = 0
+                continue
+            if events:
+                handler(events)
+            checkpoint.record(stream, shard_id, sequence_number)
+    finally:
+        for stop_event in readers.values():
+            stop_event.set()
+        renew_and_commit()
+        leases.release(stream, list(readers))
+
+
+def run_consumer_group(network,
+                       handler,
+                       processes=None,
+                       access_key_id="",
+                       secret_access_key="",
+                       region_name="us-east-1",
+                       lease_path="parsely_kinesis_leases.db",
+                       checkpoint_path="parsely_kinesis_checkpoints.db",
+                       fields=None,
+                       where=None,
+                       lease_seconds=30.0,
+                       discovery_interval=60.0,
+                       queue_size=100):
+    """Consume a Parse.ly Kinesis Stream with a group of worker processes
+
+    Runs until interrupted. Each worker calls `handler` with the list of
+    events from each GetRecords batch on the shards it has leased, and
+    checkpoints a batch once `handler` returns. Positions are committed as
+    leases are renewed, every `lease_seconds / 3`, and a shard's position is
+    dropped uncommitted if its lease was lost. A worker that dies is
+    restarted, and its shards are taken over once their leases expire;
+    raises RuntimeError if a worker dies within `lease_seconds` of
+    starting, since restarting it again is unlikely to help.
+
+    :param network: The Parse.ly network name for which to perform reads (eg
+        "blog.parsely.com")
+    :type network: str
+    :param handler: A picklable callable (eg a module-level function) that
+        accepts a list of events
+    :type handler: callable
+    :param processes: The number of worker processes, defaulting to the
+        number of CPUs
+    :type processes: int
+    :param access_key_id: The AWS access key to use when consuming the stream
+    :type access_key_id: str
+    :param secret_access_key: The AWS secret key to use when consuming the stream
+    :type secret_access_key: str
+    :param region_name: The AWS region of the stream
+    :type region_name: str
+    :param lease_path: The SQLite file holding the group's shard leases
+    :type lease_path: str
+    :param checkpoint_path: The SQLite file holding the group's shard positions
+    :type checkpoint_path: str
+    :param fields: If given, pass `handler` events holding only these keys
+    :type fields: list
+    :param where: If given, pass `handler` only events matching this filter
+    :type where: dict
+    :param lease_seconds: How long a worker's lease lasts without renewal
+    :type lease_seconds: float
+    :param discovery_interval: How often, in seconds, each worker re-describes
+        the stream to find new and unowned shards
+    :type discovery_interval: float
+    :param queue_size: The maximum number of batches each worker buffers
+    :type queue_size: int
+    """
+    processes = processes or multiprocessing.cpu_count()
+
+    def start_worker():
+        worker = multiprocessing.Process(
+            target=_group_worker,
+            args=(network, handler, processes, access_key_id,
+                  secret_access_key, region_name, lease_path, checkpoint_path,
+                  fields, where, lease_seconds, discovery_interval,
+                  queue_size, os.getpid()))
+        worker.daemon = True
+        worker.start()
+        return worker, time.time()
+
+    workers = [start_worker() for _ in range(processes)]
+    try:
+        while True:
+            time.sleep(WORKER_POLL_INTERVAL)
+            for index, (worker, started) in enumerate(workers):
+                if worker.exitcode is None:
+                    continue
+                if time.time() - started < lease_seconds:
+                    raise RuntimeError(
+                        "Consumer group worker {} exited with code {} "
+                        "soon after starting".format(worker.pid,
+                                                     worker.exitcode))
+                log.error("Consumer group worker %s exited with code %s; "
+                          "restarting it", worker.pid, worker.exitcode)
+                workers[index] = start_worker()
+    finally:
+        for worker, _ in workers:
+            if worker.is_alive():
+                worker.terminate()
@@ -0,0 +1,223 @@
+from __future__ import absolute_import, print_function
+
+import sys
+import threading
+import time
+
+from six import iteritems
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from .records import RecordStats
+
+__license__ = """
+Copyright 2016 Parsely, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Lag and throughput metrics for Kinesis stream consumers.
+
+Pass a `StreamMetrics` to `stream.events_kinesis` (or
+`events_kinesis_batches`) and read it from any thread with `snapshot`, or
+export it in the Prometheus text format with `prometheus_text` or
+`serve_metrics`. Each shard's counters are only written by that shard's
+reader thread and are plain attributes, so updating them costs no more than
+an attribute increment per GetRecords call.
+"""
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class ShardMetrics(object):
+    """Counters for the reads from one shard
+
+    `millis_behind_latest`: how far the last read was behind the tip of the
+    shard, or None before the first read
+    `get_records_calls`: successful GetRecords calls
+    `records`: records returned
+    `events`: events decoded from them and queued for the consumer
+    `throttles`: calls rejected by the shard's read limits
+    `errors`: calls failing for any other reason
+    `last_read`: the time of the last successful call
+    """
+
+    def __init__(self):
+        self.millis_behind_latest = None
+        self.get_records_calls = 0
+        self.records = 0
+        self.events = 0
+        self.throttles = 0
+        self.errors = 0
+        self.last_read = None
+
+
+class StreamMetrics(object):
+    """Metrics for a consumer of one Kinesis stream
+
+    :param event_queue: Optional: the consumer's queue of batches, whose
+        depth is reported (`events_kinesis` sets this)
+    :type event_queue: six.moves.queue.Queue
+    """
+
+    def __init__(self, event_queue=None):
+        self.stream = None
+        self.event_queue = event_queue
+        self.record_stats = RecordStats()
+        self.shards = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def shard(self, shard_id):
+        """Return the counters of a shard, creating them on first use"""
+        with self._lock:
+            metrics = self.shards.get(shard_id)
+            if metrics is None:
+                metrics = self.shards[shard_id] = ShardMetrics()
+            return metrics
+
+    def snapshot(self):
+        """Return a dict of the current metrics
+
+        Holds `time`, `stream`, `queue_depth` and `queue_size` (None
+        without a queue), `decoding` (the record counts of
+        `records.RecordStats`) and `shards`, a dict of each shard's counters.
+        """
+        with self._lock:
+            shards = dict((shard_id, dict(vars(metrics)))
+                          for shard_id, metrics in iteritems(self.shards))
+        queue_depth = queue_size = None
+        if self.event_queue is not None:
+            queue_depth = self.event_queue.qsize()
+            queue_size = self.event_queue.maxsize
+        return {"time": time.time(),
+                "stream": self.stream,
+                "queue_depth": queue_depth,
+                "queue_size": queue_size,
+                "decoding": self.record_stats.snapshot(),
+                "shards": shards}
+
+
+def _labels(**labels):
+    return "{" + ",".join('{}="{}"'.format(
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in sorted(labels.items())) + "}"
+
+
+SHARD_METRICS = (
+    ("millis_behind_latest", "gauge",
+     "How far the last read was behind the tip of the shard"),
+    ("get_records_calls", "counter", "Successful GetRecords calls"),
+    ("records", "counter", "Records read"),
+    ("events", "counter", "Events decoded and queued for the consumer"),
+    ("throttles", "counter", "GetRecords calls throttled"),
+    ("errors", "counter", "GetRecords calls failing for other reasons"),
+)
+
+
+def prometheus_text(snapshot, prefix="parsely_kinesis"):
+    """Format a `StreamMetrics.snapshot` in the Prometheus text format"""
+    stream = snapshot["stream"] or ""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        name = "{}_{}".format(prefix, name)
+        if kind == "counter":
+            name += "_total"
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in samples:
+            if value is not None:
+                lines.append("{}{} {}".format(name, labels, value))
+
+    for field, kind, help_text in SHARD_METRICS:
+        metric(field, kind, help_text,
+               [(_labels(stream=stream, shard=shard_id), counters[field])
+                for shard_id, counters in sorted(snapshot["shards"].items())])
+    metric("decoding", "counter",
+           "Kinesis records and events by how they were decoded",
+           [(_labels(stream=stream, result=result), count)
+            for result, count in sorted(snapshot["decoding"].items())])
+    metric("queue_depth", "gauge", "Record batches waiting for the consumer",
+           [(_labels(stream=stream), snapshot["queue_depth"])])
+    metric("queue_size", "gauge", "The capacity of the batch queue",
+           [(_labels(stream=stream), snapshot["queue_size"])])
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, port=9108, host="127.0.0.1"):
+    """Serve metrics in the Prometheus text format from a background thread
+
+    Returns the HTTP server; call its `shutdown` method to stop it.
+
+    :param metrics: The metrics to serve
+    :type metrics: StreamMetrics
+    :param port: The port on which to listen
+    :type port: int
+    :param host: The address on which to listen
+    :type host: str
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = prometheus_text(metrics.snapshot()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def format_stats(previous, current):
+    """Summarize two snapshots as lines of text, with rates between them"""
+    elapsed = max(current["time"] - previous["time"], 1e-9)
+    lines = []
+    total_rate = 0.0
+    for shard_id, counters in sorted(current["shards"].items()):
+        before = previous["shards"].get(shard_id, {})
+        rate = (counters["events"] - before.get("events", 0)) / elapsed
+        total_rate += rate
+        lines.append(
+            "{}: {:.1f} events/s, {} ms behind, {} throttles, {} errors".format(
+                shard_id, rate, counters["millis_behind_latest"],
+                counters["throttles"], counters["errors"]))
+    decoding = current["decoding"]
+    lines.append("total: {:.1f} events/s, {} undecodable, {} invalid records"
+                 .format(total_rate, decoding["undecodable"],
+                         decoding["invalid"]))
+    if current["queue_depth"] is not None:
+        lines.append("queue depth: {}/{}".format(current["queue_depth"],
+                                                 current["queue_size"]))
+    return lines
+
+
+def report_stats(metrics, interval, out=None):
+    """Print a summary of `metrics` every `interval` seconds from a thread"""
+    def report():
+        previous = metrics.snapshot()
+        while True:
+            time.sleep(interval)
+            current = metrics.snapshot()
+            for line in format_stats(previous, current):
+                print(line, file=out or sys.stderr)
+            previous = current
+
+    thread = threading.Thread(target=report)
+    thread.daemon = True
+    thread.start()
+    return thread
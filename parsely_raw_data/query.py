@@ -0,0 +1,141 @@
+from __future__ import absolute_import, print_function
+
+import json
+import re
+
+import six
+
+from . import codec
+
+__license__ = """
+Copyright 2016 Parsely, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Projection and predicate pushdown for raw event readers.
+
+A `where` filter is a dict mapping field names to a required value, or to a
+list, tuple or set of acceptable values, eg
+
+    {"action": "pageview", "metadata_section": ["sports", "politics"]}
+
+Before a line is JSON-decoded, it is checked for the serialized form of at
+least one acceptable value per field, so most non-matching lines are dropped
+without being parsed.
+"""
+
+# values whose JSON serialization is the same under every encoder, and so
+# can be searched for in raw bytes without false negatives
+SAFE_STRING_RE = re.compile(r'^[ !#-.0-\[\]-~]*$')
+
+
+def _needles(value):
+    """Return the raw JSON bytes of the values equal to `value`, or None if
+    they're not stable"""
+    if value is None:
+        # a missing field matches None too, and has nothing to search for
+        return None
+    if isinstance(value, six.integer_types) and value in (0, 1):
+        # booleans equal 0 and 1
+        return (b"0", b"false") if value == 0 else (b"1", b"true")
+    if isinstance(value, six.integer_types):
+        return (str(value).encode("ascii"),)
+    if isinstance(value, six.string_types) and SAFE_STRING_RE.match(value):
+        return (json.dumps(value).encode("ascii"),)
+    return None
+
+
+def _acceptable(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return frozenset(value)
+    return frozenset([value])
+
+
+def compile_where(where):
+    """Build a byte-level prefilter and an exact predicate from a filter
+
+    Returns a pair of callables: the first accepts a raw JSON line and returns
+    False only if the line cannot match, the second accepts a decoded event
+    and returns True if it matches.
+
+    :param where: The filter, mapping field names to acceptable values
+    :type where: dict
+    """
+    conditions = [(field, _acceptable(values))
+                  for field, values in six.iteritems(where or {})]
+    needle_sets = []
+    for _, values in conditions:
+        needles = [_needles(value) for value in values]
+        if needles and None not in needles:
+            needle_sets.append(tuple(needle for value_needles in needles
+                                     for needle in value_needles))
+
+    def prefilter(line):
+        for needles in needle_sets:
+            for needle in needles:
+                if needle in line:
+                    break
+            else:
+                return False
+        return True
+
+    def predicate(event):
+        for field, values in conditions:
+            try:
+                if event.get(field) not in values:
+                    return False
+            except TypeError:
+                # lists and dicts, eg metadata_tags, never equal a filter value
+                return False
+        return True
+
+    return prefilter, predicate
+
+
+def compile_query(fields=None, where=None, loads=codec.loads):
+    """Build a function decoding a raw JSON line into a filtered, projected event
+
+    The returned callable accepts a line as bytes and returns the decoded
+    event, or None if the event doesn't match `where`. If `fields` is given,
+    the event is reduced to just those keys, with None for missing ones.
+
+    :param fields: The event keys to keep, or None to keep them all
+    :type fields: list
+    :param where: The filter, mapping field names to acceptable values
+    :type where: dict
+    :param loads: The function to decode a line with, defaulting to the fastest
+        installed JSON codec
+    :type loads: callable
+    """
+    fields = list(fields) if fields is not None else None
+    if not where:
+        if fields is None:
+            return loads
+        return lambda line: _project(loads(line), fields)
+    prefilter, predicate = compile_where(where)
+
+    def decode(line):
+        if not prefilter(line):
+            return None
+        event = loads(line)
+        if not predicate(event):
+            return None
+        if fields is not None:
+            return _project(event, fields)
+        return event
+
+    return decode
+
+
+def _project(event, fields):
+    get = event.get
+    return {field: get(field) for field in fields}
@@ -0,0 +1,246 @@
+from __future__ import absolute_import, print_function
+
+import gzip
+import hashlib
+import io
+import logging
+import threading
+import zlib
+
+from six import iteritems
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__license__ = """
+Copyright 2016 Parsely, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Unpacking of Kinesis records that carry more than one event.
+
+A record's data may be a single JSON event, a gzip or zstd compressed
+batch of newline-delimited events, or a Kinesis Producer Library (KPL)
+aggregated record whose sub-records are themselves any of these. KPL
+records are the magic bytes F3 89 9A C2, an AggregatedRecord protocol
+buffer and the MD5 digest of that protocol buffer. Decompressing zstd
+batches requires the `zstandard` package.
+"""
+
+log = logging.getLogger(__name__)
+
+KPL_MAGIC = b"\xf3\x89\x9a\xc2"
+KPL_DIGEST_SIZE = 16
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# protocol buffer field numbers of AggregatedRecord.records and Record.data
+AGGREGATED_RECORDS_FIELD = 3
+RECORD_DATA_FIELD = 3
+
+
+class RecordStats(object):
+    """Thread-safe counters describing the records a consumer has unpacked
+
+    `records`: Kinesis records read
+    `aggregated`: KPL aggregated records unpacked
+    `compressed`: compressed payloads unpacked
+    `events`: events decoded and kept
+    `filtered`: events decoded but rejected by a `where` filter
+    `undecodable`: payloads that weren't valid JSON events
+    `invalid`: records that looked aggregated or compressed but couldn't be
+    unpacked (a bad digest, truncated data, or zstd without `zstandard`)
+    """
+
+    FIELDS = ("records", "aggregated", "compressed", "events", "filtered",
+              "undecodable", "invalid")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict((field, 0) for field in self.FIELDS)
+
+    def __getattr__(self, name):
+        if name in RecordStats.FIELDS:
+            return self._counts[name]
+        raise AttributeError(name)
+
+    def add(self, counts):
+        """Add a dict of counts, as kept by `unpack_records`"""
+        with self._lock:
+            for field, count in iteritems(counts):
+                self._counts[field] += count
+
+    def snapshot(self):
+        """Return a dict of the current counts"""
+        with self._lock:
+            return dict(self._counts)
+
+
+# the counters updated by decode_records unless it's given its own
+stats = RecordStats()
+
+
+def _varint(data, position):
+    result = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def _length_delimited(data, start, end, field_number):
+    """Return the (start, end) offsets of each value of a length-delimited
+    field in the message held in `data[start:end]`"""
+    values = []
+    position = start
+    while position < end:
+        key, position = _varint(data, position)
+        wire_type = key & 0x7
+        if wire_type == 0:
+            _, position = _varint(data, position)
+        elif wire_type == 1:
+            position += 8
+        elif wire_type == 2:
+            length, position = _varint(data, position)
+            if key >> 3 == field_number:
+                values.append((position, position + length))
+            position += length
+        elif wire_type == 5:
+            position += 4
+        else:
+            raise ValueError("unsupported wire type {}".format(wire_type))
+    if position != end:
+        raise ValueError("truncated protocol buffer")
+    return values
+
+
+def deaggregate(data):
+    """Return the data of each sub-record of a KPL aggregated record
+
+    Raises ValueError if the record is malformed or fails its MD5 check.
+
+    :param data: The data of a Kinesis record beginning with `KPL_MAGIC`
+    :type data: bytes
+    """
+    if len(data) < len(KPL_MAGIC) + KPL_DIGEST_SIZE:
+        raise ValueError("aggregated record is too short")
+    message = bytearray(data[len(KPL_MAGIC):-KPL_DIGEST_SIZE])
+    if hashlib.md5(message).digest() != data[-KPL_DIGEST_SIZE:]:
+        raise ValueError("aggregated record failed its MD5 check")
+    try:
+        payloads = []
+        for start, end in _length_delimited(message, 0, len(message),
+                                            AGGREGATED_RECORDS_FIELD):
+            for data_start, data_end in _length_delimited(message, start, end,
+                                                          RECORD_DATA_FIELD):
+                payloads.append(bytes(message[data_start:data_end]))
+        return payloads
+    except IndexError:
+        raise ValueError("truncated protocol buffer")
+
+
+def _gunzip(payload):
+    """Decompress every gzip member in `payload`"""
+    try:
+        return gzip.GzipFile(fileobj=io.BytesIO(payload)).read()
+    except (EOFError, IOError, OSError, zlib.error) as e:
+        raise ValueError("bad gzip payload: {}".format(e))
+
+
+def _decompress(payload):
+    """Return the lines of a compressed payload, or None if it isn't one"""
+    if payload.startswith(GZIP_MAGIC):
+        return [line for line in _gunzip(payload).split(b"\n") if line]
+    if payload.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("zstd payloads require the zstandard package")
+        try:
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(
+                payload)
+        except zstandard.ZstdError as e:
+            raise ValueError("bad zstd payload: {}".format(e))
+        return [line for line in data.split(b"\n") if line]
+    return None
+
+
+def _payloads(data, counts):
+    """Yield the individual event payloads packed in a record's data"""
+    if data.startswith(KPL_MAGIC):
+        parts = deaggregate(data)
+        counts["aggregated"] += 1
+    else:
+        parts = [data]
+    for part in parts:
+        lines = _decompress(part)
+        if lines is None:
+            yield part
+            continue
+        counts["compressed"] += 1
+        for line in lines:
+            yield line
+
+
+def unpack_records(records, decode, counts):
+    """Decode the events packed in a batch of Kinesis records
+
+    Returns a list of sequence numbers and a list of the events. When a
+    record holds several events, only the last is paired with the record's
+    sequence number; the others are paired with the sequence number of the
+    previous record in the batch (or None), so a checkpoint taken in the
+    middle of a record resumes at its start.
+
+    :param records: The records returned by GetRecords
+    :type records: list
+    :param decode: A function decoding an event payload, as returned by
+        `parsely_raw_data.query.compile_query`
+    :type decode: callable
+    :param counts: A dict of `RecordStats.FIELDS` counts to update
+    :type counts: dict
+    """
+    sequence_numbers = []
+    events = []
+    previous = None
+    for record in records:
+        data = record.get("Data")
+        if data is None:
+            continue
+        counts["records"] += 1
+        sequence_number = record.get("SequenceNumber")
+        kept = len(events)
+        try:
+            for payload in _payloads(data, counts):
+                try:
+                    event = decode(payload)
+                except ValueError:
+                    counts["undecodable"] += 1
+                    continue
+                if event is None:
+                    counts["filtered"] += 1
+                    continue
+                events.append(event)
+        except ValueError as e:
+            del events[kept:]
+            counts["invalid"] += 1
+            log.debug("Skipping record %s: %s", sequence_number, e)
+            previous = sequence_number
+            continue
+        counts["events"] += len(events) - kept
+        sequence_numbers.extend([previous] * (len(events) - kept))
+        if len(events) > kept:
+            sequence_numbers[-1] = sequence_number
+        previous = sequence_number
+    return sequence_numbers, events
@@ -64,7 +64,9 @@ def copy_from_s3(network,
                  port="5439",
                  access_key_id="",
                  secret_access_key="",
-                 debug=False):
+                 debug=False,
+                 start=None,
+                 end=None):
     """Use the Redshift COPY command to copy event data from S3
 
     :param network: The Parse.ly network for which to copy data (eg
@@ -89,20 +91,32 @@ def copy_from_s3(network,
     :type access_key_id: str
     :param secret_access_key: The AWS secret key to use when copying
     :type secret_access_key: str
+    :param start: If given with `end`, copy the range of data from `start` up
+        to `end` instead of `s3_prefix`, as one COPY per day or hour prefix in
+        a single transaction
+    :type start: datetime.datetime
+    :param end: The exclusive end of the range to copy
+    :type end: datetime.datetime
+    :raises ValueError: If only one of `start` and `end` is given, or
+        `start` isn't before `end`
     """
-    query = (
-    "COPY {table_name}\n"
-    "FROM 's3://parsely-dw-{network}/{s3_prefix}'\n"
-    "CREDENTIALS 'aws_access_key_id={aws_access_key_id};"
-    "aws_secret_access_key={aws_secret_access_key}'\n"
-    "JSON AS 'auto' GZIP\n"
-    "TRUNCATECOLUMNS;\n"
-	).format(
-	table_name=table_name,
-        network=utils.clean_network(network),
-        s3_prefix=s3_prefix,
-        aws_access_key_id=access_key_id,
-        aws_secret_access_key=secret_access_key)
+    if utils.check_range(start, end):
+        prefixes = utils.plan_prefixes(start, end)
+    else:
+        prefixes = [s3_prefix]
+    query = "".join(
+        "COPY {table_name}\n"
+        "FROM 's3://parsely-dw-{network}/{s3_prefix}'\n"
+        "CREDENTIALS 'aws_access_key_id={aws_access_key_id};"
+        "aws_secret_access_key={aws_secret_access_key}'\n"
+        "JSON AS 'auto' GZIP\n"
+        "TRUNCATECOLUMNS;\n".format(
+            table_name=table_name,
+            network=utils.clean_network(network),
+            s3_prefix=prefix,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key)
+        for prefix in prefixes)
     if debug:
         print("Running the following Redshift COPY command:")
         print(query)
@@ -159,6 +173,10 @@ def main():
                         help='Optional: create a VARCHAR column for extra_data, which'
                              ' will be saved as a JSON-formatted string.')
     args = parser.parse_args()
+    try:
+        utils.check_range(args.start, args.end)
+    except ValueError as e:
+        parser.error(str(e))
 
     if args.command == "copy_from_s3":
         copy_from_s3(
@@ -171,7 +189,9 @@ def main():
             database=args.redshift_database,
             access_key_id=args.aws_access_key_id,
             secret_access_key=args.aws_secret_access_key,
-            debug=args.debug
+            debug=args.debug,
+            start=args.start,
+            end=args.end
         )
     elif args.command == "create_table":
         create_table(
@@ -1,13 +1,15 @@
 from __future__ import absolute_import, print_function
 
-import gzip
-import json
-from collections import defaultdict
-from io import BytesIO
+import functools
+import itertools
+import multiprocessing
+import zlib
+from collections import Counter, defaultdict
 
 import boto3
 
-from . import utils
+from . import columnar, query, utils
+from .cache import ListingCache, ObjectCache
 
 
 __license__ = """
@@ -23,12 +25,195 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+CHUNK_SIZE = 256 * 1024
+LIST_WORKERS = 8
+
+
+def _s3_client(access_key_id, secret_access_key, region_name):
+    return boto3.client('s3', **{
+        'aws_access_key_id': access_key_id,
+        'aws_secret_access_key': secret_access_key,
+        'region_name': region_name
+    })
+
+
+def _object_summary(item):
+    last_modified = item.get("LastModified")
+    if last_modified is not None:
+        last_modified = last_modified.isoformat()
+    return {
+        "key": item.get("Key"),
+        "size": item.get("Size"),
+        "etag": item.get("ETag", "").strip('"'),
+        "last_modified": last_modified,
+    }
+
+
+def list_objects(client, bucket, prefix, start_after=None):
+    """Yield a summary of every object under a prefix in key order
+
+    Follows ``list_objects_v2`` continuation tokens, so prefixes holding more
+    than 1000 keys are listed completely.
+
+    :param client: The boto3 S3 client to list with
+    :type client: botocore.client.S3
+    :param bucket: The S3 bucket to list
+    :type bucket: str
+    :param prefix: The key prefix to list
+    :type prefix: str
+    :param start_after: If given, list only keys sorting after this one
+    :type start_after: str
+    """
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    while True:
+        res = client.list_objects_v2(**kwargs)
+        for item in res.get("Contents", []):
+            yield _object_summary(item)
+        if not res.get("IsTruncated", False):
+            break
+        kwargs["ContinuationToken"] = res["NextContinuationToken"]
+
+
+def _list_objects(client, bucket, prefix, listing_cache=None):
+    if listing_cache is None:
+        return list_objects(client, bucket, prefix)
+    return listing_cache.objects(
+        bucket, prefix,
+        lambda start_after: list_objects(client, bucket, prefix,
+                                         start_after=start_after))
+
+
+def _iter_body_chunks(body, chunk_size=CHUNK_SIZE):
+    """Read a file-like object (eg a botocore StreamingBody) in chunks"""
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _iter_byte_chunks(data, chunk_size=CHUNK_SIZE):
+    """Slice an in-memory object body into chunks"""
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
+def _iter_file_chunks(f, chunk_size=CHUNK_SIZE):
+    """Read an open local file in chunks, closing it when done"""
+    with f:
+        for chunk in _iter_body_chunks(f, chunk_size=chunk_size):
+            yield chunk
+
+
+def _fetch_object(client, bucket, obj, object_cache=None, buffer=False):
+    """Return an iterable of the compressed byte chunks of an S3 object
+
+    :param obj: The object summary, as produced by `list_objects`
+    :type obj: dict
+    :param object_cache: If given, serve the object from this cache when its
+        ETag matches, and store it there otherwise
+    :type object_cache: parsely_raw_data.cache.ObjectCache
+    :param buffer: If True, download the whole body before returning
+    :type buffer: bool
+    """
+    key = obj["key"]
+    if object_cache is not None:
+        cached = object_cache.get(bucket, key, obj["etag"])
+        if cached is None:
+            res = client.get_object(Bucket=bucket, Key=key)
+            cached = object_cache.put(bucket, key,
+                                      res.get("ETag", "").strip('"'),
+                                      _iter_body_chunks(res.get("Body")))
+        return _iter_file_chunks(cached)
+    body = client.get_object(Bucket=bucket, Key=key).get("Body")
+    if buffer:
+        return _iter_byte_chunks(body.read())
+    return _iter_body_chunks(body)
+
+
+def _iter_gzip_lines(chunks):
+    """Incrementally decompress gzipped chunks and yield non-empty lines
+
+    Only one chunk of compressed and decompressed data is held at a time, plus
+    whatever partial line straddles a chunk boundary. Concatenated gzip
+    members are decoded in sequence.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    tail = b""
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            chunk = decompressor.unused_data
+            if chunk:
+                data += decompressor.flush()
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            lines = (tail + data).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                if line:
+                    yield line
+    tail += decompressor.flush()
+    if tail:
+        yield tail
+
+
+def _plan_listing(client, bucket, prefix, start=None, end=None,
+                  listing_cache=None):
+    """List a single prefix, or every prefix planned from a datetime range"""
+    if utils.check_range(start, end):
+        prefixes = utils.plan_prefixes(start, end)
+    else:
+        prefixes = [prefix]
+    if len(prefixes) == 1:
+        return _list_objects(client, bucket, prefixes[0],
+                             listing_cache=listing_cache)
+    return itertools.chain.from_iterable(utils.imap_bounded(
+        lambda p: list(_list_objects(client, bucket, p,
+                                     listing_cache=listing_cache)),
+        prefixes,
+        max_workers=LIST_WORKERS))
+
+
+def _checkpointed(listing, bucket, checkpoint):
+    """Pair each object with the number of its lines already consumed"""
+    for obj in listing:
+        if checkpoint is None:
+            yield obj, 0
+            continue
+        lines, complete = checkpoint.position(bucket, obj["key"], obj["etag"])
+        if not complete:
+            yield obj, lines
+
+
+def _decode_events(chunks, decode, skip=0):
+    """Yield (line number, event) for each line of an object matching `decode`
+
+    Line numbers count every line, including those `decode` rejects.
+    """
+    lines = itertools.islice(_iter_gzip_lines(chunks), skip, None)
+    for line_number, line in enumerate(lines, skip + 1):
+        event = decode(line)
+        if event is not None:
+            yield line_number, event
+
 
 def events_s3(network,
               prefix="",
               access_key_id="",
               secret_access_key="",
-              region_name="us-east-1"):
+              region_name="us-east-1",
+              max_workers=1,
+              prefetch=None,
+              ordered=True,
+              listing_cache=None,
+              object_cache=None,
+              start=None,
+              end=None,
+              checkpoint=None,
+              fields=None,
+              where=None):
     """Yield a stream of events from a Parse.ly S3 bucket
 
     :param network: The Parse.ly network for which to perform reads (eg
@@ -43,33 +228,268 @@ def events_s3(network,
     :type secret_access_key: str
     :param region_name: The AWS region in which to perform fetches
     :type region_name: str
+    :param max_workers: The number of objects to download concurrently. With
+        the default of 1, objects are fetched one at a time and decompressed
+        as they stream in, so memory use is constant per object.
+    :type max_workers: int
+    :param prefetch: The maximum number of downloaded objects held in memory
+        at once, defaulting to twice `max_workers`
+    :type prefetch: int
+    :param ordered: If True, yield events in key order; otherwise yield each
+        object's events as soon as its download completes
+    :type ordered: bool
+    :param listing_cache: If given, serve key listings from this cache and
+        refresh it incrementally
+    :type listing_cache: parsely_raw_data.cache.ListingCache
+    :param object_cache: If given, read objects from this local cache when
+        their ETag matches, and populate it on a miss
+    :type object_cache: parsely_raw_data.cache.ObjectCache
+    :param start: If given with `end`, read the range of data from `start` up
+        to `end` instead of a single prefix. The range is expanded to day and
+        hour prefixes that are listed in parallel and fetched as one job.
+    :type start: datetime.datetime
+    :param end: The exclusive end of the range to read
+    :type end: datetime.datetime
+    :param checkpoint: If given, skip objects this checkpoint records as fully
+        consumed, resume partially consumed objects after their last committed
+        line, and record progress as events are yielded. The caller commits
+        the checkpoint once it has durably handled the events it has received,
+        including after the stream is exhausted.
+    :type checkpoint: parsely_raw_data.checkpoint.S3Checkpoint
+    :param fields: If given, yield events holding only these keys
+    :type fields: list
+    :param where: If given, yield only events matching this filter, mapping
+        field names to a value or a list of acceptable values. Lines that
+        cannot match are dropped before being decoded.
+    :type where: dict
     """
     bucket = "parsely-dw-{}".format(utils.clean_network(network))
-    client = boto3.client('s3', **{
-        'aws_access_key_id': access_key_id,
-        'aws_secret_access_key': secret_access_key,
-        'region_name': region_name
-    })
-    res = {"IsTruncated": True}
-    while res.get("IsTruncated", False):
-        res = client.list_objects(Bucket=bucket, Prefix=prefix)
-        for item in res.get("Contents", []):
-            obj = client.get_object(Bucket=bucket, Key=item.get("Key"))
-            with gzip.GzipFile(fileobj=BytesIO(obj.get("Body").read()),
-                               mode="rb") as f:
-                for part in [a for a in f.read().split('\n') if a]:
-                    yield json.loads(part)
+    client = _s3_client(access_key_id, secret_access_key, region_name)
+    listing = _plan_listing(client, bucket, prefix, start=start, end=end,
+                            listing_cache=listing_cache)
+    listing = _checkpointed(listing, bucket, checkpoint)
+    if max_workers > 1:
+        objects = utils.imap_bounded(
+            lambda item: item + (_fetch_object(client, bucket, item[0],
+                                               object_cache=object_cache,
+                                               buffer=True),),
+            listing,
+            max_workers=max_workers,
+            prefetch=prefetch,
+            ordered=ordered)
+    else:
+        objects = ((obj, skip, _fetch_object(client, bucket, obj,
+                                             object_cache=object_cache))
+                   for obj, skip in listing)
+    decode = query.compile_query(fields=fields, where=where)
+    for obj, skip, chunks in objects:
+        if checkpoint is None:
+            for _, event in _decode_events(chunks, decode):
+                yield event
+            continue
+        key, etag = obj["key"], obj["etag"]
+        lines = skip
+        for lines, event in _decode_events(chunks, decode, skip=skip):
+            checkpoint.record(bucket, key, etag, lines)
+            yield event
+        checkpoint.record(bucket, key, etag, lines, complete=True)
+
+
+_worker_client = None
+
+
+def _init_process_worker(access_key_id, secret_access_key, region_name):
+    global _worker_client
+    _worker_client = _s3_client(access_key_id, secret_access_key, region_name)
+
+
+def _process_object(task):
+    """Fetch, decode and reduce one S3 object inside a worker process"""
+    bucket, obj, fields, where, func = task
+    decode = query.compile_query(fields=fields, where=where)
+    events = (event for _, event in _decode_events(
+        _fetch_object(_worker_client, bucket, obj), decode))
+    return func(events)
+
+
+def map_events_s3(network,
+                  func,
+                  prefix="",
+                  access_key_id="",
+                  secret_access_key="",
+                  region_name="us-east-1",
+                  processes=None,
+                  prefetch=None,
+                  ordered=True,
+                  listing_cache=None,
+                  start=None,
+                  end=None,
+                  fields=None,
+                  where=None):
+    """Reduce the events of each S3 object in a pool of worker processes
+
+    Each worker downloads, decompresses, decodes, filters and projects whole
+    objects, then calls `func` with an iterator over the object's events and
+    sends back only its return value. Returning compact results, such as
+    column batches or pre-aggregated counts, rather than the events
+    themselves lets decoding throughput scale with the number of cores.
+
+    :param network: The Parse.ly network for which to perform reads (eg
+        "parsely-blog")
+    :type network: str
+    :param func: A picklable callable (eg a module-level function) accepting
+        an iterator of events and returning a picklable result
+    :type func: callable
+    :param prefix: The S3 timestamp directory prefix from which to fetch data
+        batches, formatted as YYYY/MM/DD
+    :type prefix: str
+    :param access_key_id: The AWS access key to use when fetching data batches
+    :type access_key_id: str
+    :param secret_access_key: The AWS secret key to use when fetching data batches
+    :type secret_access_key: str
+    :param region_name: The AWS region in which to perform fetches
+    :type region_name: str
+    :param processes: The number of worker processes, defaulting to the
+        number of CPUs
+    :type processes: int
+    :param prefetch: The maximum number of objects in flight at once,
+        defaulting to twice `processes`
+    :type prefetch: int
+    :param ordered: If True, yield results in key order; otherwise yield them
+        as objects complete
+    :type ordered: bool
+    :param listing_cache: If given, serve key listings from this cache and
+        refresh it incrementally
+    :type listing_cache: parsely_raw_data.cache.ListingCache
+    :param start: If given with `end`, read the range of data from `start` up
+        to `end` instead of a single prefix
+    :type start: datetime.datetime
+    :param end: The exclusive end of the range to read
+    :type end: datetime.datetime
+    :param fields: If given, pass `func` events holding only these keys
+    :type fields: list
+    :param where: If given, pass `func` only events matching this filter
+    :type where: dict
+    """
+    bucket = "parsely-dw-{}".format(utils.clean_network(network))
+    client = _s3_client(access_key_id, secret_access_key, region_name)
+    listing = _plan_listing(client, bucket, prefix, start=start, end=end,
+                            listing_cache=listing_cache)
+    return utils.imap_bounded(
+        _process_object,
+        ((bucket, obj, fields, where, func) for obj in listing),
+        max_workers=processes or multiprocessing.cpu_count(),
+        prefetch=prefetch,
+        ordered=ordered,
+        processes=True,
+        initializer=_init_process_worker,
+        initargs=(access_key_id, secret_access_key, region_name))
+
+
+def _object_batches(events, batch_size, fields, categorical):
+    return list(columnar.iter_batches(events, batch_size=batch_size,
+                                      fields=fields, categorical=categorical))
+
+
+def events_s3_batches(network, prefix="", batch_size=10000, fields=None,
+                      categorical=(), processes=None, **kwargs):
+    """Yield batches of events from a Parse.ly S3 bucket as typed columns
+
+    Accepts the same arguments as `events_s3`, and yields
+    `parsely_raw_data.columnar.ColumnBatch`es holding a NumPy array (or
+    `array.array`) plus a null mask per field, typed from the event schema.
+
+    :param network: The Parse.ly network for which to perform reads (eg
+        "parsely-blog")
+    :type network: str
+    :param prefix: The S3 timestamp directory prefix from which to fetch data
+        batches, formatted as YYYY/MM/DD
+    :type prefix: str
+    :param batch_size: The maximum number of events per batch
+    :type batch_size: int
+    :param fields: The fields to include, defaulting to every schema field
+    :type fields: list
+    :param categorical: String fields to encode as int32 category codes
+    :type categorical: iterable
+    :param processes: If given, build batches in this many worker processes
+        via `map_events_s3`, in which case batches never span S3 objects and
+        only the arguments `map_events_s3` accepts may be passed
+    :type processes: int
+    """
+    if processes:
+        func = functools.partial(_object_batches, batch_size=batch_size,
+                                 fields=fields, categorical=categorical)
+        results = map_events_s3(network, func, prefix=prefix,
+                                processes=processes, fields=fields, **kwargs)
+        return (batch for batches in results for batch in batches)
+    events = events_s3(network, prefix=prefix, fields=fields, **kwargs)
+    return columnar.iter_batches(events, batch_size=batch_size, fields=fields,
+                                 categorical=categorical)
+
+
+def _count_actions(events):
+    counts = Counter()
+    for event in events:
+        counts[event.get("action")] += 1
+    return counts
 
 
 def main():
-    args = utils.get_default_parser("Amazon S3 utilities for Parse.ly").parse_args()
+    parser = utils.get_default_parser("Amazon S3 utilities for Parse.ly")
+    parser.add_argument('--max_workers', type=int, default=1,
+                        help='The number of S3 objects to download concurrently')
+    parser.add_argument('--unordered', action='store_true',
+                        help='Yield events as objects finish downloading rather '
+                             'than in key order')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Optional: decode and count objects in this many '
+                             'worker processes')
+    parser.add_argument('--cache_dir', type=str,
+                        help='Optional: a local directory in which to cache S3 '
+                             'key listings and objects between runs')
+    parser.add_argument('--cache_max_mb', type=int, default=10240,
+                        help='The maximum size of the local object cache in '
+                             'megabytes')
+    args = parser.parse_args()
+    try:
+        utils.check_range(args.start, args.end)
+    except ValueError as e:
+        parser.error(str(e))
+    listing_cache = object_cache = None
+    if args.cache_dir:
+        listing_cache = ListingCache(args.cache_dir)
+        object_cache = ObjectCache(args.cache_dir,
+                                   max_bytes=args.cache_max_mb * 1024 * 1024)
+    if args.processes:
+        event_counts = Counter()
+        for counts in map_events_s3(
+                args.network,
+                _count_actions,
+                prefix=args.s3_prefix,
+                access_key_id=args.aws_access_key_id,
+                secret_access_key=args.aws_secret_access_key,
+                processes=args.processes,
+                ordered=not args.unordered,
+                listing_cache=listing_cache,
+                start=args.start,
+                end=args.end,
+                fields=["action"]):
+            event_counts.update(counts)
+        print(event_counts)
+        return
     event_counts = defaultdict(int)
     for event in events_s3(
             args.network,
             prefix=args.s3_prefix,
             access_key_id=args.aws_access_key_id,
-            secret_access_key=args.aws_secret_access_key):
-        event_counts[event.action] += 1
+            secret_access_key=args.aws_secret_access_key,
+            max_workers=args.max_workers,
+            ordered=not args.unordered,
+            listing_cache=listing_cache,
+            object_cache=object_cache,
+            start=args.start,
+            end=args.end):
+        event_counts[event.get("action")] += 1
     print(event_counts)
 
 
@@ -1,28 +1,21 @@
-import json
 import os
 import tempfile
 
 import tablib
 import xlsxwriter
 
-from .schema import SCHEMA
+from . import codec
+from .schema import compile_projector, projector_fields
 
 def gen_json2csv(jsonlines):
     first_columns = ["action", "ts_action", "visitor_site_id", "url", "apikey"]
-    headers = [field["key"] for field in SCHEMA
-               if field["key"] not in first_columns]
+    headers = [key for key in projector_fields("csv")
+               if key not in first_columns]
     headers = first_columns + headers
+    project = compile_projector("csv", fields=headers)
     yield headers
     for jsonline in jsonlines:
-        row = []
-        for field in headers:
-            cell = jsonline.get(field)
-            if cell is None:
-                cell = ""
-            if isinstance(cell, (dict, list)):
-                cell = json.dumps(cell)
-            row.append(cell)
-        yield row
+        yield project(jsonline)
 
 
 def make_sample_dataset(jsonlines, row_limit=50000):
@@ -31,7 +24,7 @@ def make_sample_dataset(jsonlines, row_limit=50000):
     for i, line in enumerate(jsonlines):
         if i > row_limit:
             break
-        jsonline = json.loads(line)
+        jsonline = codec.loads(line)
         lines.append(jsonline)
     headers = None
     body = []
@@ -2,8 +2,11 @@ from __future__ import print_function
 
 import json
 
+import six
 from tabulate import tabulate
 
+from . import codec
+
 """
 Data Pipeline event schema DSL has this form:
 
@@ -298,7 +301,279 @@ def mk_markdown_table(prefix=None):
     return table, headers
 
 
+def _to_int(value):
+    # also truncates float and numeric string millisecond timestamps
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    except (TypeError, OverflowError):
+        return None
+    try:
+        return int(float(value))
+    except (ValueError, OverflowError):
+        return None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+BOOL_STRINGS = {"true": True, "1": True, "false": False, "0": False}
+
+
+def _to_bool(value):
+    if isinstance(value, six.string_types):
+        return BOOL_STRINGS.get(value.lower())
+    if isinstance(value, (dict, list)):
+        return None
+    return bool(value)
+
+
+def _to_str(value):
+    return codec.dumps(value)
+
+
+def _to_list(value):
+    if isinstance(value, (tuple, set)):
+        return list(value)
+    return [value]
+
+
+def _to_json(value):
+    if isinstance(value, (tuple, set)):
+        value = list(value)
+    return codec.dumps(value)
+
+
+# for each abstract type and target: the value types passed through as is,
+# and a function coercing any other non-null value (returning None if it
+# can't be coerced)
+STRING_TYPES = tuple(six.string_types)
+INT_TYPES = tuple(six.integer_types)
+COERCIONS = {
+    # BigQuery parses strings and numbers into STRING and FLOAT columns
+    # itself, so only the values it would reject are coerced
+    "bigquery": {
+        int: (INT_TYPES, _to_int),
+        bool: ((bool,), _to_bool),
+        list: ((list,), _to_list),
+    },
+    "redshift": {
+        str: (STRING_TYPES, _to_str),
+        int: (INT_TYPES, _to_int),
+        float: ((float,) + INT_TYPES, _to_float),
+        bool: ((bool,), _to_bool),
+        list: ((), _to_json),
+        object: (STRING_TYPES, _to_json),
+    },
+}
+COERCIONS["csv"] = COERCIONS["redshift"]
+
+
+def projector_fields(target, keep_extra_data=False):
+    """Return the columns of `target` in table order
+
+    These are the BigQuery schema's columns, the Redshift DDL's columns, or
+    every schema field for CSV.
+    """
+    if target == "bigquery":
+        return [column["name"] for column in mk_bigquery_schema()]
+    if target == "redshift":
+        return [record["key"] for record in SCHEMA
+                if record["type"] is not object or keep_extra_data]
+    if target == "csv":
+        return [record["key"] for record in SCHEMA]
+    raise ValueError("Unknown projector target {!r}".format(target))
+
+
+def _bigquery_projector(fields):
+    coercions = COERCIONS["bigquery"]
+    types = dict((record["key"], record["type"]) for record in SCHEMA)
+    keep = frozenset(fields)
+    namespace = {
+        # the fields usually present in events but not in rows
+        "drop": tuple(record["key"] for record in SCHEMA
+                      if record["key"] not in keep),
+        "only_kept": keep.issuperset,
+        "keep": keep,
+    }
+    lines = ["def project(event):",
+             "    row = event.copy()",
+             "    pop = row.pop",
+             "    for field in drop:",
+             "        pop(field, None)",
+             "    if not only_kept(row):",
+             "        for field in [f for f in list(row) if f not in keep]:",
+             "            del row[field]",
+             "    get = row.get"]
+    for i, field in enumerate(fields):
+        type_ = types.get(field)
+        if type_ in (None, object):
+            raise ValueError("Can't project field {!r} of type {} to bigquery"
+                             .format(field, type_))
+        if type_ not in coercions:
+            continue
+        allowed, namespace["c%d" % i] = coercions[type_]
+        namespace["t%d" % i] = allowed
+        lines.append("    v{0} = get({1!r})".format(i, field))
+        lines.append("    if v{0}.__class__ not in t{0}:".format(i))
+        if type_ is list:
+            # a repeated column can't be null
+            lines.append("        if v{0} is None:".format(i))
+            lines.append("            pop({0!r}, None)".format(field))
+            lines.append("        else:")
+            lines.append("            row[{1!r}] = c{0}(v{0})".format(i, field))
+        else:
+            lines.append("        if v{0} is not None:".format(i))
+            lines.append("            row[{1!r}] = c{0}(v{0})".format(i, field))
+    lines.append("    return row")
+    exec(compile("\n".join(lines), "<bigquery projector>", "exec"), namespace)
+    return namespace["project"]
+
+
+def compile_projector(target="bigquery", fields=None, keep_extra_data=False):
+    """Compile a function projecting an event onto the columns of a table
+
+    The function returns a dict of column values for "bigquery", a tuple in
+    column order for "redshift" and a list in column order for "csv". The
+    list of columns is the function's `fields` attribute.
+
+    BigQuery rows are copies of the event without its other fields, so a
+    row costs about one dict copy. Missing fields are left out, which
+    BigQuery reads as null. Only the values BigQuery would reject are
+    coerced: floats and numeric strings (such as millisecond timestamps) in
+    integer columns to integers, other values in boolean columns to
+    booleans, and single values in repeated columns to lists; null repeated
+    values are left out. Strings and numbers in string and float columns
+    are left for BigQuery to parse.
+
+    For Redshift and CSV, each value of an unexpected type is coerced to its
+    column's type: numeric strings and floats (such as millisecond
+    timestamps) to integers, "true"/"false" strings to booleans, and lists
+    and objects to JSON strings. Missing values, and values that can't be
+    coerced, are None, or "" for CSV. The field lookups and type checks are
+    generated as straight-line code once.
+
+    :param target: "bigquery", "redshift" or "csv"
+    :type target: str
+    :param fields: Optional: the fields to project, in order, defaulting to
+        `projector_fields(target)`
+    :type fields: list
+    :param keep_extra_data: Whether Redshift rows keep extra_data as a JSON
+        string (see `mk_redshift_schema`)
+    :type keep_extra_data: bool
+    """
+    if fields is None:
+        fields = projector_fields(target, keep_extra_data=keep_extra_data)
+    if target == "bigquery":
+        project = _bigquery_projector(fields)
+        project.fields = list(fields)
+        return project
+    if target not in COERCIONS:
+        raise ValueError("Unknown projector target {!r}".format(target))
+    coercions = COERCIONS[target]
+    types = dict((record["key"], record["type"]) for record in SCHEMA)
+    namespace = {}
+    lines = ["def project(event):", "    get = event.get"]
+    for i, field in enumerate(fields):
+        type_ = types.get(field)
+        if type_ not in coercions:
+            raise ValueError("Can't project field {!r} of type {} to {}"
+                             .format(field, type_, target))
+        allowed, namespace["c%d" % i] = coercions[type_]
+        if len(allowed) == 1:
+            namespace["t%d" % i] = allowed[0]
+            mismatch = "v{0}.__class__ is not t{0}"
+        elif allowed:
+            namespace["t%d" % i] = allowed
+            mismatch = "v{0}.__class__ not in t{0}"
+        else:
+            mismatch = "True"
+        lines.append("    v{0} = get({1!r})".format(i, field))
+        if target == "csv":
+            lines.append("    if v{0} is None:".format(i))
+            lines.append("        v{0} = ''".format(i))
+            lines.append(("    elif " + mismatch + ":").format(i))
+            lines.append("        v{0} = c{0}(v{0})".format(i))
+            lines.append("        if v{0} is None:".format(i))
+            lines.append("            v{0} = ''".format(i))
+        else:
+            lines.append(("    if " + mismatch + " and v{0} is not None:")
+                         .format(i))
+            lines.append("        v{0} = c{0}(v{0})".format(i))
+    values = ["v%d" % i for i in range(len(fields))]
+    if target == "redshift":
+        row = "(" + "".join(value + ", " for value in values) + ")"
+    else:
+        row = "[" + ", ".join(values) + "]"
+    lines.append("    return " + row)
+    exec(compile("\n".join(lines), "<{} projector>".format(target), "exec"),
+         namespace)
+    project = namespace["project"]
+    project.fields = list(fields)
+    return project
+
+
+def _benchmark(num_events=20000, repeat=3):
+    """Compare compiled projectors with per-field projection loops on a
+    batch of realistic Parse.ly events."""
+    import timeit
+
+    events = []
+    for i in range(num_events):
+        event = mk_sample_event()
+        event["event_id"] = "0x{:032x}".format(i)
+        event["engaged_time_inc"] = i % 30
+        event["extra_data"] = {"subscriberType": "free", "n": i}
+        events.append(event)
+
+    bigquery_fields = projector_fields("bigquery")
+    csv_fields = projector_fields("csv")
+
+    def bigquery_loop():
+        return [{k: event.get(k, None) for k in bigquery_fields}
+                for event in events]
+
+    def csv_loop():
+        rows = []
+        for event in events:
+            row = []
+            for field in csv_fields:
+                cell = event.get(field)
+                if cell is None:
+                    cell = ""
+                if isinstance(cell, (dict, list)):
+                    cell = codec.dumps(cell)
+                row.append(cell)
+            rows.append(row)
+        return rows
+
+    print("{} events".format(num_events))
+    print("{:10} {:>16} {:>16}".format("target", "loop events/s",
+                                       "compiled events/s"))
+    for target, loop in (("bigquery", bigquery_loop), ("redshift", None),
+                         ("csv", csv_loop)):
+        project = compile_projector(target)
+        compiled = min(timeit.repeat(
+            lambda: [project(event) for event in events],
+            number=1, repeat=repeat))
+        looped = "-"
+        if loop is not None:
+            looped = "{:.0f}".format(
+                num_events / min(timeit.repeat(loop, number=1, repeat=repeat)))
+        print("{:10} {:>16} {:>16.0f}".format(target, looped,
+                                              num_events / compiled))
+
+
 if __name__ == "__main__":
-    # TODO: CLI for just showing the various DDLs
-    from .docgen import main
-    main()
+    import sys
+    if sys.argv[1:] == ["benchmark"]:
+        _benchmark()
+    else:
+        # TODO: CLI for just showing the various DDLs
+        from .docgen import main
+        main()
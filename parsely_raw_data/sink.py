@@ -0,0 +1,341 @@
+from __future__ import absolute_import, print_function
+
+import gzip
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+import six
+from six import iteritems
+from six.moves.queue import Queue, Empty
+
+from . import codec
+from .cache import _makedirs
+
+__license__ = """
+Copyright 2016 Parsely, Inc.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+"""
+Archive Parse.ly events as hour-partitioned, gzipped JSON lines files.
+
+Events are buffered into batches and handed to a background thread, which
+appends each to a file under DIRECTORY/YYYY/MM/DD/HH/ chosen by the
+event's ts_action. Files are written under a temporary name and renamed
+into place when they're rolled over at the sink's size or age limit, so a
+file with its final name is always complete. For example, to archive a
+Kinesis stream::
+
+    checkpoint = SQLiteShardCheckpoint("shards.db", commit_interval=10)
+    sink = PartitionedFileSink("archive")
+    sink.attach(checkpoint)
+    for event in events_kinesis("blog.parsely.com", checkpoint=checkpoint):
+        sink.write(event)
+
+Each checkpoint commit first syncs every open file without rolling it: the
+file's current gzip member is finished and fsynced, and its length is
+recorded in a manifest. So the checkpoint never advances past events that
+aren't on disk, however often it commits. After a crash, `attach` truncates
+each file left open to its recorded length, which ends on a complete gzip
+member, and gives it its final name; events written after the last commit
+are discarded, since the checkpoint replays them.
+"""
+
+QUEUE_GET_TIMEOUT = 1.0
+TS_ACTION_HOUR_RE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})[ T](\d{2})")
+UNKNOWN_PARTITION = "unknown"
+
+
+def hour_partition(event):
+    """Return the YYYY/MM/DD/HH partition of an event from its ts_action"""
+    match = TS_ACTION_HOUR_RE.match(event.get("ts_action") or "")
+    if match is None:
+        return UNKNOWN_PARTITION
+    return "/".join(match.groups())
+
+
+def _fsync_directory(directory):
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _PartitionFile(object):
+    """A gzip file being written under a temporary name
+
+    The file is a series of gzip members; `sync` ends the current one, so
+    the file up to `synced` bytes is always a valid gzip file.
+    """
+
+    def __init__(self, path, tmp_prefix, compresslevel):
+        self.path = path
+        directory = os.path.dirname(path)
+        _makedirs(directory)
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix=tmp_prefix)
+        self._raw = os.fdopen(fd, "wb")
+        self._gzip = None
+        self.compresslevel = compresslevel
+        self.synced = 0
+        self.opened = time.time()
+
+    @property
+    def size(self):
+        """The number of compressed bytes written so far"""
+        return self._raw.tell()
+
+    def write(self, data):
+        if self._gzip is None:
+            self._gzip = gzip.GzipFile(fileobj=self._raw, mode="wb",
+                                       compresslevel=self.compresslevel)
+        self._gzip.write(data)
+
+    def sync(self):
+        """End the current gzip member and sync the file to disk"""
+        if self._gzip is not None:
+            self._gzip.close()
+            self._gzip = None
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self.synced = self._raw.tell()
+
+    def close(self):
+        """Finish the file, sync it and give it its final name"""
+        self.sync()
+        self._raw.close()
+        os.rename(self.tmp_path, self.path)
+
+
+class PartitionedFileSink(object):
+    """Write events to hour-partitioned gzip JSON lines files
+
+    `write` and `flush` should be called from a single thread. Once the
+    writer thread fails, its error is raised from every later call to
+    `write` (at the next batch) or `flush`, and nothing more is written.
+    Only one sink should write to a directory with a given prefix.
+
+    :param directory: The directory under which to write partitions
+    :type directory: str
+    :param prefix: The prefix of each file name
+    :type prefix: str
+    :param max_bytes: Roll a file over once it holds this many compressed bytes
+    :type max_bytes: int
+    :param max_age: Roll a file over once it has been open this many seconds
+    :type max_age: float
+    :param batch_size: The number of events buffered before they're handed
+        to the writer thread
+    :type batch_size: int
+    :param queue_size: The maximum number of batches waiting for the writer;
+        `write` blocks only if the writer falls this far behind
+    :type queue_size: int
+    :param compresslevel: The gzip compression level, from 1 to 9
+    :type compresslevel: int
+    :param partition: A function returning an event's partition path,
+        defaulting to its ts_action hour
+    :type partition: callable
+    :param on_roll: Optional: a function called from the writer thread with
+        the path of each complete file, when `events_written` counts the
+        events in it and in every file before it
+    :type on_roll: callable
+    """
+
+    def __init__(self, directory, prefix="events", max_bytes=128 * 1024 * 1024,
+                 max_age=300.0, batch_size=1000, queue_size=100,
+                 compresslevel=6, partition=hour_partition, on_roll=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.compresslevel = compresslevel
+        self.partition = partition
+        self.on_roll = on_roll
+        self.files_written = 0
+        self.events_written = 0
+        self._buffer = []
+        self._queue = Queue(maxsize=queue_size)
+        self._files = {}
+        self._sequence = 0
+        self._error = None
+        self._tmp_prefix = ".tmp-{}-".format(prefix)
+        self._manifest_path = os.path.join(
+            directory, ".{}-manifest.json".format(prefix))
+        self._manifest = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def attach(self, checkpoint):
+        """Flush this sink before each commit of a `ShardCheckpointStore`
+
+        Call this before writing: it first recovers the files a previous
+        run left open, keeping the events synced by its last flush.
+        """
+        self._recover()
+        self._manifest = True
+        checkpoint.add_commit_hook(self.flush)
+
+    def write(self, event):
+        """Buffer an event to be written"""
+        self._buffer.append(event)
+        if len(self._buffer) >= self.batch_size:
+            self._submit()
+
+    def write_many(self, events):
+        """Buffer each of `events` to be written"""
+        for event in events:
+            self.write(event)
+
+    def flush(self):
+        """Write every buffered event and sync all open files to disk
+
+        Returns once every event written so far is durably on disk. Open
+        files aren't rolled over, but after a crash `attach` completes them
+        up to this point.
+        """
+        self._submit()
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        done.wait()
+        self._raise_error()
+
+    def close(self):
+        """Write every buffered event, roll over all open files and stop the
+        writer thread"""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._submit()
+        finally:
+            self._queue.put(("stop", None))
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            six.reraise(*self._error)
+
+    def _submit(self):
+        self._raise_error()
+        if self._buffer:
+            batch, self._buffer = self._buffer, []
+            self._queue.put(("write", batch))
+
+    def _run(self):
+        while True:
+            try:
+                command, argument = self._queue.get(timeout=QUEUE_GET_TIMEOUT)
+            except Empty:
+                command, argument = "roll", None
+            try:
+                if self._error is not None:
+                    # once failed, write nothing more
+                    pass
+                elif command == "write":
+                    self._write(argument)
+                    self._roll(force=False)
+                elif command == "roll":
+                    self._roll(force=False)
+                elif command == "flush":
+                    self._sync()
+                else:
+                    self._roll(force=True)
+                    self._write_manifest()
+            except Exception:
+                self._error = sys.exc_info()
+            if command == "flush":
+                argument.set()
+            elif command == "stop":
+                return
+
+    def _write(self, events):
+        lines = {}
+        for event in events:
+            lines.setdefault(self.partition(event), []).append(
+                codec.dumps(event))
+        for partition, partition_lines in iteritems(lines):
+            f = self._files.get(partition)
+            if f is None:
+                f = self._files[partition] = _PartitionFile(
+                    self._path(partition), self._tmp_prefix,
+                    self.compresslevel)
+            f.write(("\n".join(partition_lines) + "\n").encode("utf-8"))
+        self.events_written += len(events)
+
+    def _path(self, partition):
+        self._sequence += 1
+        name = "{}-{}-{}-{:06d}.jsonl.gz".format(
+            self.prefix, time.strftime("%Y%m%dT%H%M%S", time.gmtime()),
+            os.getpid(), self._sequence)
+        return os.path.join(self.directory, partition, name)
+
+    def _roll(self, force):
+        now = time.time()
+        for partition, f in list(iteritems(self._files)):
+            if (force or f.size >= self.max_bytes or
+                    now - f.opened >= self.max_age):
+                del self._files[partition]
+                f.close()
+                self.files_written += 1
+                if self.on_roll is not None:
+                    self.on_roll(f.path)
+
+    def _sync(self):
+        for f in self._files.values():
+            f.sync()
+        self._write_manifest()
+
+    def _write_manifest(self):
+        """Durably record the synced length of each open file"""
+        if not self._manifest:
+            return
+        manifest = dict((f.tmp_path, [f.path, f.synced])
+                        for f in self._files.values() if f.synced)
+        _makedirs(self.directory)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                        prefix=self._tmp_prefix)
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._manifest_path)
+        _fsync_directory(self.directory)
+
+    def _recover(self):
+        """Complete the files a previous run synced, and remove the rest"""
+        try:
+            with open(self._manifest_path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError):
+            manifest = {}
+        for tmp_path, (path, synced) in iteritems(manifest):
+            if not os.path.exists(tmp_path):
+                continue
+            with open(tmp_path, "r+b") as f:
+                f.truncate(synced)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, path)
+        # other temporary files hold only events written after a commit
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith(self._tmp_prefix):
+                    os.remove(os.path.join(root, name))
+        if manifest:
+            os.remove(self._manifest_path)
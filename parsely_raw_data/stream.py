@@ -1,16 +1,19 @@
 from __future__ import absolute_import, print_function
 
-import json
+import random
 import threading
 import time
-from collections import defaultdict
 
 import boto3
 from botocore.exceptions import ClientError, ParamValidationError
-from six import iteritems
 from six.moves.queue import Queue, Empty
 
-from . import utils
+from . import query, utils
+from .analytics import SlidingTopN
+from .checkpoint import SQLiteShardCheckpoint
+from .metrics import (ShardMetrics, StreamMetrics, report_stats,
+                      serve_metrics)
+from .records import RecordStats, stats as record_stats, unpack_records
 
 __license__ = """
 Copyright 2016 Parsely, Inc.
@@ -28,19 +31,170 @@ limitations under the License.
 """
 Consider the below a demostration of how Kinesis can be utilized with
 the Parse.ly data pipeline; additional configuration may be necessary. 
-Larger publishers in particular will likely need multiple processes.
+Larger publishers in particular will likely need multiple processes; see
+parsely_raw_data.consumer_group for a multi-process consumer.
 """
 
-def events_kinesis(network, access_key_id="", secret_access_key=""):
-    """Yield a stream of events from a Parse.ly Kinesis Stream
+QUEUE_GET_TIMEOUT = 1.0
+# Kinesis allows 5 GetRecords calls per second per shard
+MIN_POLL_INTERVAL = 0.2
+CAUGHT_UP_POLL_INTERVAL = 0.5
+IDLE_POLL_INTERVAL = 1.0
+MAX_RECORDS_PER_CALL = 10000
+REPORT_INTERVAL = 2.0
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+THROTTLE_ERRORS = ("ProvisionedThroughputExceededException",
+                   "LimitExceededException")
 
-    :param network: The Parse.ly network name for which to perform reads (eg
-        "blog.parsely.com")
-    :type network: str
-    :param access_key_id: The AWS access key to use when consuming the stream
-    :type access_key_id: str
-    :param secret_access_key: The AWS secret key to use when consuming the stream
-    :type secret_access_key: str
+
+def _poll_interval(record_count, millis_behind):
+    """Choose how long to wait between GetRecords calls on a shard
+
+    A shard that is behind the tip is read as fast as the per-shard limit
+    allows; a caught-up shard is polled less often, and an empty one less
+    often still.
+    """
+    if millis_behind:
+        return MIN_POLL_INTERVAL
+    if record_count:
+        return CAUGHT_UP_POLL_INTERVAL
+    return IDLE_POLL_INTERVAL
+
+
+def _backoff(attempt):
+    """Return an exponential backoff delay with full jitter"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _shard_iterator(client, stream, shard_id, checkpoint=None,
+                    after_sequence_number=None):
+    kwargs = {"StreamName": stream, "ShardId": shard_id,
+              "ShardIteratorType": "LATEST"}
+    if after_sequence_number is None and checkpoint is not None:
+        after_sequence_number = checkpoint.get(stream, shard_id)
+        if after_sequence_number is None:
+            kwargs["ShardIteratorType"] = "TRIM_HORIZON"
+    if after_sequence_number is not None:
+        kwargs["ShardIteratorType"] = "AFTER_SEQUENCE_NUMBER"
+        kwargs["StartingSequenceNumber"] = after_sequence_number
+    return client.get_shard_iterator(**kwargs).get("ShardIterator")
+
+
+def read_shard(client, stream, shard_id, checkpoint=None,
+               limit=MAX_RECORDS_PER_CALL, stop_event=None, metrics=None):
+    """Yield each non-empty batch of records returned by GetRecords on a shard
+
+    Calls are paced by `_poll_interval` to stay within the per-shard read
+    limit, and throttling errors are retried with exponential backoff and
+    jitter. Stops when the shard is closed, eg after a reshard.
+
+    :param client: The boto3 Kinesis client to read with
+    :type client: botocore.client.Kinesis
+    :param stream: The name of the stream
+    :type stream: str
+    :param shard_id: The ID of the shard to read
+    :type shard_id: str
+    :param checkpoint: Optional: a store holding the position to resume from
+    :type checkpoint: parsely_raw_data.checkpoint.ShardCheckpointStore
+    :param limit: The maximum number of records to request per call
+    :type limit: int
+    :param stop_event: Optional: an event which, once set, stops the reader
+    :type stop_event: threading.Event
+    :param metrics: Optional: counters to update with each call
+    :type metrics: parsely_raw_data.metrics.ShardMetrics
+    """
+    if metrics is None:
+        metrics = ShardMetrics()
+    iterator = _shard_iterator(client, stream, shard_id, checkpoint=checkpoint)
+    last_sequence_number = None
+    attempt = 0
+    while iterator and not (stop_event is not None and stop_event.is_set()):
+        started = time.time()
+        try:
+            response = client.get_records(ShardIterator=iterator, Limit=limit)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code in THROTTLE_ERRORS:
+                metrics.throttles += 1
+                time.sleep(_backoff(attempt))
+                attempt += 1
+            elif code == "ExpiredIteratorException":
+                iterator = _shard_iterator(
+                    client, stream, shard_id, checkpoint=checkpoint,
+                    after_sequence_number=last_sequence_number)
+            else:
+                metrics.errors += 1
+                time.sleep(2)
+            continue
+        except ParamValidationError:
+            metrics.errors += 1
+            time.sleep(2)
+            continue
+        attempt = 0
+        iterator = response.get("NextShardIterator")
+        records = response.get("Records", [])
+        metrics.get_records_calls += 1
+        metrics.records += len(records)
+        metrics.millis_behind_latest = response.get("MillisBehindLatest")
+        metrics.last_read = started
+        if records:
+            last_sequence_number = records[-1].get("SequenceNumber")
+            yield records
+        delay = (_poll_interval(len(records), response.get("MillisBehindLatest"))
+                 - (time.time() - started))
+        if iterator and delay > 0:
+            time.sleep(delay)
+
+
+def list_shards(client, stream):
+    """Return the description of every shard in a stream, open or closed
+
+    :param client: The boto3 Kinesis client to describe the stream with
+    :type client: botocore.client.Kinesis
+    :param stream: The name of the stream
+    :type stream: str
+    """
+    shards = []
+    kwargs = {"StreamName": stream}
+    while True:
+        description = client.describe_stream(**kwargs).get("StreamDescription", {})
+        shards.extend(description.get("Shards", []))
+        if not description.get("HasMoreShards", False) or not shards:
+            return shards
+        kwargs["ExclusiveStartShardId"] = shards[-1].get("ShardId")
+
+
+def decode_records(records, decode, stats=None):
+    """Decode a batch of Kinesis records, skipping undecodable or filtered ones
+
+    Records may each hold one event, or many as KPL aggregated records or
+    compressed batches (see `parsely_raw_data.records`). Returns a list of
+    sequence numbers and a list of the decoded events; the sequence number
+    paired with an event is None or that of an earlier record unless the
+    event is the last in its record.
+
+    :param records: The records returned by GetRecords
+    :type records: list
+    :param decode: A function decoding a record's data, as returned by
+        `parsely_raw_data.query.compile_query`
+    :type decode: callable
+    :param stats: The counters to update with what was unpacked and
+        skipped, defaulting to `parsely_raw_data.records.stats`
+    :type stats: parsely_raw_data.records.RecordStats
+    """
+    counts = dict((field, 0) for field in RecordStats.FIELDS)
+    sequence_numbers, events = unpack_records(records, decode, counts)
+    (stats or record_stats).add(counts)
+    return sequence_numbers, events
+
+
+def _kinesis_batches(network, access_key_id, secret_access_key, fields, where,
+                     queue_size, event_queue, checkpoint, metrics):
+    """Read every shard on its own thread, yielding decoded batches
+
+    Yields (stream, shard_id, last sequence number, sequence numbers, events)
+    for each GetRecords batch, in the order batches are read.
     """
     client = boto3.client(
         'kinesis',
@@ -48,88 +202,175 @@ def events_kinesis(network, access_key_id="", secret_access_key=""):
         aws_secret_access_key=secret_access_key
     )
     stream = "parsely-dw-{}".format(utils.clean_network(network))
-    event_queue = Queue()
+    if event_queue is None:
+        event_queue = Queue(maxsize=queue_size)
+    decode = query.compile_query(fields=fields, where=where)
+    if metrics is None:
+        metrics = StreamMetrics()
+    metrics.stream = stream
+    metrics.event_queue = event_queue
 
     def get_events(shard_id):
-        response = client.get_shard_iterator(
-            StreamName=stream,
-            ShardId=shard_id,
-            ShardIteratorType='LATEST'
-        )
-        iterator = response.get("ShardIterator", "")
-        while True:
-            response = {}
-            try:
-                response = client.get_records(ShardIterator=iterator)
-            except (ClientError, ParamValidationError):
-                time.sleep(2)
-                continue
-            iterator = response.get("NextShardIterator", "")
-            records = response.get("Records", [])
-            for record in records:
-                event_data = record.get("Data")
-                if event_data is not None:
-                    try:
-                        event_data = json.loads(event_data)
-                    except ValueError:
-                        continue
-                    event_queue.put(event_data)
+        shard_metrics = metrics.shard(shard_id)
+        for records in read_shard(client, stream, shard_id,
+                                  checkpoint=checkpoint,
+                                  metrics=shard_metrics):
+            sequence_numbers, events = decode_records(
+                records, decode, stats=metrics.record_stats)
+            shard_metrics.events += len(events)
+            event_queue.put((shard_id, records[-1].get("SequenceNumber"),
+                             sequence_numbers, events))
 
     workers = []
-    description = {"HasMoreShards": True}
-    while description.get("HasMoreShards", False):
-        response = client.describe_stream(StreamName=stream)
-        description = response.get('StreamDescription', {})
-        shards = description.get('Shards', [])
-        for shard in shards:
-            worker = threading.Thread(target=get_events, args=(shard.get("ShardId"),))
-            worker.daemon = True
-            worker.start()
-            workers.append(worker)
+    for shard in list_shards(client, stream):
+        worker = threading.Thread(target=get_events, args=(shard.get("ShardId"),))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
 
     while True:
-        event = None
         try:
-            event = event_queue.get(block=False, timeout=.01)
+            # block with a timeout rather than indefinitely so that
+            # KeyboardInterrupt is still delivered on Python 2
+            shard_id, last_sequence_number, sequence_numbers, events = \
+                event_queue.get(timeout=QUEUE_GET_TIMEOUT)
         except Empty:
-            pass
-        if event is not None:
+            if checkpoint is not None:
+                checkpoint.maybe_commit()
+            continue
+        yield stream, shard_id, last_sequence_number, sequence_numbers, events
+
+
+def events_kinesis(network, access_key_id="", secret_access_key="",
+                   fields=None, where=None, queue_size=100, event_queue=None,
+                   checkpoint=None, metrics=None):
+    """Yield a stream of events from a Parse.ly Kinesis Stream
+
+    :param network: The Parse.ly network name for which to perform reads (eg
+        "blog.parsely.com")
+    :type network: str
+    :param access_key_id: The AWS access key to use when consuming the stream
+    :type access_key_id: str
+    :param secret_access_key: The AWS secret key to use when consuming the stream
+    :type secret_access_key: str
+    :param fields: If given, yield events holding only these keys
+    :type fields: list
+    :param where: If given, yield only events matching this filter, mapping
+        field names to a value or a list of acceptable values
+    :type where: dict
+    :param queue_size: The maximum number of record batches (one per
+        GetRecords call) buffered between the shard readers and the consumer.
+        When the buffer is full, shard readers block until the consumer
+        catches up.
+    :type queue_size: int
+    :param event_queue: Optional: the queue in which to buffer batches, in
+        place of a new one of `queue_size`. Pass your own to monitor its depth
+        with `qsize()`.
+    :type event_queue: six.moves.queue.Queue
+    :param checkpoint: Optional: a store in which to record each shard's
+        position as its events are consumed. Shards with a stored position
+        resume just after it, and shards without one start from the oldest
+        available record. Without a store, every shard starts at the latest
+        record.
+    :type checkpoint: parsely_raw_data.checkpoint.ShardCheckpointStore
+    :param metrics: Optional: an object in which to keep lag, throughput
+        and decoding metrics for the consumer
+    :type metrics: parsely_raw_data.metrics.StreamMetrics
+    """
+    batches = _kinesis_batches(network, access_key_id, secret_access_key,
+                               fields, where, queue_size, event_queue,
+                               checkpoint, metrics)
+    for stream, shard_id, last_sequence_number, sequence_numbers, events \
+            in batches:
+        if checkpoint is None:
+            for event in events:
+                yield event
+            continue
+        for sequence_number, event in zip(sequence_numbers, events):
             yield event
+            if sequence_number is not None:
+                checkpoint.record(stream, shard_id, sequence_number)
+        checkpoint.record(stream, shard_id, last_sequence_number)
+
+
+def events_kinesis_batches(network, access_key_id="", secret_access_key="",
+                           fields=None, where=None, queue_size=100,
+                           event_queue=None, checkpoint=None, metrics=None):
+    """Yield lists of events from a Parse.ly Kinesis Stream
+
+    Each list holds the events from one GetRecords call on one shard, which
+    avoids per-event overhead for consumers that work on batches. Accepts
+    the same arguments as `events_kinesis`; when a checkpoint is given, a
+    batch's shard position is recorded once the consumer asks for the next
+    batch.
+    """
+    batches = _kinesis_batches(network, access_key_id, secret_access_key,
+                               fields, where, queue_size, event_queue,
+                               checkpoint, metrics)
+    for stream, shard_id, last_sequence_number, _, events in batches:
+        if events:
+            yield events
+        if checkpoint is not None:
+            checkpoint.record(stream, shard_id, last_sequence_number)
 
 
 def main():
     parser = utils.get_default_parser(
         "Amazon Kinesis Stream utilities for Parse.ly")
+    parser.add_argument('--queue_size', type=int, default=100,
+                        help='The maximum number of record batches to buffer '
+                             'between the shard readers and the consumer')
+    parser.add_argument('--checkpoint', type=str,
+                        help='Optional: a local SQLite file in which to record '
+                             'shard positions, so a restarted consumer resumes '
+                             'where it stopped')
+    parser.add_argument('--group_by', type=str, default='url',
+                        help='The event field by which to rank pageviews')
+    parser.add_argument('--window', type=int, default=300,
+                        help='The length in seconds of the sliding window '
+                             'over which pageviews are ranked')
+    parser.add_argument('--stats_interval', type=float,
+                        help='Optional: print lag, throughput and decoding '
+                             'metrics to stderr every this many seconds')
+    parser.add_argument('--metrics_port', type=int,
+                        help='Optional: serve metrics in the Prometheus text '
+                             'format on this local port')
     args = parser.parse_args()
+    event_queue = Queue(maxsize=args.queue_size)
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = SQLiteShardCheckpoint(args.checkpoint)
+    metrics = StreamMetrics(event_queue)
+    if args.stats_interval:
+        report_stats(metrics, args.stats_interval)
+    if args.metrics_port:
+        serve_metrics(metrics, port=args.metrics_port)
 
     # simple example of realtime analytics with streaming event data
-    # periodically prints the top ten urls in current TIME_WINDOW_SEC window
-    TIME_WINDOW_SEC = 30
-    url_counts = defaultdict(int)
-    total_count = 0
-    last_update = time.time()
+    # periodically prints the top ten values of --group_by among the
+    # pageviews of the last --window seconds
+    top_n = SlidingTopN(field=args.group_by, window=args.window,
+                        resolution=max(1, args.window / 30.0))
+    next_report = time.time() + REPORT_INTERVAL
     for event in events_kinesis(
             args.network,
             access_key_id=args.aws_access_key_id,
-            secret_access_key=args.aws_secret_access_key):
-        total_count += 1
-        if event['action'] == "pageview":
-            url_counts[event['url']] += 1
-
-        if total_count % 20 == 0:
-            sorted_pairs = sorted(iteritems(url_counts), key=lambda x: x[1],
-                                  reverse=True)
-            top_urls = sorted_pairs[:10]
-            for url, events in top_urls:
-                url_display = url[:70]
-                if len(url) > 70:
-                    url_display += "..."
-                print(events, url_display)
-            print("\n\n")
+            secret_access_key=args.aws_secret_access_key,
+            where={"action": "pageview"},
+            event_queue=event_queue,
+            checkpoint=checkpoint,
+            metrics=metrics):
+        top_n.add(event)
 
-        if time.time() - last_update > TIME_WINDOW_SEC:
-            url_counts = defaultdict(int)
-            last_update = time.time()
+        if time.time() >= next_report:
+            for value, events in top_n.top(10):
+                value = u"{}".format(value)
+                value_display = value[:70]
+                if len(value) > 70:
+                    value_display += "..."
+                print(events, value_display)
+            print("\n\n")
+            next_report = time.time() + REPORT_INTERVAL
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,14 @@
 from __future__ import absolute_import, print_function
 
 import argparse
+import datetime
+import multiprocessing
+import sys
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import six
+from six.moves.queue import Queue
 
 __license__ = """
 Copyright 2016 Parsely, Inc.
@@ -36,6 +44,13 @@ def get_default_parser(description, commands=None):
     parser.add_argument('--s3_prefix', type=str,
                         help='The date prefix to use when copying from S3, formatted as '
                              'YYYY/MM/DD')
+    parser.add_argument('--start', type=parse_datetime,
+                        help='Optional: instead of --s3_prefix, the UTC datetime '
+                             'from which to copy data, formatted as YYYY-MM-DD or '
+                             'YYYY-MM-DDTHH')
+    parser.add_argument('--end', type=parse_datetime,
+                        help='Optional: the UTC datetime (exclusive) up to which to '
+                             'copy data when --start is given')
     parser.add_argument('--debug', action='store_true',
                         help='Turn on debug mode to log output and commands')
     if commands is not None:
@@ -48,3 +63,154 @@ def get_default_parser(description, commands=None):
 def clean_network(network):
     """Format a network name to match AWS resources"""
     return network.replace(".", "-").replace(" ", "-").lower()
+
+
+DATETIME_FORMATS = (
+    "%Y-%m-%d",
+    "%Y-%m-%dT%H",
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+)
+
+
+def parse_datetime(value):
+    """Parse a command line datetime, formatted as YYYY-MM-DD[THH[:MM[:SS]]]"""
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(
+        "invalid datetime {!r}, expected YYYY-MM-DD or YYYY-MM-DDTHH".format(value))
+
+
+def check_range(start, end):
+    """Return whether a datetime range is given, raising ValueError if only
+    one of its bounds is or if `start` isn't before `end`"""
+    if start is None and end is None:
+        return False
+    if start is None or end is None:
+        raise ValueError("a range needs both a start and an end")
+    if start >= end:
+        raise ValueError("the range start {} isn't before its end {}".format(
+            start, end))
+    return True
+
+
+def plan_prefixes(start, end):
+    """Expand a datetime range into the fewest S3 day and hour prefixes
+
+    Whole days in the range become YYYY/MM/DD prefixes and partial days
+    become one YYYY/MM/DD/HH prefix per hour. `start` is rounded down and
+    `end` rounded up to the hour; `end` is exclusive.
+
+    :param start: The beginning of the range
+    :type start: datetime.datetime
+    :param end: The end of the range
+    :type end: datetime.datetime
+    """
+    one_hour = datetime.timedelta(hours=1)
+    one_day = datetime.timedelta(days=1)
+    current = start.replace(minute=0, second=0, microsecond=0)
+    if end.replace(minute=0, second=0, microsecond=0) != end:
+        end = end.replace(minute=0, second=0, microsecond=0) + one_hour
+    prefixes = []
+    while current < end:
+        if current.hour == 0 and current + one_day <= end:
+            prefixes.append(current.strftime("%Y/%m/%d"))
+            current += one_day
+        else:
+            prefixes.append(current.strftime("%Y/%m/%d/%H"))
+            current += one_hour
+    return prefixes
+
+
+def _call_capturing(func, item, keep_traceback=True):
+    try:
+        return func(item), None
+    except Exception:
+        exc_type, exc_value, exc_tb = sys.exc_info()
+        # tracebacks can't be pickled back from worker processes
+        return None, (exc_type, exc_value, exc_tb if keep_traceback else None)
+
+
+def imap_bounded(func, iterable, max_workers=4, prefetch=None, ordered=True,
+                 processes=False, initializer=None, initargs=()):
+    """Apply `func` to each item of `iterable` in a pool of workers
+
+    At most `prefetch` calls are in flight (running or finished but not yet
+    consumed) at any moment, so memory use stays bounded regardless of how
+    many items `iterable` produces. Exceptions raised by `func` are re-raised
+    in the consuming thread.
+
+    :param func: The callable to apply to each item
+    :type func: callable
+    :param iterable: The items to process
+    :type iterable: iterable
+    :param max_workers: The number of workers
+    :type max_workers: int
+    :param prefetch: The maximum number of results to hold in flight,
+        defaulting to twice `max_workers`
+    :type prefetch: int
+    :param ordered: If True, yield results in input order; otherwise yield them
+        as they complete
+    :type ordered: bool
+    :param processes: If True, run `func` in worker processes instead of
+        threads, in which case `func`, the items and the results must all be
+        picklable
+    :type processes: bool
+    :param initializer: A callable run once in each worker when it starts
+    :type initializer: callable
+    :param initargs: The arguments to pass to `initializer`
+    :type initargs: tuple
+    """
+    if prefetch is None:
+        prefetch = max_workers * 2
+    prefetch = max(prefetch, 1)
+    items = iter(iterable)
+    if processes:
+        pool = multiprocessing.Pool(max_workers, initializer, initargs)
+    else:
+        pool = ThreadPool(max_workers, initializer, initargs)
+    keep_traceback = not processes
+    try:
+        if ordered:
+            pending = deque()
+            for item in items:
+                pending.append(pool.apply_async(
+                    _call_capturing, (func, item, keep_traceback)))
+                if len(pending) >= prefetch:
+                    break
+            while pending:
+                result, exc_info = pending.popleft().get()
+                if exc_info is not None:
+                    six.reraise(*exc_info)
+                for item in items:
+                    pending.append(pool.apply_async(
+                        _call_capturing, (func, item, keep_traceback)))
+                    break
+                yield result
+        else:
+            done = Queue()
+            in_flight = 0
+            for item in items:
+                pool.apply_async(_call_capturing, (func, item, keep_traceback),
+                                 callback=done.put)
+                in_flight += 1
+                if in_flight >= prefetch:
+                    break
+            while in_flight:
+                result, exc_info = done.get()
+                in_flight -= 1
+                if exc_info is not None:
+                    six.reraise(*exc_info)
+                for item in items:
+                    pool.apply_async(_call_capturing,
+                                     (func, item, keep_traceback),
+                                     callback=done.put)
+                    in_flight += 1
+                    break
+                yield result
+    finally:
+        pool.terminate()
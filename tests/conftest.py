@@ -0,0 +1,7 @@
+import sys
+
+collect_ignore = []
+
+# the asyncio consumer and its tests need Python 3.6's async generators
+if sys.version_info < (3, 6):
+    collect_ignore.append("test_async_stream.py")
@@ -0,0 +1,105 @@
+import pickle
+import random
+
+from parsely_raw_data.analytics import (HyperLogLog, SketchMap, SlidingTopN,
+                                        SpaceSaving)
+
+
+def test_estimates_distinct_values():
+    for precision, cardinality in [(12, 50), (12, 5000), (12, 100000),
+                                   (10, 20000)]:
+        sketch = HyperLogLog(precision)
+        for n in range(cardinality):
+            sketch.add("visitor-%d" % n)
+            sketch.add("visitor-%d" % n)
+        error = 1.04 / (2 ** precision) ** 0.5
+        assert abs(sketch.count() - cardinality) <= 3 * error * cardinality
+
+
+def test_merges_sketches_as_a_union():
+    left, right, union = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    for n in range(20000):
+        (left if n % 2 else right).add(n)
+        union.add(n)
+    left.merge(right)
+    assert left.registers == union.registers
+    assert HyperLogLog.from_bytes(left.to_bytes()).count() == union.count()
+
+
+def test_tracks_every_frequent_key():
+    rng = random.Random(0)
+    events = ["hot-%d" % (n % 5) for n in range(5000)]
+    events += ["cold-%d" % rng.randrange(10000) for _ in range(5000)]
+    rng.shuffle(events)
+    summary = SpaceSaving(capacity=50)
+    for key in events:
+        summary.add(key)
+    assert summary.total == len(events)
+    assert len(summary) == 50
+    top = dict(summary.top(5))
+    assert sorted(top) == ["hot-%d" % n for n in range(5)]
+    for key, count in top.items():
+        # counts never underestimate, and overestimate by at most the error
+        assert 1000 <= count <= 1000 + summary.errors[key]
+        assert summary.errors[key] <= len(events) // 50
+
+
+def test_flags_keys_readmitted_with_inherited_counts():
+    uniques = SketchMap("url", "visitor_site_id", max_keys=2)
+    for n in range(100):
+        uniques.add({"url": "busy", "visitor_site_id": n})
+    for url in ["a", "b", "a"]:
+        uniques.add({"url": url, "visitor_site_id": 1})
+    assert uniques.errors()["busy"] == 0
+    assert uniques.errors()["a"] > 0
+    assert set(uniques.counts()) == set(["busy", "a"])
+    assert set(uniques.counts(complete=True)) == set(["busy"])
+
+    merged = SketchMap("url", "visitor_site_id", max_keys=2)
+    merged.merge(pickle.loads(pickle.dumps(uniques)))
+    assert merged.errors() == uniques.errors()
+    assert merged.counts() == uniques.counts()
+
+
+def test_ranks_keys_in_the_window():
+    top = SlidingTopN("url", window=60, resolution=10)
+    for url, count in [("a", 3), ("b", 5), ("c", 1)]:
+        for n in range(count):
+            top.add({"url": url}, timestamp=1000 + n)
+    top.add({"url": None}, timestamp=1000)
+    assert top.top(2, timestamp=1010) == [("b", 5), ("a", 3)]
+    assert top.total(timestamp=1010) == 9
+
+
+def test_expires_buckets_that_leave_the_window():
+    top = SlidingTopN("url", window=60, resolution=10)
+    top.add({"url": "old"}, timestamp=1000, count=10)
+    top.add({"url": "new"}, timestamp=1035)
+    assert dict(top.top(timestamp=1059)) == {"old": 10, "new": 1}
+    # the bucket of 1000-1009 leaves a window ending in the bucket of 1060
+    assert top.top(timestamp=1060) == [("new", 1)]
+    assert top.total(timestamp=1060) == 1
+    assert top.top(timestamp=2000) == []
+    assert top.totals == {}
+
+
+def test_counts_late_events_still_in_the_window():
+    top = SlidingTopN("url", window=60, resolution=10)
+    top.add({"url": "a"}, timestamp=1100)
+    top.add({"url": "a"}, timestamp=1050)
+    # older than the window
+    top.add({"url": "a"}, timestamp=1049)
+    assert top.top(timestamp=1100) == [("a", 2)]
+    assert top.top(timestamp=1105) == [("a", 2)]
+    assert top.top(timestamp=1110) == [("a", 1)]
+
+
+def test_uses_its_clock_and_keys_lists_as_tuples():
+    now = [1000.0]
+    top = SlidingTopN("metadata_tags", window=20, resolution=10,
+                      clock=lambda: now[0])
+    top.add({"metadata_tags": ["x", "y"]})
+    top.add({"metadata_tags": ["x", "y"]})
+    assert top.top() == [(("x", "y"), 2)]
+    now[0] = 1020.0
+    assert top.top() == []
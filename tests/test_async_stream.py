@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+from botocore.exceptions import ClientError
+
+from parsely_raw_data.async_stream import aevents_kinesis
+from parsely_raw_data.checkpoint import FileShardCheckpoint
+
+
+class FakeKinesis(object):
+    """An in-memory stand-in for an asynchronous Kinesis client"""
+
+    def __init__(self, shards, page_size=10, throttle_first_read=False):
+        self.shards = shards
+        self.page_size = page_size
+        self.throttle = throttle_first_read
+        self.iterator_requests = []
+
+    async def describe_stream(self, StreamName, ExclusiveStartShardId=None):
+        shard_ids = sorted(self.shards)
+        if ExclusiveStartShardId is not None:
+            shard_ids = [s for s in shard_ids if s > ExclusiveStartShardId]
+        return {"StreamDescription": {
+            "Shards": [{"ShardId": shard_id} for shard_id in shard_ids[:1]],
+            "HasMoreShards": len(shard_ids) > 1}}
+
+    async def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType,
+                                 StartingSequenceNumber=None):
+        self.iterator_requests.append((ShardId, ShardIteratorType))
+        records = self.shards[ShardId]
+        if ShardIteratorType == "TRIM_HORIZON":
+            position = 0
+        elif ShardIteratorType == "AFTER_SEQUENCE_NUMBER":
+            position = [seq for seq, _ in records].index(StartingSequenceNumber) + 1
+        else:
+            position = len(records)
+        return {"ShardIterator": "{}:{}".format(ShardId, position)}
+
+    async def get_records(self, ShardIterator, Limit):
+        if self.throttle:
+            self.throttle = False
+            raise ClientError(
+                {"Error": {"Code": "ProvisionedThroughputExceededException"}},
+                "GetRecords")
+        shard_id, position = ShardIterator.rsplit(":", 1)
+        position = int(position)
+        records = self.shards[shard_id][position:position + self.page_size]
+        return {
+            "Records": [{"SequenceNumber": seq, "Data": data}
+                        for seq, data in records],
+            "NextShardIterator": "{}:{}".format(shard_id, position + len(records)),
+            "MillisBehindLatest": 0,
+        }
+
+
+def make_shards(num_shards, num_events):
+    shards = {}
+    for i in range(num_shards):
+        shards["shardId-{:012d}".format(i)] = [
+            ("{}{:05d}".format(i, j),
+             json.dumps({"action": "pageview" if j % 2 else "heartbeat",
+                         "url": "http://example.com/{}".format(j),
+                         "shard": i, "n": j}).encode("utf-8"))
+            for j in range(num_events)]
+    return shards
+
+
+def collect(client, count, **kwargs):
+    async def run():
+        events = []
+        stream = aevents_kinesis("example.com", client=client, **kwargs)
+        async for event in stream:
+            events.append(event)
+            if len(events) == count:
+                break
+        await stream.aclose()
+        return events
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def test_reads_every_shard_from_trim_horizon(tmpdir):
+    client = FakeKinesis(make_shards(3, 10), throttle_first_read=True)
+    checkpoint = FileShardCheckpoint(str(tmpdir.join("shards.json")))
+    events = collect(client, 30, checkpoint=checkpoint)
+    assert sorted((e["shard"], e["n"]) for e in events) == \
+        [(i, j) for i in range(3) for j in range(10)]
+    assert set(kind for _, kind in client.iterator_requests) == {"TRIM_HORIZON"}
+
+
+def test_resumes_after_checkpoint(tmpdir):
+    path = str(tmpdir.join("shards.json"))
+    shards = make_shards(1, 20)
+    first = collect(FakeKinesis(shards, page_size=5), 8,
+                    checkpoint=FileShardCheckpoint(path))
+    client = FakeKinesis(shards, page_size=5)
+    rest = collect(client, 13, checkpoint=FileShardCheckpoint(path))
+    assert [e["n"] for e in first] == list(range(8))
+    assert [e["n"] for e in rest] == list(range(7, 20))
+    assert client.iterator_requests[0][1] == "AFTER_SEQUENCE_NUMBER"
+
+
+def test_filters_and_projects(tmpdir):
+    client = FakeKinesis(make_shards(2, 10))
+    checkpoint = FileShardCheckpoint(str(tmpdir.join("shards.json")))
+    events = collect(client, 10, checkpoint=checkpoint,
+                     fields=["action", "n"], where={"action": "pageview"})
+    assert all(set(e) == {"action", "n"} for e in events)
+    assert all(e["action"] == "pageview" for e in events)
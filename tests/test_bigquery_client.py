@@ -0,0 +1,97 @@
+import os
+import time
+
+import httplib2
+import pytest
+
+from parsely_raw_data import bigquery
+from parsely_raw_data.bigquery import _discovery_document
+
+DOCUMENT = u'{"name": "bigquery", "version": "v2"}'
+
+
+class FakeHttp(object):
+    """Serves the discovery document, or fails as `failure` says"""
+
+    requests = []
+    failure = None
+
+    def __init__(self, timeout=None):
+        pass
+
+    def request(self, uri):
+        FakeHttp.requests.append(uri)
+        if isinstance(FakeHttp.failure, Exception):
+            raise FakeHttp.failure
+        status = FakeHttp.failure or 200
+        return (httplib2.Response({"status": status}),
+                DOCUMENT.encode("utf-8"))
+
+
+@pytest.fixture
+def http(monkeypatch):
+    FakeHttp.requests = []
+    FakeHttp.failure = None
+    monkeypatch.setattr(bigquery.httplib2, "Http", FakeHttp)
+    return FakeHttp
+
+
+def write_cached(path, document, age):
+    with open(path, "w") as f:
+        f.write(document)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def test_fetches_and_caches_the_document(tmpdir, http):
+    path = str(tmpdir.join("cache", "discovery.json"))
+    assert _discovery_document(path, ttl=60) == DOCUMENT
+    assert http.requests == [bigquery.DISCOVERY_URL]
+    with open(path, "rb") as f:
+        assert f.read().decode("utf-8") == DOCUMENT
+    # served from the cache until it expires
+    assert _discovery_document(path, ttl=60) == DOCUMENT
+    assert len(http.requests) == 1
+
+
+def test_refreshes_a_document_older_than_the_ttl(tmpdir, http):
+    path = str(tmpdir.join("discovery.json"))
+    write_cached(path, u'{"old": true}', age=30)
+    assert _discovery_document(path, ttl=60) == u'{"old": true}'
+    assert http.requests == []
+    write_cached(path, u'{"old": true}', age=90)
+    assert _discovery_document(path, ttl=60) == DOCUMENT
+    assert len(http.requests) == 1
+    assert time.time() - os.path.getmtime(path) < 60
+
+
+@pytest.mark.parametrize("failure", [500, IOError("connection refused")])
+def test_falls_back_to_a_stale_document(tmpdir, http, failure):
+    path = str(tmpdir.join("discovery.json"))
+    write_cached(path, u'{"old": true}', age=90)
+    http.failure = failure
+    assert _discovery_document(path, ttl=60) == u'{"old": true}'
+    assert len(http.requests) == 1
+    # the stale copy is kept, and fetched again on the next call
+    with open(path) as f:
+        assert f.read() == u'{"old": true}'
+    assert _discovery_document(path, ttl=60) == u'{"old": true}'
+    assert len(http.requests) == 2
+
+
+def test_raises_without_a_cached_document(tmpdir, http):
+    path = str(tmpdir.join("discovery.json"))
+    http.failure = 503
+    with pytest.raises(IOError):
+        _discovery_document(path, ttl=60)
+    http.failure = None
+    assert _discovery_document(path, ttl=60) == DOCUMENT
+
+
+def test_serves_the_document_when_it_cant_be_cached(tmpdir, http):
+    # the cache directory is a file
+    blocker = tmpdir.join("cache")
+    blocker.write("")
+    path = str(blocker.join("discovery.json"))
+    assert _discovery_document(path, ttl=60) == DOCUMENT
+    assert not os.path.isdir(str(blocker))
@@ -0,0 +1,183 @@
+import json
+import threading
+
+from parsely_raw_data import bigquery
+from parsely_raw_data.bigquery import (_encode_insert_row, _insert_rows,
+                                       insert_batches, row_batches)
+
+
+class FakeRequest(object):
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self, num_retries=0):
+        return self.response
+
+
+class FakeTabledata(object):
+    """An insertAll endpoint failing rows as `errors(event_id, attempt)` says
+
+    `errors` returns the list of error reasons for a row, or an empty list.
+    """
+
+    def __init__(self, errors=lambda event_id, attempt: []):
+        self.errors = errors
+        self.requests = []
+        self.inserted = []
+        self.attempts = {}
+        self._lock = threading.Lock()
+
+    def tabledata(self):
+        return self
+
+    def insertAll(self, projectId, datasetId, tableId, body):
+        body = json.loads(body)
+        insert_errors = []
+        with self._lock:
+            self.requests.append(body["rows"])
+            for index, entry in enumerate(body["rows"]):
+                event_id = entry["json"]["event_id"]
+                attempt = self.attempts.get(event_id, 0)
+                self.attempts[event_id] = attempt + 1
+                reasons = self.errors(event_id, attempt)
+                if reasons:
+                    insert_errors.append({"index": index, "errors": [
+                        {"reason": reason} for reason in reasons]})
+                else:
+                    self.inserted.append(entry)
+        return FakeRequest({"insertErrors": insert_errors}
+                           if insert_errors else {})
+
+
+class FakeCheckpoint(object):
+    def __init__(self):
+        self.commits = []
+
+    def commit(self, positions=None):
+        self.commits.append(positions)
+
+
+def encode(count, prefix="e"):
+    return [_encode_insert_row({"event_id": "{}{}".format(prefix, i),
+                                "url": "http://example.com/"})
+            for i in range(count)]
+
+
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(bigquery, "_backoff", lambda attempt: 0)
+
+
+def test_uses_event_ids_as_insert_ids():
+    tabledata = FakeTabledata()
+    # rows without an event_id are sent without an insertId
+    entries = encode(2) + [_encode_insert_row({"event_id": None})]
+    assert _insert_rows(tabledata, entries, "p", "d", "t") == []
+    assert [entry.get("insertId") for entry in tabledata.inserted] == \
+        ["e0", "e1", None]
+
+
+def test_resends_only_rows_failing_for_transient_reasons(monkeypatch):
+    no_backoff(monkeypatch)
+
+    def errors(event_id, attempt):
+        if event_id == "e1" and attempt < 2:
+            return ["backendError"]
+        if event_id == "e2":
+            return ["invalid"]
+        if event_id == "e3" and attempt == 0:
+            # valid, but held back by e2
+            return ["stopped"]
+        if event_id == "e4":
+            return ["timeout", "invalid"]
+        return []
+
+    tabledata = FakeTabledata(errors)
+    failed = _insert_rows(tabledata, encode(6), "p", "d", "t")
+    assert failed == [2, 4]
+    assert [len(rows) for rows in tabledata.requests] == [6, 2, 1]
+    assert sorted(entry["insertId"] for entry in tabledata.inserted) == \
+        ["e0", "e1", "e3", "e5"]
+
+
+def test_gives_up_after_max_attempts(monkeypatch):
+    no_backoff(monkeypatch)
+    tabledata = FakeTabledata(
+        lambda event_id, attempt: ["rateLimitExceeded"]
+        if event_id == "e0" else [])
+    failed = _insert_rows(tabledata, encode(3), "p", "d", "t",
+                          max_attempts=3)
+    assert failed == [0]
+    assert tabledata.attempts == {"e0": 3, "e1": 1, "e2": 1}
+
+
+def test_commits_marks_in_order_until_a_batch_fails(monkeypatch):
+    no_backoff(monkeypatch)
+    tabledata = FakeTabledata(
+        lambda event_id, attempt: ["invalid"] if event_id == "b2-1" else [])
+    batches = [(encode(3, "b{}-".format(i)), "mark-{}".format(i))
+               for i in range(5)]
+    checkpoint = FakeCheckpoint()
+    summary = insert_batches(iter(batches), lambda: tabledata,
+                             project_id="p", dataset_id="d", table_id="t",
+                             concurrency=3, checkpoint=checkpoint)
+    assert summary.batches == 5 and summary.rows == 15
+    assert summary.failed_batches == [2] and summary.failed_rows == 1
+    # later batches were inserted, but their marks would skip batch 2
+    assert checkpoint.commits == ["mark-0", "mark-1"]
+    assert len(tabledata.inserted) == 14
+
+
+def test_commits_the_mark_of_a_final_empty_batch():
+    tabledata = FakeTabledata()
+    checkpoint = FakeCheckpoint()
+    summary = insert_batches(iter([(encode(2), "mark-0"), ([], "mark-1")]),
+                             lambda: tabledata, checkpoint=checkpoint)
+    assert summary.batches == 1 and summary.rows == 2
+    assert checkpoint.commits == ["mark-0", "mark-1"]
+
+
+def make_rows(count, size=50):
+    return [{"event_id": "e{:04}".format(i), "padding": "x" * size}
+            for i in range(count)]
+
+
+def test_closes_batches_at_max_rows():
+    batches = list(row_batches(make_rows(7), max_rows=3))
+    assert [len(entries) for entries, _ in batches] == [3, 3, 1]
+    assert [json.loads(entry)["json"]["event_id"]
+            for entries, _ in batches for entry in entries] == \
+        ["e{:04}".format(i) for i in range(7)]
+
+
+def test_closes_batches_at_max_bytes():
+    size = len(_encode_insert_row(make_rows(1)[0])) + 1
+    # a batch is closed by the row that brings it to max_bytes
+    batches = list(row_batches(make_rows(7), max_bytes=3 * size))
+    assert [len(entries) for entries, _ in batches] == [3, 3, 1]
+    batches = list(row_batches(make_rows(7), max_bytes=3 * size + 1))
+    assert [len(entries) for entries, _ in batches] == [4, 3]
+    batches = list(row_batches(make_rows(7), max_bytes=3 * size - 1))
+    assert [len(entries) for entries, _ in batches] == [3, 3, 1]
+
+
+def test_sends_a_row_over_max_bytes_at_the_end_of_a_batch():
+    rows = make_rows(5)
+    rows[1]["padding"] = "x" * 1000
+    rows[3]["padding"] = "x" * 1000
+    batches = list(row_batches(rows, max_bytes=500))
+    assert [[json.loads(entry)["json"]["event_id"] for entry in entries]
+            for entries, _ in batches] == \
+        [["e0000", "e0001"], ["e0002", "e0003"], ["e0004"]]
+
+
+def test_marks_each_batch_as_it_closes():
+    marks = iter(range(100))
+
+    class Checkpoint(object):
+        def mark(self):
+            return next(marks)
+
+    batches = list(row_batches(make_rows(4), max_rows=2,
+                               checkpoint=Checkpoint()))
+    assert [(len(entries), mark) for entries, mark in batches] == \
+        [(2, 0), (2, 1), (0, 2)]
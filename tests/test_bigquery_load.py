@@ -0,0 +1,210 @@
+import binascii
+import gzip
+import io
+import json
+import os
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from parsely_raw_data.bigquery import (_LoadProgress, load_files,
+                                       write_load_files)
+from parsely_raw_data.checkpoint import S3Checkpoint
+
+
+class FakeUpload(object):
+    """A resumable upload that reads its media in chunks, like the real one"""
+
+    def __init__(self, bigquery, body, media_body):
+        self.bigquery = bigquery
+        self.body = body
+        self.media = media_body
+        self.offset = 0
+
+    def next_chunk(self, num_retries=0):
+        if self.offset == 0 and self.job_id in self.bigquery.jobs_by_id:
+            raise HttpError(httplib2.Response({"status": 409}), b"duplicate")
+        size = self.media.size()
+        chunk = self.media.getbytes(self.offset, self.media.chunksize())
+        self.offset += len(chunk)
+        self.bigquery.uploaded.setdefault(self.job_id, b"")
+        self.bigquery.uploaded[self.job_id] += chunk
+        if self.offset < size:
+            return None, None
+        status = {"state": "DONE"}
+        if any(name in self.job_id for name in self.bigquery.fail_jobs):
+            status["errorResult"] = {"reason": "invalid"}
+            del self.bigquery.uploaded[self.job_id]
+        self.bigquery.jobs_by_id[self.job_id] = {
+            "configuration": self.body["configuration"], "status": status}
+        self.bigquery.jobs_inserted.append(self.job_id)
+        return None, {"jobReference": self.body["jobReference"]}
+
+    @property
+    def job_id(self):
+        return self.body["jobReference"]["jobId"]
+
+
+class FakeRequest(object):
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self, num_retries=0):
+        return self.response
+
+
+class FakeBigQuery(object):
+    """An in-memory stand-in for the BigQuery jobs API"""
+
+    def __init__(self, fail_jobs=()):
+        self.uploaded = {}
+        self.jobs_by_id = {}
+        self.jobs_inserted = []
+        self.fail_jobs = fail_jobs
+
+    def jobs(self):
+        return self
+
+    def insert(self, projectId, body, media_body):
+        assert media_body.resumable()
+        assert body["configuration"]["load"]["sourceFormat"] == \
+            "NEWLINE_DELIMITED_JSON"
+        return FakeUpload(self, body, media_body)
+
+    def get(self, projectId, jobId):
+        return FakeRequest(self.jobs_by_id[jobId])
+
+    def rows(self):
+        rows = []
+        for data in self.uploaded.values():
+            lines = gzip.GzipFile(fileobj=io.BytesIO(data)).read().splitlines()
+            rows.extend(json.loads(line.decode("utf-8")) for line in lines)
+        return rows
+
+
+def make_rows(count):
+    # random padding keeps the rows from compressing to nothing
+    return [{"event_id": "e{}".format(i),
+             "url": "http://example.com/{}".format(i),
+             "padding": binascii.hexlify(os.urandom(64)).decode("ascii")}
+            for i in range(count)]
+
+
+def test_writes_size_capped_files(tmpdir):
+    rows = make_rows(5000)
+    paths = write_load_files(rows, str(tmpdir), max_bytes=50000, writers=3,
+                             batch_size=100)
+    assert len(paths) > 3
+    written = []
+    for path in paths:
+        with gzip.open(path) as f:
+            written.extend(json.loads(line.decode("utf-8")) for line in f)
+    assert sorted(row["event_id"] for row in written) == \
+        sorted(row["event_id"] for row in rows)
+    assert not [name for name in os.listdir(str(tmpdir))
+                if name.startswith(".tmp-")]
+
+
+def test_loads_each_file_with_a_resumable_upload(tmpdir):
+    rows = make_rows(3000)
+    paths = write_load_files(rows, str(tmpdir), max_bytes=100000, writers=2,
+                             batch_size=200)
+    bigquery = FakeBigQuery()
+    failed = load_files(paths, lambda: bigquery, project_id="p",
+                        dataset_id="d", table_id="t", concurrency=2,
+                        poll_interval=0)
+    assert failed == []
+    assert len(bigquery.jobs_inserted) == len(paths)
+    assert len(set(bigquery.jobs_inserted)) == len(paths)
+    assert sorted(row["event_id"] for row in bigquery.rows()) == \
+        sorted(row["event_id"] for row in rows)
+    assert not any(os.path.exists(path) for path in paths)
+
+
+def test_keeps_files_whose_jobs_fail(tmpdir):
+    paths = write_load_files(make_rows(2000), str(tmpdir), max_bytes=50000,
+                             writers=2, batch_size=100)
+    failing = os.path.basename(paths[0]).replace(".", "_")
+    bigquery = FakeBigQuery(fail_jobs=[failing])
+    failed = load_files(paths, lambda: bigquery, concurrency=2,
+                        poll_interval=0)
+    assert failed == [paths[0]]
+    assert os.path.exists(paths[0])
+    assert not any(os.path.exists(path) for path in paths[1:])
+
+
+def test_retries_a_failed_file_under_a_new_job_id(tmpdir):
+    paths = write_load_files(make_rows(500), str(tmpdir), writers=1)
+    bigquery = FakeBigQuery(fail_jobs=["load"])
+    assert load_files(paths, lambda: bigquery, poll_interval=0) == paths
+    bigquery.fail_jobs = []
+    assert load_files(paths, lambda: bigquery, poll_interval=0) == []
+    assert len(bigquery.jobs_inserted) == 2
+    assert bigquery.jobs_inserted[0].endswith("_0")
+    assert bigquery.jobs_inserted[1].endswith("_1")
+    assert len(bigquery.rows()) == 500
+
+
+def test_doesnt_reload_a_loaded_file(tmpdir):
+    paths = write_load_files(make_rows(500), str(tmpdir), writers=1)
+    bigquery = FakeBigQuery()
+    assert load_files(paths, lambda: bigquery, poll_interval=0,
+                      remove=False) == []
+    assert load_files(paths, lambda: bigquery, poll_interval=0) == []
+    assert len(bigquery.jobs_inserted) == 1
+    assert not os.path.exists(paths[0])
+
+
+def test_fails_on_a_job_id_sent_another_file(tmpdir):
+    paths = write_load_files(make_rows(500), str(tmpdir), writers=1)
+    bigquery = FakeBigQuery()
+    assert load_files(paths, lambda: bigquery, poll_interval=0,
+                      remove=False) == []
+    job_id = bigquery.jobs_inserted[0]
+    bigquery.jobs_by_id[job_id]["configuration"]["labels"] = {
+        "parsely_source_sha1": "0" * 40}
+    assert load_files(paths, lambda: bigquery, poll_interval=0) == paths
+    assert os.path.exists(paths[0])
+    assert len(bigquery.jobs_inserted) == 1
+
+
+def fake_events_s3(objects, checkpoint):
+    """Yield rows the way events_s3 does, recording each one's position"""
+    for key, count in objects:
+        lines, complete = checkpoint.position("bucket", key, "etag")
+        if complete:
+            continue
+        for line in range(lines + 1, count + 1):
+            checkpoint.record("bucket", key, "etag", line)
+            yield {"event_id": "{}:{}".format(key, line),
+                   "padding": binascii.hexlify(os.urandom(64)).decode("ascii")}
+        checkpoint.record("bucket", key, "etag", max(lines, count),
+                          complete=True)
+
+
+def test_commits_each_object_as_its_files_load(tmpdir):
+    objects = [("k{}".format(i), (i * 397) % 1500) for i in range(12)]
+    checkpoint = S3Checkpoint(str(tmpdir.join("checkpoint.db")))
+    progress = _LoadProgress(checkpoint, writers=3, batch_size=100)
+    paths = write_load_files(fake_events_s3(objects, progress),
+                             str(tmpdir.join("files")), max_bytes=40000,
+                             writers=3, batch_size=100, progress=progress)
+    assert len(paths) > 6
+    failing = os.path.basename(paths[len(paths) // 2]).replace(".", "_")
+    bigquery = FakeBigQuery(fail_jobs=[failing])
+    chains = progress.chains()
+    assert any(len(chain) > 1 for chain in chains)
+    failed = load_files(chains, lambda: bigquery, concurrency=2,
+                        poll_interval=0, on_load=progress.loaded)
+    assert failed
+
+    # a rerun reads exactly the events that weren't loaded
+    loaded = [row["event_id"] for row in bigquery.rows()]
+    rerun = [row["event_id"] for row in fake_events_s3(objects, checkpoint)]
+    assert rerun
+    assert sorted(loaded + rerun) == sorted(
+        "{}:{}".format(key, line)
+        for key, count in objects for line in range(1, count + 1))
+    complete = [key for key, count in objects
+                if checkpoint.position("bucket", key, "etag")[1]]
+    assert 0 < len(complete) < len(objects)
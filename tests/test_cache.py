@@ -0,0 +1,79 @@
+import os
+
+from parsely_raw_data.cache import ObjectCache
+
+
+def put(cache, key, etag, size):
+    with cache.put("bucket", key, etag, [b"x" * size]) as f:
+        return f.read()
+
+
+def cached_files(cache):
+    return sorted(name for name in os.listdir(cache.directory)
+                  if not name.startswith(".tmp-"))
+
+
+def test_serves_entries_only_for_their_etag(tmpdir):
+    cache = ObjectCache(str(tmpdir))
+    assert cache.get("bucket", "a", "etag-1") is None
+    assert put(cache, "a", "etag-1", 10) == b"x" * 10
+    with cache.get("bucket", "a", "etag-1") as f:
+        assert f.read() == b"x" * 10
+    assert cache.get("bucket", "a", "etag-2") is None
+    assert cache.get("other-bucket", "a", "etag-1") is None
+
+
+def test_evicts_least_recently_used_entries(tmpdir):
+    cache = ObjectCache(str(tmpdir), max_bytes=30)
+    for key in "abc":
+        put(cache, key, "etag", 10)
+    # reading "a" makes "b" the least recently used
+    cache.get("bucket", "a", "etag").close()
+    put(cache, "d", "etag", 10)
+    assert cache.get("bucket", "b", "etag") is None
+    for key in "acd":
+        cache.get("bucket", key, "etag").close()
+    assert len(cached_files(cache)) == 3
+
+
+def test_keeps_an_entry_larger_than_the_cap(tmpdir):
+    cache = ObjectCache(str(tmpdir), max_bytes=30)
+    put(cache, "a", "etag", 10)
+    f = cache.put("bucket", "big", "etag", [b"x" * 50])
+    assert cache.get("bucket", "a", "etag") is None
+    assert f.read() == b"x" * 50
+    f.close()
+    # an entry evicted while open stays readable
+    with cache.get("bucket", "big", "etag") as f:
+        put(cache, "c", "etag", 50)
+        assert f.read() == b"x" * 50
+    assert cache.get("bucket", "big", "etag") is None
+
+
+def test_removes_entries_for_stale_etags(tmpdir):
+    cache = ObjectCache(str(tmpdir))
+    put(cache, "a", "0123abcd", 10)
+    put(cache, "b", "0123abcd", 10)
+    # multipart upload ETags hold a "-"
+    put(cache, "a", "4567cdef-3", 20)
+    assert cache.get("bucket", "a", "0123abcd") is None
+    assert len(cached_files(cache)) == 2
+    put(cache, "a", "89abef01-12", 30)
+    assert cache.get("bucket", "a", "4567cdef-3") is None
+    with cache.get("bucket", "a", "89abef01-12") as f:
+        assert len(f.read()) == 30
+    assert len(cached_files(cache)) == 2
+    assert cache._total_bytes == 40
+
+
+def test_reloads_entries_and_applies_its_cap(tmpdir):
+    cache = ObjectCache(str(tmpdir))
+    for key in "abc":
+        put(cache, key, "etag", 10)
+    os.utime(os.path.join(cache.directory,
+                          cache._name("bucket", "a", "etag")), (0, 0))
+    cache = ObjectCache(str(tmpdir), max_bytes=20)
+    # the oldest file was evicted on load
+    assert cache.get("bucket", "a", "etag") is None
+    for key in "bc":
+        cache.get("bucket", key, "etag").close()
@@ -0,0 +1,28 @@
+from parsely_raw_data.checkpoint import S3Checkpoint
+
+
+def test_persists_only_committed_positions(tmpdir):
+    path = str(tmpdir.join("checkpoint.db"))
+    checkpoint = S3Checkpoint(path)
+    checkpoint.record("bucket", "a", "etag-a", 10, complete=True)
+    checkpoint.record("bucket", "b", "etag-b", 3)
+    mark = checkpoint.mark()
+    checkpoint.record("bucket", "b", "etag-b", 5)
+    checkpoint.record("bucket", "c", "etag-c", 1)
+    checkpoint.commit(mark)
+    # positions recorded after the mark stay pending
+    assert checkpoint.mark() == {("bucket", "b"): ("etag-b", 5, False),
+                                 ("bucket", "c"): ("etag-c", 1, False)}
+    checkpoint.close()
+
+    checkpoint = S3Checkpoint(path)
+    assert checkpoint.position("bucket", "a", "etag-a") == (10, True)
+    assert checkpoint.position("bucket", "b", "etag-b") == (3, False)
+    assert checkpoint.position("bucket", "c", "etag-c") == (0, False)
+
+
+def test_discards_positions_of_rewritten_objects(tmpdir):
+    checkpoint = S3Checkpoint(str(tmpdir.join("checkpoint.db")))
+    checkpoint.record("bucket", "a", "etag-1", 10, complete=True)
+    checkpoint.commit()
+    assert checkpoint.position("bucket", "a", "etag-2") == (0, False)
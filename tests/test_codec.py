@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from parsely_raw_data import codec
+
+EVENT = {"url": u"http://example.com/café", "engaged_time_inc": 5,
+         "metadata_tags": [u"日本", "b"], "extra_data": None, "flag": True}
+
+
+def test_falls_back_to_the_standard_library(monkeypatch):
+    monkeypatch.delenv("PARSELY_JSON_CODEC", raising=False)
+    installed = codec._load_codec
+    monkeypatch.setattr(codec, "_load_codec",
+                        lambda name: installed(name) if name == "json"
+                        else None)
+    name, loads, dumps = codec._select()
+    assert name == "json"
+    assert loads(dumps(EVENT).encode("utf-8")) == EVENT
+    assert codec.available_codecs() == ["json"]
+
+
+def test_prefers_the_fastest_installed_codec(monkeypatch):
+    monkeypatch.delenv("PARSELY_JSON_CODEC", raising=False)
+    installed = codec._load_codec
+    monkeypatch.setattr(codec, "_load_codec",
+                        lambda name: installed("json")
+                        if name in ("simdjson", "json") else None)
+    assert codec._select()[0] == "simdjson"
+    assert codec.available_codecs()[-1] == "json"
+
+
+def test_forces_a_codec_from_the_environment(monkeypatch):
+    monkeypatch.setenv("PARSELY_JSON_CODEC", "json")
+    name, loads, dumps = codec._select()
+    assert name == "json"
+    assert (loads, dumps) == (codec._stdlib_loads, codec._stdlib_dumps)
+    monkeypatch.setenv("PARSELY_JSON_CODEC", "no-such-codec")
+    with pytest.raises(ImportError):
+        codec._select()
+
+
+@pytest.mark.parametrize("name", codec.available_codecs())
+def test_decodes_bytes_and_text(name):
+    loads, dumps = codec._load_codec(name)
+    text = dumps(EVENT)
+    assert isinstance(text, type(u""))
+    assert loads(text) == EVENT
+    assert loads(text.encode("utf-8")) == EVENT
+    # slashes are left unescaped, as the standard library writes them
+    assert "\\/" not in text
+    with pytest.raises(ValueError):
+        loads(b'{"url": ')
+
+
+def test_decodes_bytes_where_json_only_takes_text(monkeypatch):
+    monkeypatch.setattr(codec, "STDLIB_LOADS_BYTES", False)
+    assert codec._stdlib_loads(u'{"a": "café"}'.encode("utf-8")) == \
+        {"a": u"café"}
+    assert codec._stdlib_loads(u'{"a": 1}') == {"a": 1}
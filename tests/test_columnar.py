@@ -0,0 +1,98 @@
+import math
+
+import pytest
+
+from parsely_raw_data import columnar
+from parsely_raw_data.columnar import iter_batches, to_columns
+
+
+@pytest.fixture(params=["numpy", "array"])
+def backend(request, monkeypatch):
+    if request.param == "numpy":
+        if columnar.np is None:
+            pytest.skip("NumPy is not installed")
+    else:
+        monkeypatch.setattr(columnar, "np", None)
+    return request.param
+
+
+def column(batch, field):
+    return list(batch.columns[field]), [bool(flag)
+                                        for flag in batch.nulls[field]]
+
+
+def test_types_columns_from_the_schema(backend):
+    batch = to_columns([{"engaged_time_inc": 5, "ip_lat": 40.5,
+                         "flags_is_amp": True, "url": "http://a/",
+                         "metadata_tags": ["a", "b"]}],
+                       fields=["engaged_time_inc", "ip_lat", "flags_is_amp",
+                               "url", "metadata_tags", "unknown"])
+    assert batch.size == 1
+    assert column(batch, "engaged_time_inc") == ([5], [False])
+    assert column(batch, "ip_lat") == ([40.5], [False])
+    assert column(batch, "flags_is_amp") == ([True], [False])
+    assert column(batch, "url") == (["http://a/"], [False])
+    # lists stay whole values of an object column
+    assert column(batch, "metadata_tags") == ([["a", "b"]], [False])
+    assert column(batch, "unknown") == ([None], [True])
+    if backend == "numpy":
+        assert batch.columns["engaged_time_inc"].dtype == "int64"
+        assert batch.columns["metadata_tags"].shape == (1,)
+
+
+def test_coerces_values_and_masks_nulls(backend):
+    events = [{"engaged_time_inc": "7", "ip_lat": "1.5",
+               "flags_is_amp": "true"},
+              {"engaged_time_inc": "1474998120000.0", "ip_lat": 2,
+               "flags_is_amp": "false"},
+              {"engaged_time_inc": "soon", "ip_lat": "north",
+               "flags_is_amp": "maybe"},
+              {"engaged_time_inc": True, "ip_lat": None, "flags_is_amp": 1},
+              {}]
+    fields = ["engaged_time_inc", "ip_lat", "flags_is_amp"]
+    batch = to_columns(events, fields=fields)
+    assert column(batch, "engaged_time_inc") == (
+        [7, 1474998120000, 0, 1, 0], [False, False, True, False, True])
+    lats, nulls = column(batch, "ip_lat")
+    assert lats[:2] == [1.5, 2.0]
+    assert all(math.isnan(lat) for lat in lats[2:])
+    assert nulls == [False, False, True, True, True]
+    assert column(batch, "flags_is_amp") == (
+        [True, False, False, True, False], [False, False, True, False, True])
+
+
+def test_nulls_integers_overflowing_int64(backend):
+    batch = to_columns([{"session_id": 2 ** 63}, {"session_id": 1}],
+                       fields=["session_id"])
+    assert column(batch, "session_id") == ([0, 1], [True, False])
+    # coerced values are checked too
+    batch = to_columns([{"session_id": "1"}, {"session_id": -2 ** 63 - 1}],
+                       fields=["session_id"])
+    assert column(batch, "session_id") == ([1, 0], [False, True])
+    batch = to_columns([{"session_id": 2 ** 63 - 1}, {"session_id": -2 ** 63}],
+                       fields=["session_id"])
+    assert column(batch, "session_id") == ([2 ** 63 - 1, -2 ** 63],
+                                           [False, False])
+
+
+def test_encodes_categorical_columns(backend):
+    events = [{"url": "b"}, {"url": "a"}, {}, {"url": "b"}]
+    batch = to_columns(events, fields=["url", "action"],
+                       categorical=["url"])
+    assert list(batch.columns["url"]) == [0, 1, -1, 0]
+    assert batch.categories == {"url": ["b", "a"]}
+    assert [bool(flag) for flag in batch.nulls["url"]] == \
+        [False, False, True, False]
+    assert "action" not in batch.categories
+
+
+def test_groups_events_into_batches(backend):
+    events = ({"engaged_time_inc": n} for n in range(7))
+    batches = list(iter_batches(events, batch_size=3,
+                                fields=["engaged_time_inc", "url"],
+                                categorical=["url"]))
+    assert [batch.size for batch in batches] == [3, 3, 1]
+    assert [list(batch.columns["engaged_time_inc"]) for batch in batches] == \
+        [[0, 1, 2], [3, 4, 5], [6]]
+    assert all(batch.categories == {"url": []} for batch in batches)
+    assert list(iter_batches([], batch_size=3)) == []
@@ -0,0 +1,186 @@
+import json
+import os
+import sqlite3
+import time
+
+import pytest
+
+from parsely_raw_data import consumer_group, stream
+from parsely_raw_data.checkpoint import SQLiteShardCheckpoint
+from parsely_raw_data.consumer_group import (ShardLeases, _group_worker,
+                                             eligible_shards)
+
+STREAM = "parsely-dw-blog-parsely-com"
+
+
+class FakeKinesis(object):
+    """A stream whose shards each hold a list of batches of events
+
+    A shard whose `closed` flag is set ends after its last batch.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def describe_stream(self, StreamName):
+        return {"StreamDescription": {"Shards": [
+            dict(shard["description"]) for shard in self.shards]}}
+
+    def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType,
+                           StartingSequenceNumber=None):
+        position = 0
+        if ShardIteratorType == "AFTER_SEQUENCE_NUMBER":
+            position = int(StartingSequenceNumber.split("-")[1]) + 1
+        return {"ShardIterator": "{}:{}".format(ShardId, position)}
+
+    def get_records(self, ShardIterator, Limit):
+        shard_id, position = ShardIterator.split(":")
+        shard = [shard for shard in self.shards
+                 if shard["description"]["ShardId"] == shard_id][0]
+        position = int(position)
+        records = []
+        if position < len(shard["batches"]):
+            records = [{"SequenceNumber": "{}-{}".format(shard_id, position),
+                        "Data": json.dumps(event).encode("utf-8")}
+                       for event in shard["batches"][position]]
+        next_iterator = "{}:{}".format(shard_id, position + 1)
+        if shard.get("closed") and position + 1 >= len(shard["batches"]):
+            next_iterator = None
+        return {"Records": records, "NextShardIterator": next_iterator,
+                "MillisBehindLatest": 0}
+
+
+class Done(Exception):
+    pass
+
+
+def run_worker(tmpdir, monkeypatch, client, handler, lease_seconds=30.0):
+    monkeypatch.setattr(consumer_group.boto3, "client",
+                        lambda *args, **kwargs: client)
+    # don't pace GetRecords calls
+    monkeypatch.setattr(stream, "_poll_interval", lambda *args: 0)
+    with pytest.raises(Done):
+        _group_worker("blog.parsely.com", handler, 1, "", "", "us-east-1",
+                      str(tmpdir.join("leases.db")),
+                      str(tmpdir.join("checkpoints.db")), None, None,
+                      lease_seconds, 0.1, 10, os.getppid())
+
+
+def test_leases_up_to_a_limit_and_renews_them(tmpdir):
+    path = str(tmpdir.join("leases.db"))
+    a = ShardLeases(path, "a")
+    b = ShardLeases(path, "b")
+    shards = ["shard-0", "shard-1", "shard-2"]
+    assert a.acquire(STREAM, shards, 2) == ["shard-0", "shard-1"]
+    assert a.acquire(STREAM, shards, 2) == []
+    assert b.acquire(STREAM, shards, 2) == ["shard-2"]
+    assert a.renew(STREAM, shards) == set(["shard-0", "shard-1"])
+    a.release(STREAM, ["shard-1"])
+    assert b.acquire(STREAM, shards, 2) == ["shard-1"]
+    assert a.renew(STREAM, shards) == set(["shard-0"])
+
+
+def test_takes_over_expired_leases(tmpdir):
+    path = str(tmpdir.join("leases.db"))
+    a = ShardLeases(path, "a", lease_seconds=0.05)
+    b = ShardLeases(path, "b", lease_seconds=0.05)
+    assert a.acquire(STREAM, ["shard-0"], 1) == ["shard-0"]
+    assert b.acquire(STREAM, ["shard-0"], 1) == []
+    time.sleep(0.1)
+    assert b.acquire(STREAM, ["shard-0"], 1) == ["shard-0"]
+    # the old owner can neither renew nor finish the shard
+    assert a.renew(STREAM, ["shard-0"]) == set()
+    a.finish(STREAM, "shard-0")
+    assert a.finished(STREAM) == set()
+    b.finish(STREAM, "shard-0")
+    assert a.finished(STREAM) == set(["shard-0"])
+    assert a.acquire(STREAM, ["shard-0"], 1) == []
+
+
+def test_reads_children_after_their_parents():
+    shards = [{"ShardId": "shard-0"},
+              {"ShardId": "shard-1"},
+              {"ShardId": "shard-2", "ParentShardId": "shard-0",
+               "AdjacentParentShardId": "shard-1"},
+              {"ShardId": "shard-3", "ParentShardId": "shard-expired"}]
+    assert eligible_shards(shards, set()) == ["shard-0", "shard-1",
+                                              "shard-3"]
+    assert eligible_shards(shards, set(["shard-0"])) == ["shard-1",
+                                                         "shard-3"]
+    assert eligible_shards(shards, set(["shard-0", "shard-1"])) == \
+        ["shard-2", "shard-3"]
+
+
+def test_worker_reads_a_closed_shard_then_its_child(tmpdir, monkeypatch):
+    client = FakeKinesis([
+        {"description": {"ShardId": "shard-0"}, "closed": True,
+         "batches": [[{"n": 0}, {"n": 1}], [{"n": 2}]]},
+        {"description": {"ShardId": "shard-1", "ParentShardId": "shard-0"},
+         "batches": [[{"n": 3}]]},
+    ])
+    handled = []
+
+    def handler(events):
+        handled.extend(event["n"] for event in events)
+        if 3 in handled:
+            raise Done()
+
+    run_worker(tmpdir, monkeypatch, client, handler)
+    assert handled == [0, 1, 2, 3]
+    checkpoint = SQLiteShardCheckpoint(str(tmpdir.join("checkpoints.db")))
+    assert checkpoint.get(STREAM, "shard-0") == "shard-0-1"
+    leases = ShardLeases(str(tmpdir.join("leases.db")), "other")
+    assert leases.finished(STREAM) == set(["shard-0"])
+    # the worker gave up its lease on the child as it stopped
+    assert leases.acquire(STREAM, ["shard-1"], 1) == ["shard-1"]
+
+
+def test_worker_doesnt_save_positions_of_lost_shards(tmpdir, monkeypatch):
+    client = FakeKinesis([
+        {"description": {"ShardId": "shard-0"},
+         "batches": [[{"n": 0}], [{"n": 1}]]},
+    ])
+    checkpoint_path = str(tmpdir.join("checkpoints.db"))
+
+    def handler(events):
+        if events[0]["n"] == 0:
+            return
+        # another worker takes the shard over and gets further along
+        conn = sqlite3.connect(str(tmpdir.join("leases.db")))
+        conn.execute("UPDATE kinesis_leases SET owner = 'other'")
+        conn.commit()
+        other = SQLiteShardCheckpoint(checkpoint_path)
+        other.record(STREAM, "shard-0", "shard-0-5")
+        other.commit()
+        raise Done()
+
+    run_worker(tmpdir, monkeypatch, client, handler)
+    checkpoint = SQLiteShardCheckpoint(checkpoint_path)
+    assert checkpoint.get(STREAM, "shard-0") == "shard-0-5"
+
+
+def test_worker_rereads_a_shard_after_its_reader_fails(tmpdir, monkeypatch):
+    client = FakeKinesis([
+        {"description": {"ShardId": "shard-0"},
+         "batches": [[{"n": 0}], [{"n": 1}]]},
+    ])
+    get_records = client.get_records
+    calls = []
+
+    def flaky_get_records(ShardIterator, Limit):
+        calls.append(ShardIterator)
+        if len(calls) == 2:
+            raise RuntimeError("connection reset")
+        return get_records(ShardIterator, Limit)
+
+    client.get_records = flaky_get_records
+    handled = []
+
+    def handler(events):
+        handled.extend(event["n"] for event in events)
+        if 1 in handled:
+            raise Done()
+
+    run_worker(tmpdir, monkeypatch, client, handler)
+    # the second reader resumed after the committed first batch
+    assert handled == [0, 1]
@@ -0,0 +1,106 @@
+import threading
+
+import six
+
+from parsely_raw_data.metrics import (StreamMetrics, format_stats,
+                                      prometheus_text, report_stats)
+
+PREFIX = "parsely_kinesis_"
+
+
+def parse(text):
+    """Return the HELP and TYPE of each metric and its sample lines"""
+    assert text.endswith("\n")
+    metrics = {}
+    for line in text.splitlines():
+        if line.startswith("# "):
+            _, kind, name, value = line.split(" ", 3)
+            metrics.setdefault(name, {"samples": []})[kind] = value
+        else:
+            sample, value = line.rsplit(" ", 1)
+            name = sample.split("{", 1)[0]
+            metrics[name]["samples"].append((sample[len(name):], value))
+    return metrics
+
+
+def test_formats_counters_and_gauges():
+    metrics = StreamMetrics()
+    metrics.stream = "parsely-dw-blog-parsely-com"
+    shard = metrics.shard("shard-1")
+    shard.millis_behind_latest = 1500
+    shard.get_records_calls = 3
+    shard.records = 7
+    metrics.shard("shard-0").events = 2
+    metrics.record_stats.add({"records": 7, "undecodable": 1})
+    parsed = parse(prometheus_text(metrics.snapshot()))
+    records = parsed[PREFIX + "records_total"]
+    assert records["TYPE"] == "counter"
+    assert records["HELP"] == "Records read"
+    stream = 'stream="parsely-dw-blog-parsely-com"'
+    assert records["samples"] == [
+        ('{shard="shard-0",' + stream + '}', "0"),
+        ('{shard="shard-1",' + stream + '}', "7")]
+    behind = parsed[PREFIX + "millis_behind_latest"]
+    assert behind["TYPE"] == "gauge"
+    # a shard that hasn't been read yet has no lag to report
+    assert behind["samples"] == [('{shard="shard-1",' + stream + '}', "1500")]
+    decoding = dict(parsed[PREFIX + "decoding_total"]["samples"])
+    assert decoding['{result="undecodable",' + stream + '}'] == "1"
+    assert decoding['{result="invalid",' + stream + '}'] == "0"
+
+
+def test_keeps_help_and_type_for_metrics_without_samples():
+    parsed = parse(prometheus_text(StreamMetrics().snapshot(),
+                                   prefix="consumer"))
+    for name in ["consumer_millis_behind_latest", "consumer_records_total",
+                 "consumer_throttles_total", "consumer_queue_depth",
+                 "consumer_queue_size"]:
+        assert parsed[name]["samples"] == []
+        assert parsed[name]["HELP"]
+        assert parsed[name]["TYPE"] in ("counter", "gauge")
+
+
+def test_reports_queue_depth_and_escapes_labels():
+    queue = six.moves.queue.Queue(maxsize=8)
+    queue.put([])
+    metrics = StreamMetrics(event_queue=queue)
+    metrics.stream = 'a "quoted" \\ name'
+    parsed = parse(prometheus_text(metrics.snapshot()))
+    label = r'{stream="a \"quoted\" \\ name"}'
+    assert parsed[PREFIX + "queue_depth"]["samples"] == [(label, "1")]
+    assert parsed[PREFIX + "queue_size"]["samples"] == [(label, "8")]
+
+
+def test_summarizes_rates_between_snapshots():
+    metrics = StreamMetrics()
+    metrics.shard("shard-0").events = 100
+    previous = metrics.snapshot()
+    metrics.shard("shard-0").events = 300
+    metrics.shard("shard-1").events = 50
+    metrics.record_stats.add({"invalid": 2})
+    current = metrics.snapshot()
+    previous["time"], current["time"] = 0, 10
+    assert format_stats(previous, current) == [
+        "shard-0: 20.0 events/s, None ms behind, 0 throttles, 0 errors",
+        "shard-1: 5.0 events/s, None ms behind, 0 throttles, 0 errors",
+        "total: 25.0 events/s, 0 undecodable, 2 invalid records"]
+
+
+def test_reports_stats_from_a_thread():
+    written = threading.Event()
+
+    class Out(six.StringIO):
+        def write(self, text):
+            six.StringIO.write(self, text)
+            if text.startswith("queue depth"):
+                written.set()
+
+    out = Out()
+    metrics = StreamMetrics(event_queue=six.moves.queue.Queue())
+    metrics.shard("shard-0")
+    thread = report_stats(metrics, 0.01, out=out)
+    assert thread.daemon
+    assert written.wait(5)
+    lines = out.getvalue().splitlines()
+    assert lines[0].startswith("shard-0: 0.0 events/s")
+    assert "queue depth: 0/0" in lines
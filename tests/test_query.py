@@ -0,0 +1,60 @@
+import json
+
+from parsely_raw_data.query import compile_query, compile_where
+
+# strings that some encoders escape and others don't
+STRINGS = [u"plain", u'say "hi"', u"a/b", u"café", u"日本",
+           u"tab\there", u"back\\slash", u"\U0001f600"]
+
+
+def encodings(event):
+    """Yield the line for an event as several JSON encoders would write it"""
+    yield json.dumps(event).encode("utf-8")
+    yield json.dumps(event, ensure_ascii=False).encode("utf-8")
+    yield json.dumps(event, separators=(",", ":")).encode("utf-8")
+    yield json.dumps(event).replace("/", "\\/").encode("utf-8")
+
+
+def test_matches_any_acceptable_value():
+    prefilter, predicate = compile_where(
+        {"action": "pageview", "metadata_section": ["sports", "politics"]})
+    assert predicate({"action": "pageview", "metadata_section": "sports"})
+    assert not predicate({"action": "pageview", "metadata_section": "arts"})
+    assert not predicate({"action": "heartbeat",
+                          "metadata_section": "sports"})
+    assert not prefilter(b'{"action": "heartbeat", "x": "sports"}')
+    assert prefilter(b'{"action": "pageview", "x": "politics"}')
+
+
+def test_prefilter_never_drops_a_matching_line():
+    values = STRINGS + [0, 17, True, False, None]
+    for value in values:
+        prefilter, predicate = compile_where({"field": value})
+        for other in values:
+            event = {"field": other, "action": "pageview"}
+            for line in encodings(event):
+                if predicate(json.loads(line.decode("utf-8"))):
+                    assert prefilter(line), (value, line)
+
+
+def test_none_matches_missing_and_null_fields():
+    decode = compile_query(where={"field": [None, "x"]})
+    assert decode(b'{"action": "pageview"}') == {"action": "pageview"}
+    assert decode(b'{"field": null}') == {"field": None}
+    assert decode(b'{"field": "x"}') == {"field": "x"}
+    assert decode(b'{"field": "y"}') is None
+
+
+def test_unhashable_values_dont_match():
+    decode = compile_query(where={"metadata_tags": "a"})
+    assert decode(b'{"metadata_tags": ["a"]}') is None
+    assert decode(b'{"metadata_tags": {"a": 1}}') is None
+    assert decode(b'{"metadata_tags": "a"}') == {"metadata_tags": "a"}
+
+
+def test_projects_matching_events():
+    decode = compile_query(fields=["url", "missing"],
+                           where={"action": "pageview"})
+    assert decode(b'{"action": "pageview", "url": "u", "x": 1}') == \
+        {"url": "u", "missing": None}
+    assert decode(b'{"action": "heartbeat", "url": "u"}') is None
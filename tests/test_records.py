@@ -0,0 +1,82 @@
+import gzip
+import hashlib
+import io
+import json
+
+import pytest
+
+from parsely_raw_data.query import compile_query
+from parsely_raw_data.records import (KPL_MAGIC, RecordStats, deaggregate,
+                                      unpack_records)
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field(number, payload):
+    """Encode a length-delimited protocol buffer field"""
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def aggregate(payloads):
+    """Encode payloads as a KPL aggregated record"""
+    message = field(1, b"partition-key")
+    for payload in payloads:
+        # Record: partition_key_index (varint), data, then a tag
+        record = varint(1 << 3) + varint(0) + field(3, payload)
+        record += field(4, b"tag")
+        message += field(3, record)
+    return KPL_MAGIC + message + hashlib.md5(message).digest()
+
+
+def gzip_lines(lines):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+        f.write(b"\n".join(lines))
+    return buf.getvalue()
+
+
+def event(n):
+    return json.dumps({"n": n}).encode("utf-8")
+
+
+def test_deaggregates_sub_records():
+    payloads = [event(0), b"x" * 300, b""]
+    assert deaggregate(aggregate(payloads)) == payloads
+
+
+def test_rejects_corrupt_aggregated_records():
+    data = aggregate([event(0), event(1)])
+    with pytest.raises(ValueError):
+        deaggregate(data[:-1] + b"\x00")
+    with pytest.raises(ValueError):
+        deaggregate(data[:10])
+
+
+def test_unpacks_aggregated_and_compressed_records():
+    records = [
+        {"SequenceNumber": "1", "Data": event(0)},
+        {"SequenceNumber": "2",
+         "Data": aggregate([event(1), gzip_lines([event(2), event(3)])])},
+        {"SequenceNumber": "3", "Data": b'{"n": 4'},
+        {"SequenceNumber": "4", "Data": KPL_MAGIC + b"\x00" * 20},
+        {"SequenceNumber": "5", "Data": gzip_lines([event(4), event(5)])},
+    ]
+    counts = dict((name, 0) for name in RecordStats.FIELDS)
+    sequence_numbers, events = unpack_records(
+        records, compile_query(where={"n": [0, 1, 2, 4, 5]}), counts)
+    assert [e["n"] for e in events] == [0, 1, 2, 4, 5]
+    # a checkpoint taken mid-record resumes at its start
+    assert sequence_numbers == ["1", "1", "2", "4", "5"]
+    assert counts == {"records": 5, "aggregated": 1, "compressed": 2,
+                      "events": 5, "filtered": 1, "undecodable": 1,
+                      "invalid": 1}
@@ -0,0 +1,196 @@
+import gzip
+import io
+import multiprocessing
+from collections import Counter
+
+import pytest
+
+from parsely_raw_data import s3
+from parsely_raw_data.cache import ListingCache
+from parsely_raw_data.checkpoint import S3Checkpoint
+from parsely_raw_data.s3 import (_count_actions, _iter_byte_chunks,
+                                 _iter_gzip_lines, _list_objects,
+                                 _process_object, events_s3,
+                                 events_s3_batches, list_objects,
+                                 map_events_s3)
+
+
+class FakeS3(object):
+    """A bucket listed by list_objects_v2, `page_size` keys per page"""
+
+    def __init__(self, keys, page_size=2, bodies=None):
+        self.keys = sorted(keys)
+        self.page_size = page_size
+        self.bodies = bodies or {}
+        self.calls = []
+        self.fetched = []
+
+    def list_objects_v2(self, Bucket, Prefix, StartAfter=None,
+                        ContinuationToken=None):
+        self.calls.append((StartAfter, ContinuationToken))
+        keys = [key for key in self.keys if key.startswith(Prefix) and
+                key > (ContinuationToken or StartAfter or "")]
+        page = keys[:self.page_size]
+        res = {"Contents": [{"Key": key, "Size": 1, "ETag": '"%s"' % key}
+                            for key in page],
+               "IsTruncated": len(keys) > len(page)}
+        if res["IsTruncated"]:
+            res["NextContinuationToken"] = page[-1]
+        return res
+
+    def get_object(self, Bucket, Key):
+        self.fetched.append(Key)
+        return {"ETag": '"%s"' % Key, "Body": io.BytesIO(self.bodies[Key])}
+
+
+def gzip_member(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def test_decodes_lines_across_chunks():
+    lines = [("line %d" % n).encode("utf-8") * (n % 7 + 1)
+             for n in range(1000)]
+    data = gzip_member(b"\n".join(lines) + b"\n")
+    for chunk_size in (1, 7, 100, len(data)):
+        decoded = list(_iter_gzip_lines(_iter_byte_chunks(data, chunk_size)))
+        assert decoded == lines
+
+
+def test_decodes_concatenated_members():
+    # a line may straddle two members, and a member may be empty
+    data = (gzip_member(b"a\nb") + gzip_member(b"") +
+            gzip_member(b"c\n\nd\n") + gzip_member(b"e"))
+    for chunk_size in (1, 5, len(data)):
+        decoded = list(_iter_gzip_lines(_iter_byte_chunks(data, chunk_size)))
+        assert decoded == [b"a", b"bc", b"d", b"e"]
+
+
+def test_lists_every_page():
+    client = FakeS3(["a/%d" % n for n in range(5)] + ["b/0"])
+    objects = list(list_objects(client, "bucket", "a/"))
+    assert [obj["key"] for obj in objects] == ["a/%d" % n for n in range(5)]
+    assert objects[0]["etag"] == "a/0"
+    assert len(client.calls) == 3
+
+
+def test_refreshes_a_cached_listing_after_its_last_key(tmpdir):
+    cache = ListingCache(str(tmpdir))
+    prefix = "events/2099/01/01"
+    client = FakeS3([prefix + "/0", prefix + "/1"])
+    assert len(list(_list_objects(client, "bucket", prefix, cache))) == 2
+    client.keys.append(prefix + "/2")
+    client.calls = []
+    objects = list(_list_objects(client, "bucket", prefix, cache))
+    assert [obj["key"] for obj in objects] == \
+        [prefix + "/0", prefix + "/1", prefix + "/2"]
+    assert client.calls == [(prefix + "/1", None)]
+
+
+def test_serves_a_closed_listing_without_listing(tmpdir):
+    cache = ListingCache(str(tmpdir))
+    prefix = "events/2016/01/01/00"
+    client = FakeS3([prefix + "/0"])
+    assert len(list(_list_objects(client, "bucket", prefix, cache))) == 1
+    client.keys.append(prefix + "/1")
+    client.calls = []
+    assert len(list(_list_objects(client, "bucket", prefix, cache))) == 1
+    assert not client.calls
+
+
+def test_resumes_from_a_checkpoint(tmpdir, monkeypatch):
+    bodies = {}
+    for name in ("a", "b", "c"):
+        lines = ['{"key": "%s", "line": %d}' % (name, n) for n in range(5)]
+        bodies["2016/01/01/" + name] = gzip_member(
+            "\n".join(lines).encode("utf-8"))
+    client = FakeS3(bodies, bodies=bodies)
+    monkeypatch.setattr(s3, "_s3_client", lambda *args: client)
+    path = str(tmpdir.join("checkpoint.db"))
+
+    checkpoint = S3Checkpoint(path)
+    events = events_s3("blog.parsely.com", prefix="2016/01/01",
+                       checkpoint=checkpoint)
+    for _ in range(7):
+        next(events)
+    checkpoint.commit()
+    # these are read but never committed
+    next(events)
+    next(events)
+    checkpoint.close()
+
+    client.fetched = []
+    checkpoint = S3Checkpoint(path)
+    events = list(events_s3("blog.parsely.com", prefix="2016/01/01",
+                            checkpoint=checkpoint))
+    assert [(e["key"], e["line"]) for e in events] == \
+        [("b", n) for n in range(2, 5)] + [("c", n) for n in range(5)]
+    assert client.fetched == ["2016/01/01/b", "2016/01/01/c"]
+
+
+def action_bodies():
+    """Three objects of pageviews and heartbeats, 3, 4 and 5 lines long"""
+    bodies = {}
+    for n, name in enumerate("abc"):
+        lines = ['{"action": "%s", "engaged_time_inc": %d, "url": "%s"}' % (
+            "pageview" if line % 2 else "heartbeat", line, name)
+            for line in range(n + 3)]
+        bodies["2016/01/01/" + name] = gzip_member(
+            "\n".join(lines).encode("utf-8"))
+    return bodies
+
+
+def test_reduces_one_object_in_a_worker(monkeypatch):
+    bodies = action_bodies()
+    client = FakeS3(bodies, bodies=bodies)
+    monkeypatch.setattr(s3, "_worker_client", client)
+    obj = list(list_objects(client, "bucket", "2016/01/01/b"))[0]
+    assert _process_object(("bucket", obj, None, None, _count_actions)) == \
+        Counter({"heartbeat": 2, "pageview": 2})
+    # the worker filters and projects before calling func
+    assert _process_object(("bucket", obj, ["url"], {"action": "pageview"},
+                            list)) == [{"url": "b"}, {"url": "b"}]
+    assert client.fetched == ["2016/01/01/b", "2016/01/01/b"]
+
+
+def fork_workers(monkeypatch, client):
+    """Give forked worker processes a fake client"""
+    get_start_method = getattr(multiprocessing, "get_start_method", None)
+    if get_start_method is not None and get_start_method() != "fork":
+        pytest.skip("workers only inherit the fake client when forked")
+    monkeypatch.setattr(s3, "_s3_client", lambda *args: client)
+
+
+def test_maps_objects_in_a_process_pool(monkeypatch):
+    bodies = action_bodies()
+    fork_workers(monkeypatch, FakeS3(bodies, bodies=bodies))
+    results = list(map_events_s3("blog.parsely.com", _count_actions,
+                                 prefix="2016/01/01", processes=1))
+    assert results == [Counter({"heartbeat": 2, "pageview": 1}),
+                       Counter({"heartbeat": 2, "pageview": 2}),
+                       Counter({"heartbeat": 3, "pageview": 2})]
+    results = map_events_s3("blog.parsely.com", _count_actions,
+                            prefix="2016/01/01", processes=2, ordered=False,
+                            where={"action": "pageview"})
+    assert sum(results, Counter()) == Counter({"pageview": 5})
+
+
+def test_builds_column_batches_in_a_process_pool(monkeypatch):
+    bodies = action_bodies()
+    fork_workers(monkeypatch, FakeS3(bodies, bodies=bodies))
+    fields = ["engaged_time_inc", "url"]
+    batches = list(events_s3_batches("blog.parsely.com", prefix="2016/01/01",
+                                     batch_size=4, fields=fields,
+                                     categorical=["url"]))
+    assert [batch.size for batch in batches] == [4, 4, 4]
+    # batches built in workers never span objects
+    batches = list(events_s3_batches("blog.parsely.com", prefix="2016/01/01",
+                                     batch_size=4, fields=fields,
+                                     categorical=["url"], processes=1))
+    assert [batch.size for batch in batches] == [3, 4, 4, 1]
+    assert [list(batch.columns["engaged_time_inc"]) for batch in batches] == \
+        [[0, 1, 2], [0, 1, 2, 3], [0, 1, 2, 3], [4]]
+    assert [batch.categories["url"] for batch in batches] == \
+        [["a"], ["b"], ["c"], ["c"]]
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+from parsely_raw_data.schema import compile_projector
+
+
+def make_event(**fields):
+    event = {"action": "pageview", "url": "http://example.com/",
+             "display_avail_height": 900, "ip_lat": 40.7,
+             "flags_is_amp": False, "metadata_tags": ["a", "b"]}
+    event.update(fields)
+    return event
+
+
+def test_projects_bigquery_rows():
+    project = compile_projector("bigquery")
+    row = project(make_event(extra_data={"x": 1}, not_a_field=1))
+    assert "extra_data" not in row and "not_a_field" not in row
+    assert row == make_event()
+    assert set(row) <= set(project.fields)
+
+
+def test_coerces_only_values_bigquery_rejects():
+    project = compile_projector("bigquery")
+    row = project(make_event(timestamp_info_nginx_ms=1459539616000.0,
+                             session_id="12", version="abc",
+                             flags_is_amp="false", metadata_tags="solo",
+                             metadata_authors=None, ip_lat="40.7",
+                             session_timestamp=None))
+    assert row["timestamp_info_nginx_ms"] == 1459539616000
+    assert row["session_id"] == 12
+    assert row["version"] is None
+    assert row["flags_is_amp"] is False
+    assert row["metadata_tags"] == ["solo"]
+    # a repeated column can't be null
+    assert "metadata_authors" not in row
+    assert row["ip_lat"] == "40.7"
+    assert row["session_timestamp"] is None
+
+
+def test_projects_redshift_tuples():
+    project = compile_projector("redshift")
+    assert "extra_data" not in project.fields
+    row = project(make_event(display_avail_height="900", ip_lat=40,
+                             flags_is_amp="true", url=None))
+    values = dict(zip(project.fields, row))
+    assert isinstance(row, tuple) and len(row) == len(project.fields)
+    assert values["display_avail_height"] == 900
+    assert values["ip_lat"] == 40
+    assert values["flags_is_amp"] is True
+    assert values["url"] is None
+    assert json.loads(values["metadata_tags"]) == ["a", "b"]
+    assert values["metadata_authors"] is None
+
+
+def test_keeps_extra_data_as_json_for_redshift():
+    project = compile_projector("redshift", keep_extra_data=True)
+    row = project(make_event(extra_data={"plan": "free"}))
+    values = dict(zip(project.fields, row))
+    assert json.loads(values["extra_data"]) == {"plan": "free"}
+
+
+def test_projects_csv_lists():
+    project = compile_projector("csv")
+    row = project(make_event(display_avail_height=[1], extra_data={"a": 1}))
+    values = dict(zip(project.fields, row))
+    assert isinstance(row, list) and len(row) == len(project.fields)
+    # missing values and values that can't be coerced are empty
+    assert values["url"] == "http://example.com/"
+    assert values["session_id"] == ""
+    assert values["display_avail_height"] == ""
+    assert json.loads(values["extra_data"]) == {"a": 1}
+
+
+def test_projects_chosen_fields_in_order():
+    project = compile_projector("csv", fields=["url", "action"])
+    assert project(make_event()) == ["http://example.com/", "pageview"]
+    project = compile_projector("bigquery", fields=["url", "ip_lat"])
+    assert project(make_event()) == {"url": "http://example.com/",
+                                     "ip_lat": 40.7}
+
+
+def test_rejects_unknown_targets_and_fields():
+    with pytest.raises(ValueError):
+        compile_projector("parquet")
+    with pytest.raises(ValueError):
+        compile_projector("bigquery", fields=["extra_data"])
+    with pytest.raises(ValueError):
+        compile_projector("redshift", fields=["not_a_field"])
@@ -0,0 +1,67 @@
+import gzip
+import json
+import os
+
+from parsely_raw_data.sink import PartitionedFileSink
+
+
+class FakeCheckpoint(object):
+
+    def __init__(self):
+        self.hooks = []
+
+    def add_commit_hook(self, hook):
+        self.hooks.append(hook)
+
+    def commit(self):
+        for hook in self.hooks:
+            hook()
+
+
+def make_event(n):
+    return {"ts_action": "2016-01-01 00:00:00", "n": n}
+
+
+def list_files(directory):
+    return sorted(os.path.join(root, name)
+                  for root, _, names in os.walk(directory) for name in names)
+
+
+def read_events(path):
+    with gzip.open(path) as f:
+        return [json.loads(line.decode("utf-8"))["n"] for line in f]
+
+
+def test_commits_sync_files_without_rolling_them(tmpdir):
+    checkpoint = FakeCheckpoint()
+    sink = PartitionedFileSink(str(tmpdir), batch_size=2)
+    sink.attach(checkpoint)
+    for n in range(10):
+        sink.write(make_event(n))
+        checkpoint.commit()
+    assert not [path for path in list_files(str(tmpdir))
+                if path.endswith(".gz")]
+    sink.close()
+    paths = [path for path in list_files(str(tmpdir)) if path.endswith(".gz")]
+    assert len(paths) == 1
+    assert read_events(paths[0]) == list(range(10))
+
+
+def test_recovers_the_committed_events_of_an_open_file(tmpdir):
+    checkpoint = FakeCheckpoint()
+    sink = PartitionedFileSink(str(tmpdir), batch_size=1)
+    sink.attach(checkpoint)
+    for n in range(3):
+        sink.write(make_event(n))
+    checkpoint.commit()
+    sink.write(make_event(3))
+    checkpoint.commit()
+    # written to disk but not committed before the process dies
+    sink.write(make_event(4))
+    sink._manifest = False
+    sink.flush()
+
+    PartitionedFileSink(str(tmpdir)).attach(FakeCheckpoint())
+    paths = list_files(str(tmpdir))
+    assert len(paths) == 1 and paths[0].endswith(".gz")
+    assert read_events(paths[0]) == [0, 1, 2, 3]
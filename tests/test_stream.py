@@ -0,0 +1,201 @@
+import itertools
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+from parsely_raw_data import stream
+from parsely_raw_data.checkpoint import (FileShardCheckpoint,
+                                         SQLiteShardCheckpoint)
+from parsely_raw_data.metrics import ShardMetrics
+from parsely_raw_data.stream import (_backoff, _poll_interval, events_kinesis,
+                                     read_shard)
+
+STREAM = "parsely-dw-blog-parsely-com"
+
+
+class FakeKinesis(object):
+    """A one-shard stream holding a list of batches of events
+
+    Sequence numbers are "<batch>-<record>"; iterators are positions in the
+    list of batches.
+    """
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.iterator_requests = []
+
+    def describe_stream(self, StreamName):
+        return {"StreamDescription": {"Shards": [{"ShardId": "shard-0"}]}}
+
+    def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType,
+                           StartingSequenceNumber=None):
+        self.iterator_requests.append((ShardIteratorType,
+                                       StartingSequenceNumber))
+        position = 0
+        if ShardIteratorType == "AFTER_SEQUENCE_NUMBER":
+            batch, record = map(int, StartingSequenceNumber.split("-"))
+            position = batch + 1
+        return {"ShardIterator": str(position)}
+
+    def get_records(self, ShardIterator, Limit):
+        position = int(ShardIterator)
+        records = []
+        if position < len(self.batches):
+            records = [{"SequenceNumber": "{}-{}".format(position, i),
+                        "Data": json.dumps(event).encode("utf-8")}
+                       for i, event in enumerate(self.batches[position])]
+        return {"Records": records, "NextShardIterator": str(position + 1),
+                "MillisBehindLatest": 0}
+
+
+@pytest.fixture(params=["sqlite", "file"])
+def open_checkpoint(request, tmpdir):
+    if request.param == "sqlite":
+        path = str(tmpdir.join("checkpoints.db"))
+        return lambda **kwargs: SQLiteShardCheckpoint(path, **kwargs)
+    path = str(tmpdir.join("checkpoints.json"))
+    return lambda **kwargs: FileShardCheckpoint(path, **kwargs)
+
+
+def test_persists_committed_positions(open_checkpoint):
+    checkpoint = open_checkpoint()
+    assert checkpoint.get(STREAM, "shard-0") is None
+    checkpoint.record(STREAM, "shard-0", "1")
+    checkpoint.record(STREAM, "shard-1", "7")
+    checkpoint.commit()
+    checkpoint.record(STREAM, "shard-0", "2")
+    # the uncommitted position is lost
+    checkpoint = open_checkpoint()
+    assert checkpoint.get(STREAM, "shard-0") == "1"
+    assert checkpoint.get(STREAM, "shard-1") == "7"
+    assert checkpoint.get("other-stream", "shard-0") is None
+
+
+def test_commits_after_the_interval(open_checkpoint):
+    checkpoint = open_checkpoint(commit_interval=0)
+    checkpoint.record(STREAM, "shard-0", "1")
+    assert open_checkpoint().get(STREAM, "shard-0") == "1"
+    checkpoint = open_checkpoint(commit_interval=3600)
+    checkpoint.record(STREAM, "shard-0", "2")
+    assert open_checkpoint().get(STREAM, "shard-0") == "1"
+
+
+def test_keeps_positions_when_a_commit_hook_fails(open_checkpoint):
+    checkpoint = open_checkpoint()
+    failures = [RuntimeError("disk full")]
+
+    def hook():
+        if failures:
+            raise failures.pop()
+
+    checkpoint.add_commit_hook(hook)
+    checkpoint.record(STREAM, "shard-0", "1")
+    with pytest.raises(RuntimeError):
+        checkpoint.commit()
+    assert open_checkpoint().get(STREAM, "shard-0") is None
+    checkpoint.commit()
+    assert open_checkpoint().get(STREAM, "shard-0") == "1"
+
+
+def read_events(client, checkpoint, count, monkeypatch):
+    monkeypatch.setattr(stream.boto3, "client", lambda *args, **kw: client)
+    monkeypatch.setattr(stream, "_poll_interval", lambda *args: 0)
+    events = events_kinesis("blog.parsely.com", checkpoint=checkpoint)
+    return [event["n"] for event in itertools.islice(events, count)]
+
+
+def test_resumes_after_the_committed_sequence_number(open_checkpoint,
+                                                     monkeypatch):
+    client = FakeKinesis([[{"n": 0}, {"n": 1}], [{"n": 2}], [{"n": 3}]])
+    checkpoint = open_checkpoint()
+    # asking for the fourth event records the position of the third
+    assert read_events(client, checkpoint, 4, monkeypatch) == [0, 1, 2, 3]
+    checkpoint.commit()
+    assert client.iterator_requests == [("TRIM_HORIZON", None)]
+
+    client.iterator_requests = []
+    assert read_events(client, open_checkpoint(), 1, monkeypatch) == [3]
+    assert client.iterator_requests == [("AFTER_SEQUENCE_NUMBER", "1-0")]
+
+
+def test_polls_less_often_once_caught_up():
+    assert _poll_interval(100, 5000) == stream.MIN_POLL_INTERVAL
+    assert _poll_interval(0, 5000) == stream.MIN_POLL_INTERVAL
+    assert _poll_interval(100, 0) == stream.CAUGHT_UP_POLL_INTERVAL
+    assert _poll_interval(0, 0) == stream.IDLE_POLL_INTERVAL
+    assert _poll_interval(0, None) == stream.IDLE_POLL_INTERVAL
+
+
+def test_backs_off_exponentially_with_full_jitter(monkeypatch):
+    monkeypatch.setattr(stream.random, "uniform", lambda low, high:
+                        (low, high))
+    assert _backoff(0) == (0, stream.BACKOFF_BASE)
+    assert _backoff(3) == (0, stream.BACKOFF_BASE * 8)
+    assert _backoff(20) == (0, stream.BACKOFF_MAX)
+    monkeypatch.undo()
+    delays = [_backoff(2) for _ in range(1000)]
+    assert all(0 <= delay <= stream.BACKOFF_BASE * 4 for delay in delays)
+    assert min(delays) < stream.BACKOFF_BASE
+    assert max(delays) > stream.BACKOFF_BASE * 3
+
+
+class ScriptedKinesis(object):
+    """A shard whose GetRecords calls return or raise from a script"""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.iterator_requests = []
+
+    def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType,
+                           StartingSequenceNumber=None):
+        self.iterator_requests.append((ShardIteratorType,
+                                       StartingSequenceNumber))
+        return {"ShardIterator": "iterator"}
+
+    def get_records(self, ShardIterator, Limit):
+        step = self.script.pop(0)
+        if isinstance(step, str):
+            raise ClientError({"Error": {"Code": step}}, "GetRecords")
+        records, millis_behind = step
+        return {"Records": [{"SequenceNumber": sequence_number, "Data": b"{}"}
+                            for sequence_number in records],
+                "NextShardIterator": "iterator" if self.script else None,
+                "MillisBehindLatest": millis_behind}
+
+
+def test_paces_reads_and_retries_throttles(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(stream.time, "sleep", sleeps.append)
+    monkeypatch.setattr(stream, "_backoff", lambda attempt: 10 + attempt)
+    client = ScriptedKinesis([
+        (["1", "2"], 9000),
+        "ProvisionedThroughputExceededException",
+        "LimitExceededException",
+        ([], 9000),
+        (["3"], 0),
+        "ExpiredIteratorException",
+        ([], 0),
+        (["4"], 0),
+    ])
+    metrics = ShardMetrics()
+    batches = list(read_shard(client, STREAM, "shard-0", metrics=metrics))
+    assert [[record["SequenceNumber"] for record in records]
+            for records in batches] == [["1", "2"], ["3"], ["4"]]
+    # the backoff grows with each throttle in a row, and resets on success
+    assert [delay for delay in sleeps if delay >= 10] == [10, 11]
+    paced = [delay for delay in sleeps if delay < 10]
+    # no pause after the last read of a closed shard
+    assert len(paced) == 4
+    assert paced[0] <= stream.MIN_POLL_INTERVAL
+    assert paced[1] <= stream.MIN_POLL_INTERVAL
+    assert stream.CAUGHT_UP_POLL_INTERVAL - 0.1 < paced[2] <= \
+        stream.CAUGHT_UP_POLL_INTERVAL
+    assert stream.IDLE_POLL_INTERVAL - 0.1 < paced[3] <= \
+        stream.IDLE_POLL_INTERVAL
+    # an expired iterator resumes after the last record read
+    assert client.iterator_requests == [("LATEST", None),
+                                        ("AFTER_SEQUENCE_NUMBER", "3")]
+    assert metrics.throttles == 2
+    assert metrics.records == 4
+    assert metrics.get_records_calls == 5
@@ -0,0 +1,76 @@
+import time
+from datetime import datetime
+
+import pytest
+
+from parsely_raw_data.utils import check_range, imap_bounded, plan_prefixes
+
+
+def slow_square(n):
+    # later items finish first
+    time.sleep(0.001 * (20 - n))
+    return n * n
+
+
+def test_keeps_input_order():
+    results = list(imap_bounded(slow_square, range(20), max_workers=4))
+    assert results == [n * n for n in range(20)]
+
+
+def test_yields_every_result_unordered():
+    results = list(imap_bounded(slow_square, range(20), max_workers=4,
+                                ordered=False))
+    assert sorted(results) == [n * n for n in range(20)]
+
+
+def test_bounds_the_items_in_flight():
+    pulled = []
+
+    def items():
+        for n in range(100):
+            pulled.append(n)
+            yield n
+
+    results = imap_bounded(lambda n: n, items(), max_workers=2, prefetch=3)
+    assert next(results) == 0
+    # the window of 3 was refilled once as the first result was consumed
+    assert len(pulled) == 4
+    assert list(results) == list(range(1, 100))
+
+
+def test_reraises_errors_in_the_consumer():
+    def func(n):
+        if n == 3:
+            raise KeyError(n)
+        return n
+
+    for ordered in (True, False):
+        results = imap_bounded(func, range(10), max_workers=2,
+                               ordered=ordered)
+        with pytest.raises(KeyError):
+            list(results)
+
+
+def test_plans_whole_days_and_partial_hours():
+    prefixes = plan_prefixes(datetime(2016, 1, 1, 22, 30),
+                             datetime(2016, 1, 4, 1, 15))
+    assert prefixes == ["2016/01/01/22", "2016/01/01/23", "2016/01/02",
+                        "2016/01/03", "2016/01/04/00", "2016/01/04/01"]
+
+
+def test_plans_a_single_hour():
+    assert plan_prefixes(datetime(2016, 2, 29, 5),
+                         datetime(2016, 2, 29, 6)) == ["2016/02/29/05"]
+    assert plan_prefixes(datetime(2016, 12, 31),
+                         datetime(2017, 1, 1)) == ["2016/12/31"]
+
+
+def test_checks_ranges():
+    assert not check_range(None, None)
+    assert check_range(datetime(2016, 1, 1), datetime(2016, 1, 2))
+    for start, end in [(datetime(2016, 1, 1), None),
+                       (None, datetime(2016, 1, 1)),
+                       (datetime(2016, 1, 2), datetime(2016, 1, 1)),
+                       (datetime(2016, 1, 1), datetime(2016, 1, 1))]:
+        with pytest.raises(ValueError):
+            check_range(start, end)